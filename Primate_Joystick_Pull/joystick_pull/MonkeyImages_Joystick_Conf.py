@@ -29,6 +29,8 @@ from butil import EventFile, Debounce, get_git_info, AnalogOut
 from butil import DigitalOutput
 from butil.out_file import EventFileProcess
 from butil.sound import get_sound_provider, SoundProvider
+from butil.event_source.shm_ring import RECORD_ANALOG, RECORD_SPIKE, RECORD_EVENT, RECORD_OTHER_EVENT, RECORD_ANALOG_BLOCK
+from butil.plexon import AnalogBlock
 
 from .game_frame import GameFrame, InfoView, screenshot_widgets, screenshot_widget
 from .photodiode import Photodiode
@@ -200,7 +202,11 @@ class MonkeyImages:
                 # from .plexon import Plexon
                 # self.plexon: Optional[Plexon] = Plexon()
                 from butil.plexon import PlexonProxy, PlexonOutput
-                self.plexon: Optional[PlexonProxy] = PlexonProxy() #type: ignore
+                spike_channels = None
+                if self.config.plexon_client_spike_filter and self.config.template_in_path is not None:
+                    with open(self.config.template_in_path) as f:
+                        spike_channels = behavioral_classifiers.helpers.template_spike_channels(json.load(f))
+                self.plexon: Optional[PlexonProxy] = PlexonProxy(spike_channels = spike_channels) #type: ignore
                 self.digital_output = PlexonOutput()
             case 'ability':
                 from butil.bridge.data_bridge import DataBridge
@@ -812,7 +818,7 @@ class MonkeyImages:
                 self.clear_image()
             
             self.log_event("trial_end", tags=['game_flow'], info={})
-            
+    
     
     def manual_water_dispense(self):
         self.log_event("manual_water_dispense", tags=[], info={'duration': self.config.manual_reward_time})
@@ -872,7 +878,7 @@ class MonkeyImages:
                     # get reward duration from percent
                     rwd_dur = perc * (rwd['reward_max'] - rwd['reward_min']) + rwd['reward_min']
                     return rwd_dur
-                
+            
             else:
                 assert False
         
@@ -1001,72 +1007,98 @@ class MonkeyImages:
         thread = Thread(target=send_events)
         thread.start()
     
+    def _handle_joystick_edge(self, ts: float, edge):
+        if edge.rising:
+            evt = self.log_hw('joystick_pulled', plexon_ts=ts)
+            self.joystick_pull_event = evt
+            self.joystick_pulled = True
+            self.joystick_pull_remote_ts = ts
+        elif edge.falling:
+            self.log_hw('joystick_released', plexon_ts=ts, info={
+                'pull_event': get_event_id(self.joystick_pull_event),
+            })
+            self.joystick_pull_event = None
+            self.joystick_pulled = False
+            self.joystick_release_remote_ts = ts
+    
+    def _handle_photodiode_edge(self, ts: float, edge):
+        if edge.rising:
+            self.log_hw('photodiode_on', plexon_ts=ts, info={'edge_ts': edge.ts})
+            self._photodiode_edge_count += 1
+            if self.info_view is not None:
+                self.info_view.update_pd_info(self._photodiode_flash_count, self._photodiode_edge_count)
+            if self.pending_photodiode_event is not None:
+                self.handle_classification_event(self.pending_photodiode_event, edge.ts)
+                self.pending_photodiode_event = None
+        if edge.falling:
+            self.log_hw('photodiode_off', plexon_ts=ts)
+    
+    def _handle_analog_sample(self, chan: int, ts: float, value: float):
+        if chan == self.config.joystick_channel:
+            self._handle_joystick_edge(ts, self.joystick_debounce.sample(ts, value))
+        elif self._photodiode is not None and chan == self.config.pd_channel:
+            self._handle_photodiode_edge(ts, self._photodiode.handle_value(value, ts))
+    
+    def _handle_analog_block(self, block: AnalogBlock):
+        a_out = self.analog_out.get(block.chan)
+        if a_out is not None:
+            a_out.append_block(block.values, ts=block.ts)
+        
+        # per sample timestamps are only computed for the joystick and photodiode channels
+        if block.chan == self.config.joystick_channel:
+            for ts, edge in self.joystick_debounce.sample_block(block.timestamps, block.values):
+                self._handle_joystick_edge(ts, edge)
+        elif self._photodiode is not None and block.chan == self.config.pd_channel:
+            for ts, edge in self._photodiode.handle_values(block.values, block.timestamps):
+                self._handle_photodiode_edge(ts, edge)
+    
     def gathering_data_omni_new(self):
         assert self.plexon
-        for d in self.plexon.get_data():
+        records, samples = self.plexon.get_records()
+        samples_i = 0
+        # plain python values are much faster to compare than numpy scalars
+        for ts, event_type, chan, unit, value, falling in records.tolist():
             if self._cl_helper is not None:
-                self._cl_helper.any_event(d.ts)
+                self._cl_helper.any_event(ts)
             
-            if d.type == d.ANALOG:
+            if event_type == RECORD_ANALOG_BLOCK:
+                block = AnalogBlock(ts, chan=chan, rate=value, values=samples[samples_i:samples_i + unit])
+                samples_i += unit
+                self._handle_analog_block(block)
+            elif event_type == RECORD_ANALOG:
                 try:
-                    a_out = self.analog_out[d.chan]
+                    a_out = self.analog_out[chan]
                 except KeyError:
                     pass
                 else:
-                    a_out.append(d.value, ts=d.ts)
+                    a_out.append(value, ts=ts)
                 
-                if d.chan == self.config.joystick_channel:
-                    edge = self.joystick_debounce.sample(d.ts, d.value)
-                    
-                    if edge.rising:
-                        evt = self.log_hw('joystick_pulled', plexon_ts=d.ts)
-                        self.joystick_pull_event = evt
-                        self.joystick_pulled = True
-                        self.joystick_pull_remote_ts = d.ts
-                    elif edge.falling:
-                        self.log_hw('joystick_released', plexon_ts=d.ts, info={
-                            'pull_event': get_event_id(self.joystick_pull_event),
-                        })
-                        self.joystick_pull_event = None
-                        self.joystick_pulled = False
-                        self.joystick_release_remote_ts = d.ts
-                elif self._photodiode is not None and d.chan == self.config.pd_channel:
-                    edge = self._photodiode.handle_value(d.value, d.ts)
-                    if edge.rising:
-                        self.log_hw('photodiode_on', plexon_ts=d.ts, info={'edge_ts': edge.ts})
-                        self._photodiode_edge_count += 1
-                        if self.info_view is not None:
-                            self.info_view.update_pd_info(self._photodiode_flash_count, self._photodiode_edge_count)
-                        if self.pending_photodiode_event is not None:
-                            self.handle_classification_event(self.pending_photodiode_event, edge.ts)
-                            self.pending_photodiode_event = None
-                    if edge.falling:
-                        self.log_hw('photodiode_off', plexon_ts=d.ts)
-            elif d.type == d.SPIKE:
+                self._handle_analog_sample(chan, ts, value)
+            elif event_type == RECORD_SPIKE:
                 if self._cl_helper is not None:
                     self._cl_helper.spike(
-                        channel = d.chan,
-                        unit = d.unit,
-                        timestamp = d.ts,
+                        channel = chan,
+                        unit = unit,
+                        timestamp = ts,
                     )
-            elif d.type == d.EVENT:
-                zone = self.zone_by_chan.get(d.chan)
+            elif event_type == RECORD_EVENT:
+                zone = self.zone_by_chan.get(chan)
                 if zone is not None:
-                    if d.falling: # zone exit
+                    if falling: # zone exit
                         zone.exit()
                     else: # zone enter
                         zone.enter()
                 else:
                     # handle dedicated exit events from plexon
-                    zone = self.zone_by_exit_chan.get(d.chan)
+                    zone = self.zone_by_exit_chan.get(chan)
                     if zone is not None:
                         zone.exit()
                 
                 # neuorkey interface won't send channel 12
-                if zone is None and d.chan == 12 and d.rising:
+                if zone is None and chan == 12 and not falling:
                     homezone = self.zone_by_name['homezone']
                     joystick_zone = self.zone_by_name['joystick_zone']
-                    self.log_hw('zone_exit', plexon_ts=d.ts, info={
+                    self.log_hw('zone_exit', plexon_ts=ts, info={
                         'was_in_homezone': homezone.in_zone,
                         'was_in_joystick_zone': joystick_zone.in_zone,
                     })
@@ -1079,20 +1111,20 @@ class MonkeyImages:
                         zone.exit()
                 
                 if zone is not None:
-                    self.log_hw(zone.event_name, plexon_ts=d.ts, info={
+                    self.log_hw(zone.event_name, plexon_ts=ts, info={
                         'changed': zone.changed,
                     })
-                    self.handle_classification_event(zone.event_name, d.ts)
+                    self.handle_classification_event(zone.event_name, ts)
                 else:
-                    self.log_hw('hw_event', plexon_ts=d.ts, info={'channel': d.chan})
-            elif d.type == d.OTHER_EVENT:
-                if d.chan == 1:
+                    self.log_hw('hw_event', plexon_ts=ts, info={'channel': chan})
+            elif event_type == RECORD_OTHER_EVENT:
+                if chan == 1:
                     # not sure what this is but plexon sends them every 10ms or so
                     pass
-                elif d.chan == 2:
-                    self.log_hw('plexon_recording_start', plexon_ts=d.ts)
+                elif chan == 2:
+                    self.log_hw('plexon_recording_start', plexon_ts=ts)
                 else:
-                    self.log_hw('plexon_other_event', plexon_ts=d.ts, info={'channel': d.chan})
+                    self.log_hw('plexon_other_event', plexon_ts=ts, info={'channel': chan})
 
 def main():
     logging.addLevelName(5, "trace")
@@ -201,6 +201,7 @@ class GameConfig:
         self.simulate_photodiode: bool = bool(os.environ.get('simulate_photodiode'))
         
         self.event_source: Optional[str] = os.environ.get('event_source')
+        self.plexon_client_spike_filter: bool = bool(os.environ.get('plexon_client_spike_filter'))
         
         self.no_git: bool = bool(os.environ.get('no_git'))
         self.no_print_stats: bool = bool(os.environ.get('no_print_stats'))
@@ -1,5 +1,5 @@
 
-from typing import Any
+from typing import Any, Dict, List, Optional, Tuple
 import argparse
 from pathlib import Path
 import json
@@ -7,9 +7,12 @@ import sys
 import os
 from contextlib import ExitStack
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+
+import numpy as np
 
 import behavioral_classifiers
-from butil import EventReader
 from .tools.time_sync import get_event_times
 
 from .config import GameConfig
@@ -53,65 +56,53 @@ event_classes = {
 def parse_args(args):
     parser = argparse.ArgumentParser(description='')
     
-    parser.add_argument('--events', required=True, type=Path,
-        help=".json.gz file")
-    parser.add_argument('--event-class', required=True,
-        help="e.g. joystick_pull")
+    parser.add_argument('--events', required=True, type=Path, nargs='+',
+        help=".json.gz file, more than one requires --batch-out")
+    parser.add_argument('--event-class', required=True, nargs='+',
+        help="e.g. joystick_pull, more than one requires --batch-out")
     parser.add_argument('--template-out', type=Path,
         help="")
     parser.add_argument('--info-out', type=Path,
         help="debug info output path")
     parser.add_argument('--labels', type=Path,
         help="json labels file")
-    parser.add_argument('--post-time', type=int, required=True,
-        help="window size after event in ms")
-    parser.add_argument('--bin-size', type=int, required=True,
-        help="bin size in ms")
+    parser.add_argument('--post-time', type=int, required=True, nargs='+',
+        help="window size after event in ms, more than one requires --batch-out")
+    parser.add_argument('--bin-size', type=int, required=True, nargs='+',
+        help="bin size in ms, more than one requires --batch-out")
     parser.add_argument('--baseline-offset', type=int,
         help="adds baseline events offset by specified amount (ms)")
+    parser.add_argument('--batch-out', type=Path,
+        help="directory to write a template for every combination of events file, event class, post time and bin size to")
+    parser.add_argument('--cache-dir', type=Path,
+        help="directory for the parsed events files in batch mode, defaults to a cache directory in the batch output directory")
+    parser.add_argument('--jobs', type=int,
+        help="number of processes used in batch mode, defaults to the number of cpus")
     
     return parser.parse_args(args=args)
 
-def gen_templates_main(stack, args_list=None):
-    args = parse_args(args_list)
-    
-    debug_info = {}
-    # end info written is added last for readability of output file
-    end_debug_info = {}
-    ts_info = []
-    debug_info['ts'] = ts_info
-    
-    def write_debug_info():
-        debug_info.update(end_debug_info)
-        if args.info_out is not None:
-            with open(args.info_out, 'w', encoding='utf8', newline='\n') as f:
-                json.dump(debug_info, f, indent=2)
-    stack.callback(write_debug_info)
-    
-    event_class = None
+def find_event_class(name: str) -> Optional[Dict[str, Any]]:
     try:
-        event_class = event_classes[args.event_class]
+        return event_classes[name]
     except KeyError:
-        for v in event_classes.values():
-            if args.event_class in v.get('aliases', set()):
-                event_class = v
-                break
-    if event_class is None:
-        print_error(f'unknown event class {args.event_class}')
-        sys.exit(1)
-    
-    events = []
-    with EventReader(path=args.events) as reader:
-        for record in reader.read_records():
-            name = record.get('name')
-            if name is None:
-                continue
-            events.append(record)
-    data = get_event_times.get_trial_details(events, plx_offset=0)
-    data = list(data)
-    end_debug_info['trial_details'] = data
-    end_debug_info['events'] = events
-    
+        pass
+    for v in event_classes.values():
+        if name in v.get('aliases', set()):
+            return v
+    return None
+
+def get_event_timestamps(
+    data: List[Dict[str, Any]],
+    event_class: Dict[str, Any],
+    ts_info: List[Any],
+    baseline_offset: Optional[int],
+) -> List[Tuple[str, float]]:
+    """returns (cue, timestamp) of the event in each successful trial
+        
+        Args:
+            data: trial details
+            ts_info: debug info for each trial is appended to it
+        """
     def get_ts():
         for rec in data:
             dbg: Any = {}
@@ -147,39 +138,221 @@ def gen_templates_main(stack, args_list=None):
     
     ts = list(get_ts())
     
-    if args.baseline_offset is not None:
+    if baseline_offset is not None:
         def get_baseline():
             for cue, _ts in ts:
                 baseline_cue = f"{cue}_baseline"
-                yield baseline_cue, _ts + (args.baseline_offset/1000)
+                yield baseline_cue, _ts + (baseline_offset/1000)
         baseline_ts = list(get_baseline())
         ts.extend(baseline_ts)
     
+    return ts
+
+def load_labels(path: Optional[Path]):
+    if path is None:
+        return None
+    with open(path) as f:
+        return json.load(f)['channels']
+
+def gen_templates_main(stack, args_list=None):
+    args = parse_args(args_list)
+    
+    if args.batch_out is not None:
+        gen_templates_batch(args)
+        return
+    
+    for name, values in [
+        ('--events', args.events),
+        ('--event-class', args.event_class),
+        ('--post-time', args.post_time),
+        ('--bin-size', args.bin_size),
+    ]:
+        if len(values) > 1:
+            print_error(f'multiple {name} values require --batch-out')
+            sys.exit(1)
+    events_path = args.events[0]
+    
+    debug_info = {}
+    # end info written is added last for readability of output file
+    end_debug_info = {}
+    ts_info = []
+    debug_info['ts'] = ts_info
+    
+    def write_debug_info():
+        debug_info.update(end_debug_info)
+        if args.info_out is not None:
+            with open(args.info_out, 'w', encoding='utf8', newline='\n') as f:
+                json.dump(debug_info, f, indent=2)
+    stack.callback(write_debug_info)
+    
+    event_class = find_event_class(args.event_class[0])
+    if event_class is None:
+        print_error(f'unknown event class {args.event_class[0]}')
+        sys.exit(1)
+    
+    # the events file is only read once, for both the events and the spikes
+    events = []
+    spike_ts, spike_chans, chan_names = behavioral_classifiers.eucl_classifier.read_events_file_spikes(
+        events_path, records=events)
+    data = get_event_times.get_trial_details(events, plx_offset=0)
+    data = list(data)
+    end_debug_info['trial_details'] = data
+    end_debug_info['events'] = events
+    
+    ts = get_event_timestamps(data, event_class, ts_info, args.baseline_offset)
+    
     debug_info['event_timestamps'] = ts
     # eprint('events', ts)
     eprint('event count', len(ts))
     
-    if args.labels is None:
-        labels = None
-    else:
-        with open(args.labels) as f:
-            labels = json.load(f)['channels']
+    labels = load_labels(args.labels)
     
-    debug_info['templates'] = behavioral_classifiers.eucl_classifier.build_templates_from_new_events_file(
+    debug_info['templates'] = behavioral_classifiers.eucl_classifier.build_templates_from_spikes(
         ts_list = ts,
-        events_path = args.events,
+        spike_ts = spike_ts,
+        spike_chans = spike_chans,
+        chan_names = chan_names,
         # template_path = args.template_out,
         event_class = event_class['event_class'],
-        post_time = args.post_time,
-        bin_size = args.bin_size,
+        post_time = args.post_time[0],
+        bin_size = args.bin_size[0],
         labels = labels,
     )
-    debug_info['templates']['_input_filename'] = args.events.name
+    debug_info['templates']['_input_filename'] = events_path.name
     debug_info['templates']['_generation_date'] = datetime.now().isoformat()
     if args.template_out is not None:
         with open(args.template_out, 'w', encoding='utf8', newline='\n') as f:
             json.dump(debug_info['templates'], f, indent=2)
 
+def _session_name(events_path: Path) -> str:
+    name = events_path.name
+    for suffix in ['.json.gz', '.json.bz2', '.json']:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def _cache_paths(cache_dir: Path, events_path: Path) -> Dict[str, Path]:
+    """cache paths of an events file, keyed on its absolute path, size and modification time
+        so files with the same name in different directories don't share a cache and a changed
+        file isn't read from a stale one
+        """
+    stat = events_path.stat()
+    key = f"{events_path.resolve()}|{stat.st_size}|{stat.st_mtime_ns}"
+    name = f"{_session_name(events_path)}_{hashlib.sha1(key.encode('utf8')).hexdigest()[:16]}"
+    return {
+        'spike_ts': cache_dir / f"{name}_spike_ts.npy",
+        'spike_chans': cache_dir / f"{name}_spike_chans.npy",
+        'events': cache_dir / f"{name}_events.json",
+    }
+
+def _tmp_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}.{os.getpid()}.tmp")
+
+def _cache_session(events_path: Path, cache_dir: Path) -> Dict[str, Path]:
+    """parses an events file into the cache if it isn't already, returns the cache paths"""
+    paths = _cache_paths(cache_dir, events_path)
+    if all(p.exists() for p in paths.values()):
+        return paths
+    
+    events = []
+    spike_ts, spike_chans, chan_names = behavioral_classifiers.eucl_classifier.read_events_file_spikes(
+        events_path, records=events)
+    # each file is written to a temporary name and moved into place so an interrupted
+    # write never leaves a partial file in the cache
+    for key, arr in [('spike_ts', spike_ts), ('spike_chans', spike_chans)]:
+        tmp = _tmp_path(paths[key])
+        with open(tmp, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp, paths[key])
+    # moved last so the cache is only complete once the spikes are
+    tmp = _tmp_path(paths['events'])
+    with open(tmp, 'w', encoding='utf8', newline='\n') as f:
+        json.dump({'chan_names': chan_names, 'events': events}, f)
+    os.replace(tmp, paths['events'])
+    return paths
+
+def _build_batch_template(job: Dict[str, Any]) -> Path:
+    """builds and writes the template for one batch combination"""
+    templates = behavioral_classifiers.eucl_classifier.build_templates_from_spikes(
+        ts_list = job['ts'],
+        spike_ts = np.load(job['cache']['spike_ts'], mmap_mode='r'),
+        spike_chans = np.load(job['cache']['spike_chans'], mmap_mode='r'),
+        chan_names = job['chan_names'],
+        event_class = job['event_class'],
+        post_time = job['post_time'],
+        bin_size = job['bin_size'],
+        labels = job['labels'],
+    )
+    templates['_input_filename'] = job['events_path'].name
+    templates['_generation_date'] = datetime.now().isoformat()
+    with open(job['template_out'], 'w', encoding='utf8', newline='\n') as f:
+        json.dump(templates, f, indent=2)
+    return job['template_out']
+
+def gen_templates_batch(args):
+    """writes a template for every combination of events file, event class, post time and bin size
+        
+        each events file is parsed once into the cache, then the templates are built in a process pool
+        """
+    event_class_names = {}
+    for name in args.event_class:
+        event_class = find_event_class(name)
+        if event_class is None:
+            print_error(f'unknown event class {name}')
+            sys.exit(1)
+        # aliases of the same class only build it once
+        event_class_names[event_class['event']] = event_class
+    
+    # the same file given twice is only processed once
+    events_paths: List[Path] = list({p.resolve(): p for p in args.events}.values())
+    # outputs are named after the events file so files with the same name would overwrite each other
+    session_names: Dict[str, Path] = {}
+    for events_path in events_paths:
+        name = _session_name(events_path)
+        if name in session_names:
+            print_error(f'{events_path} and {session_names[name]} have the same name, their templates would overwrite each other')
+            sys.exit(1)
+        session_names[name] = events_path
+    
+    out_dir: Path = args.batch_out
+    cache_dir: Path = args.cache_dir if args.cache_dir is not None else out_dir / 'cache'
+    out_dir.mkdir(parents=True, exist_ok=True)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    labels = load_labels(args.labels)
+    
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        cache = dict(zip(
+            events_paths,
+            pool.map(_cache_session, events_paths, [cache_dir] * len(events_paths)),
+        ))
+        
+        jobs = []
+        for events_path in events_paths:
+            with open(cache[events_path]['events'], encoding='utf8') as f:
+                cached = json.load(f)
+            data = list(get_event_times.get_trial_details(cached['events'], plx_offset=0))
+            for event_class in event_class_names.values():
+                ts = get_event_timestamps(data, event_class, [], args.baseline_offset)
+                eprint(events_path.name, event_class['event'], 'event count', len(ts))
+                for post_time in args.post_time:
+                    for bin_size in args.bin_size:
+                        name = f"{_session_name(events_path)}_{event_class['event']}_{post_time}_{bin_size}_templates.json"
+                        jobs.append({
+                            'events_path': events_path,
+                            'cache': cache[events_path],
+                            # passed so the workers don't load the cached events
+                            'chan_names': cached['chan_names'],
+                            'ts': ts,
+                            'event_class': event_class['event_class'],
+                            'post_time': post_time,
+                            'bin_size': bin_size,
+                            'labels': labels,
+                            'template_out': out_dir / name,
+                        })
+        
+        for template_out in pool.map(_build_batch_template, jobs):
+            eprint('wrote', template_out)
+
 def main():
     with ExitStack() as stack:
         gen_templates_main(stack)
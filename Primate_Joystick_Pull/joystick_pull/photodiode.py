@@ -1,10 +1,12 @@
 
-from typing import Optional
+from typing import Optional, List, Tuple
 import time
 import statistics
 import logging
 from collections import deque
 
+import numpy as np
+
 logger = logging.getLogger(__name__)
 debug = logger.debug
 
@@ -237,3 +239,64 @@ class Photodiode:
         #     self._last_time = ts
         # else:
         #     self.changed = False
+    
+    def handle_values(self, vals: np.ndarray, timestamps: np.ndarray) -> List[Tuple[float, Edge]]:
+        """same as calling handle_value for each value in order but only returns the edges
+            
+            returns (timestamp, edge) for each sample that produced an edge
+            """
+        n = len(vals)
+        # samples that count towards a rising edge and the falling edge samples
+        above = vals > self._rising_threshold
+        below = np.flatnonzero(vals < self._falling_threshold)
+        above_i = np.flatnonzero(above)
+        # length of the run of above threshold samples ending at each sample
+        idx = np.arange(n)
+        last_not_above = np.maximum.accumulate(np.where(above, -1, idx)) if n else idx
+        run = idx - last_not_above
+        
+        out = []
+        i = 0
+        while i < n:
+            if self._is_high:
+                fall = below[np.searchsorted(below, i):]
+                if len(fall) == 0:
+                    break
+                i = int(fall[0])
+                edge = Edge()
+                edge.falling = True
+                self._is_high = False
+                out.append((float(timestamps[i]), edge))
+                i += 1
+                continue
+            
+            candidates = above_i[np.searchsorted(above_i, i):]
+            # runs that started before i only count from i, plus the samples already counted
+            # when the run continues from the previous call
+            since_i = candidates - i + 1
+            from_i = run[candidates] >= since_i
+            counts = np.minimum(run[candidates], since_i) + np.where(from_i, self._edge_samples, 0)
+            done = np.flatnonzero(counts >= max(self._edge_width, 1))
+            if len(done) == 0:
+                # carry the run at the end of the block into the next call
+                if len(candidates) and candidates[-1] == n - 1:
+                    if not from_i[-1] or self._edge_samples == 0:
+                        self._edge_start_ts = float(timestamps[n - int(counts[-1])])
+                    self._edge_samples = int(counts[-1])
+                else:
+                    self._edge_samples = 0
+                break
+            
+            k = int(done[0])
+            j = int(candidates[k])
+            if not from_i[k] or self._edge_samples == 0:
+                self._edge_start_ts = float(timestamps[j - int(counts[k]) + 1])
+            edge = Edge()
+            edge.rising = True
+            edge.ts = self._edge_start_ts + self._edge_offset
+            self._is_high = True
+            self._edge_samples = 0
+            out.append((float(timestamps[j]), edge))
+            i = j + 1
+        
+        return out
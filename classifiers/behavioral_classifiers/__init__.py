@@ -2,4 +2,5 @@
 from .classifier import Classifier
 from .eucl_classifier import EuclClassifier
 from .random_classifier import RandomClassifier
+from .metric_classifier import MetricClassifier
 from .helpers.events_file import EventsFileWriter
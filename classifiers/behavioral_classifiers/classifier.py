@@ -1,5 +1,5 @@
 
-from typing import Any
+from typing import Any, Sequence
 
 class Classifier:
     def event(self, *, event_type: str = '', timestamp: float):
@@ -8,6 +8,11 @@ class Classifier:
     def spike(self, channel: str, timestamp: float):
         pass
     
+    def spike_batch(self, channels: Sequence[str], timestamps: Sequence[float]):
+        """adds spikes in timestamp order, equivalent to calling spike for each one"""
+        for channel, timestamp in zip(channels, timestamps):
+            self.spike(channel, timestamp)
+    
     def clear(self):
         pass
     
@@ -1,13 +1,13 @@
 
-from typing import Optional, Tuple, List, Dict, Set, Union, Any
+from typing import Optional, Tuple, List, Dict, Set, Union, Any, Sequence
 from pathlib import Path
 import json
 from collections import deque
-from struct import Struct
-from base64 import b85decode
 import os
 from math import isclose
 
+import numpy as np
+
 from .classifier import Classifier
 
 from butil import EventReader
@@ -22,10 +22,12 @@ class EuclClassifier(Classifier):
     def __init__(self, *,
         post_time: int, bin_size: int,
         channel_filter: set[str] | None = None,
+        float32: bool = False,
     ):
         """
             post_time: time after event to classify in in ms
             bin_size: in ms
+            float32: compute distances in single precision
             """
         self.post_time: float = post_time / 1000
         self.bin_size: float = bin_size / 1000
@@ -38,9 +40,22 @@ class EuclClassifier(Classifier):
         self._current_event: Optional[Tuple[str, float]] = None
         # list of (channel, spike timestamps in ms)
         self.event_spike_list: deque[Tuple[str, float]] = deque()
-        
+        self._dtype = np.float32 if float32 else np.float64
+        # channel -> row in the template matrix
+        self._template_chans: Dict[str, int] = {}
+        # event type of each template in the template matrix
+        self._template_types: List[str] = []
+        # (event types, channels, bins) psths of the templates
+        self._template_matrix: np.ndarray = np.zeros((0, 0, bins_n), dtype=self._dtype)
+        # (event types, channels) true if the channel is part of the event type's template
+        self._template_mask: np.ndarray = np.zeros((0, 0), dtype=bool)
+        # (channels, bins) psths of the current event for the template channels
+        self._event_counts: np.ndarray = np.zeros((0, bins_n), dtype=np.int64)
+        # channel -> psth of the current event, spikes are binned as they arrive
+        # rows of _event_counts for template channels
+        self._event_psths: Dict[str, np.ndarray] = {}
         # event_type -> psth dict
-        self.templates: Dict[str, PsthDict] = {}
+        self.templates = {}
         
         self.channel_filter: set[str] | None = channel_filter
         
@@ -48,20 +63,95 @@ class EuclClassifier(Classifier):
         if self._buffer_time < 2:
             self._buffer_time = 2
     
+    @property
+    def templates(self) -> Dict[str, PsthDict]:
+        return self._templates
+    
+    @templates.setter
+    def templates(self, templates: Dict[str, PsthDict]):
+        """sets the templates and compiles them into the template matrix"""
+        chans = sorted(set(chan for template in templates.values() for chan in template))
+        self._template_chans = {chan: i for i, chan in enumerate(chans)}
+        self._template_types = list(templates)
+        self._template_matrix = np.zeros((len(templates), len(chans), self._bins_n), dtype=self._dtype)
+        self._template_mask = np.zeros((len(templates), len(chans)), dtype=bool)
+        for type_i, template in enumerate(templates.values()):
+            for chan, template_psth in template.items():
+                assert len(template_psth) == self._bins_n
+                chan_i = self._template_chans[chan]
+                self._template_matrix[type_i, chan_i] = template_psth
+                self._template_mask[type_i, chan_i] = True
+        self._templates = templates
+        self._event_counts = np.zeros((len(chans), self._bins_n), dtype=np.int64)
+        self._event_psths = {}
+    
+    def _reset_event_psths(self):
+        self._event_counts.fill(0)
+        self._event_psths = {}
+    
     def clear(self):
         self._current_event = None
+        self._reset_event_psths()
     
     def event(self, *, event_type: str = '', timestamp: float):
         self._current_event = (event_type, timestamp)
+        self._reset_event_psths()
+        # spikes after the event can arrive before it
+        for channel, ts in self.event_spike_list:
+            self._bin_spike(channel, ts)
+    
+    def _bin_spike(self, channel: str, timestamp: float):
+        """adds a spike to the psth of the current event"""
+        assert self._current_event is not None
+        psth = self._event_psths.get(channel)
+        if psth is None:
+            chan_i = self._template_chans.get(channel)
+            if chan_i is None:
+                psth = np.zeros(self._bins_n, dtype=np.int64)
+            else:
+                psth = self._event_counts[chan_i]
+            self._event_psths[channel] = psth
+        
+        d = timestamp - self._current_event[1]
+        if d < 0:
+            return
+        bin_ = int(d / self.bin_size)
+        if bin_ < self._bins_n:
+            psth[bin_] += 1
     
     def spike(self, channel: str, timestamp: float):
         if self.channel_filter is not None and channel not in self.channel_filter:
             return
         
+        if self._current_event is not None:
+            self._bin_spike(channel, timestamp)
         self.event_spike_list.append((channel, timestamp))
         while self._buffer_time is not None and timestamp - self.event_spike_list[0][1] > self._buffer_time:
             self.event_spike_list.popleft()
     
+    def spike_batch(self, channels: Sequence[str], timestamps: Sequence[float]):
+        if len(timestamps) == 0:
+            return
+        if self.channel_filter is None:
+            spikes = list(zip(channels, timestamps))
+        else:
+            channel_filter = self.channel_filter
+            spikes = [
+                (channel, ts)
+                for channel, ts in zip(channels, timestamps)
+                if channel in channel_filter
+            ]
+        
+        if self._current_event is not None:
+            for channel, ts in spikes:
+                self._bin_spike(channel, ts)
+        self.event_spike_list.extend(spikes)
+        
+        if self._buffer_time is not None and self.event_spike_list:
+            latest = self.event_spike_list[-1][1]
+            while latest - self.event_spike_list[0][1] > self._buffer_time:
+                self.event_spike_list.popleft()
+    
     def zero_psth(self) -> List[int]:
         """creates a list of the correct length filled with zeros"""
         return [0 for _ in range(self._bins_n)]
@@ -70,121 +160,390 @@ class EuclClassifier(Classifier):
         return set(k for k, _ in self.event_spike_list)
     
     def build_key_psth(self, target_key: Optional[str] = None) -> List[int]:
-        psth = self.zero_psth()
+        """psth of one channel for the current event, the sum of all channels if target_key is None"""
         if self._current_event is None:
-            return psth
-        _, event_ts = self._current_event
-        for key, ts in self.event_spike_list:
-            if target_key is None or key != target_key:
-                continue
-            
-            d = ts - event_ts
-            if d < 0:
-                continue
-            
-            bin_ = d / self.bin_size
-            # is_on_left_edge = bin_.is_integer()
-            bin_ = int(bin_)
-            
-            # make right edge inclusive instead of left
-            # if is_on_left_edge:
-            #     bin_ -= 1
-            
-            if bin_ < 0:
-                continue
-            try:
-                psth[bin_] += 1
-            except IndexError:
-                pass
+            return self.zero_psth()
+        
+        if target_key is None:
+            psth = np.zeros(self._bins_n, dtype=np.int64)
+            for chan_psth in self._event_psths.values():
+                psth += chan_psth
+        else:
+            psth = self._event_psths.get(target_key)
+            if psth is None:
+                return self.zero_psth()
         
-        return psth
+        return psth.tolist()
     
     def build_per_key_psth(self) -> PsthDict:
-        keys = self.get_keys()
-        psths = {
-            key: self.build_key_psth(target_key=key)
-            for key in keys
+        return {
+            key: psth.tolist()
+            for key, psth in self._event_psths.items()
         }
-        return psths
     
     def classify_debug_info(self) -> tuple[str, Any]:
         debug_info = {}
         event_psths = self.build_per_key_psth()
         
-        def calc_chan_eucl_dist(a, b):
-            assert len(a) == len(b)
-            acc = 0
-            for a, b in zip(a, b):
-                acc += (a - b)**2
-            acc **= 0.5 # square root
-            return acc
+        # channels not in any template are ignored
+        event_matrix = self._event_counts.astype(self._dtype)
         
-        def calc_eucl_dist(template: PsthDict, new=False):
-            # combined list of counts for all channels
-            event_counts: list[float] = []
-            template_counts: list[float] = []
-            
-            for chan, template_psth in template.items():
-                template_counts.extend(template_psth)
-                try:
-                    chan_psth = event_psths[chan]
-                except KeyError:
-                    event_counts.extend([0]*len(template_psth))
-                else:
-                    event_counts.extend(chan_psth)
-                
-                assert len(event_counts) == len(template_counts)
-            
-            dist = calc_chan_eucl_dist(event_counts, template_counts)
-            
-            return dist
+        # distance over the channels in each template, a template channel without
+        # event spikes is compared against zeros
+        diff = self._template_matrix - event_matrix
+        chan_dists = np.einsum('tcb,tcb->tc', diff, diff)
+        dist_array = np.sqrt((chan_dists * self._template_mask).sum(axis=1))
         
-        dists = {
-            event_type: calc_eucl_dist(template_psth, new=True)
-            for event_type, template_psth in self.templates.items()
-        }
+        dists = dict(zip(self._template_types, dist_array.tolist()))
         
         debug_info['dists'] = dists
         debug_info['templates'] = self.templates
         debug_info['event'] = event_psths
         
         assert dists
-        closest_event_type, _ = min(dists.items(), key=lambda x: x[1])
+        closest_event_type = self._template_types[int(np.argmin(dist_array))]
         
         return closest_event_type, debug_info
 
-def _build_templates_from_psths(
-    psths: Dict[str, List[EuclClassifier]],
-    builder: EuclClassifier,
-):
-    def average_psths(psths: List[List[int]]) -> List[int]:
-        acc = builder.zero_psth()
+_B85_ALPHABET = b"0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz!#$%&()*+-;<=>?@^_`{|}~"
+# ascii code -> base85 digit, 255 for characters not in the alphabet
+_B85_DIGITS = np.full(256, 255, dtype=np.uint8)
+_B85_DIGITS[np.frombuffer(_B85_ALPHABET, dtype=np.uint8)] = np.arange(85)
+
+def _b85decode_doubles(encoded: str) -> np.ndarray:
+    """decodes base85 encoded little endian doubles, the same as b85decode without the per character python loop
+    
+    doubles are a multiple of 4 bytes so there is no padding and the encodings of
+    several arrays can be concatenated and decoded at once
+    """
+    chars = np.frombuffer(encoded.encode('ascii'), dtype=np.uint8)
+    if len(chars) % 10 != 0:
+        raise ValueError("base85 data is not a whole number of doubles")
+    digits = _B85_DIGITS[chars].reshape(-1, 5).astype(np.uint64)
+    if (digits == 255).any():
+        raise ValueError("bad base85 character")
+    words = digits[:, 0]
+    for i in range(1, 5):
+        words = words * 85 + digits[:, i]
+    if (words > 0xffffffff).any():
+        raise ValueError("base85 overflow")
+    # each group of 5 characters is one big endian 32 bit word
+    return words.astype('>u4').view('<f8')
+
+# seconds spike records can be out of order in an events file, the same as the deque
+# based template builder allowed
+SPIKE_ORDER_SLACK = 0.5
+
+class _PsthAccumulator:
+    """sums of the psths of events and of their squares, by event type
+    
+    spikes are added in batches in time order, each event's psth is added to the sums
+    once it's past the end of the event's window. spikes in a batch can be up to
+    SPIKE_ORDER_SLACK seconds earlier than the latest spike of previous batches, later
+    spikes are dropped
+    """
+    
+    def __init__(self, *,
+        event_times: np.ndarray, event_types: np.ndarray, types_n: int,
+        post_time: float, bin_size: float,
+    ):
+        """
+            Args:
+                event_times: sorted event timestamps in seconds
+                event_types: index of the type of each event
+                post_time: in seconds
+                bin_size: in seconds
+            """
+        self._event_times = event_times
+        self._event_types = event_types
+        self._bin_size = bin_size
+        self._bins_n = round(post_time / bin_size)
+        # spikes further than this after an event can't be in its psth, the extra bin
+        # covers rounding of the bin calculation at the end of the window
+        self._window = (self._bins_n + 1) * bin_size
         
-        for psth in psths:
-            assert len(psth) == len(acc)
-            for i, x in enumerate(psth):
-                acc[i] += x
-        # return [(x / n, n) for x in acc]
-        return [x for x in acc]
+        self.chans_n = 0
+        # (event types, channels, bins)
+        self.sums = np.zeros((types_n, 0, self._bins_n), dtype=np.int64)
+        self.sq_sums = np.zeros((types_n, 0, self._bins_n), dtype=np.int64)
+        # (channels,) number of spikes of each channel
+        self.chan_spike_counts = np.zeros(0, dtype=np.int64)
+        # events before this index have been added to the sums
+        self._done_i = 0
+        # (events, channels, bins) psths of the events from _done_i that are still open
+        self._open = np.zeros((0, 0, self._bins_n), dtype=np.int64)
+        # latest spike timestamp added
+        self._latest = -np.inf
+        # spikes within SPIKE_ORDER_SLACK of the latest spike, not yet in the psths
+        self._held_ts = np.empty(0)
+        self._held_chans = np.empty(0, dtype=np.int64)
     
-    templates = {}
-    for event_class, events in psths.items():
-        # events is a list of classifiers, one for each event
-        chans = {}
-        chan_keys = set()
-        for classifier in events:
-            chan_keys |= classifier.get_keys()
+    def _add_chans(self, chans_n: int):
+        pad = ((0, 0), (0, chans_n - self.chans_n), (0, 0))
+        self.sums = np.pad(self.sums, pad)
+        self.sq_sums = np.pad(self.sq_sums, pad)
+        self._open = np.pad(self._open, pad)
+        self.chan_spike_counts = np.pad(self.chan_spike_counts, (0, chans_n - self.chans_n))
+        self.chans_n = chans_n
+    
+    def _close_events(self, end_i: int):
+        """adds the open events before end_i to the sums"""
+        n = end_i - self._done_i
+        if n <= 0:
+            return
+        self._extend_open(end_i)
+        counts = self._open[:n]
+        types = self._event_types[self._done_i:end_i]
+        np.add.at(self.sums, types, counts)
+        np.add.at(self.sq_sums, types, counts * counts)
+        self._open = self._open[n:]
+        self._done_i = end_i
+    
+    def _extend_open(self, end_i: int):
+        """adds zero psths so the events before end_i are open"""
+        extra = end_i - self._done_i - len(self._open)
+        if extra > 0:
+            self._open = np.concatenate([
+                self._open,
+                np.zeros((extra, self.chans_n, self._bins_n), dtype=np.int64),
+            ])
+    
+    def add_spikes(self, timestamps: np.ndarray, chans: np.ndarray, chans_n: int):
+        """
+            Args:
+                timestamps: spike timestamps in seconds, at most SPIKE_ORDER_SLACK seconds before
+                    the latest spike of a previous batch
+                chans: channel index of each spike
+                chans_n: number of channels seen so far
+            """
+        if chans_n > self.chans_n:
+            self._add_chans(chans_n)
+        if len(timestamps) == 0:
+            return
+        self.chan_spike_counts += np.bincount(chans, minlength=self.chans_n)
+        timestamps = np.concatenate([self._held_ts, timestamps])
+        chans = np.concatenate([self._held_chans, chans])
+        order = np.argsort(timestamps, kind='stable')
+        timestamps = timestamps[order]
+        chans = chans[order]
         
-        for chan_key in chan_keys:
-            chan_psths = [c.build_key_psth(chan_key) for c in events]
-            chans[chan_key] = average_psths(chan_psths)
+        # spikes within the slack of the latest spike are held back until the next batch
+        # in case earlier spikes are still to come
+        self._latest = max(self._latest, float(timestamps[-1]))
+        cutoff = self._latest - SPIKE_ORDER_SLACK
+        split = int(np.searchsorted(timestamps, cutoff, side='left'))
+        self._held_ts = timestamps[split:]
+        self._held_chans = chans[split:]
+        self._add_sorted(timestamps[:split], chans[:split])
         
-        templates[event_class] = {
-            'spike_counts': chans,
-            'event_count': len(events),
-        }
+        # later batches only have spikes at or after the cutoff
+        self._close_events(int(np.searchsorted(self._event_times, cutoff - self._window, side='left')))
     
-    return templates
+    def _add_sorted(self, timestamps: np.ndarray, chans: np.ndarray):
+        """adds sorted spikes to the psths of the open events"""
+        if len(timestamps) == 0:
+            return
+        # events that can have spikes in this batch
+        start_i = self._done_i
+        end_i = int(np.searchsorted(self._event_times, timestamps[-1], side='left'))
+        self._extend_open(end_i)
+        event_times = self._event_times[start_i:end_i]
+        
+        # spikes at the same time as the event are not counted
+        lo = np.searchsorted(timestamps, event_times, side='right')
+        hi = np.searchsorted(timestamps, event_times + self._window, side='right')
+        spike_counts = hi - lo
+        total = int(spike_counts.sum())
+        if total:
+            # (event, spike) pairs of every spike in each event's window
+            pair_events = np.repeat(np.arange(len(event_times)), spike_counts)
+            starts = np.cumsum(spike_counts) - spike_counts
+            pair_spikes = np.arange(total) - np.repeat(starts - lo, spike_counts)
+            
+            bins = ((timestamps[pair_spikes] - event_times[pair_events]) / self._bin_size).astype(np.int64)
+            keep = bins < self._bins_n
+            flat = np.ravel_multi_index(
+                (pair_events[keep], chans[pair_spikes[keep]], bins[keep]),
+                (len(event_times), self.chans_n, self._bins_n),
+            )
+            counts = np.bincount(flat, minlength=len(event_times) * self.chans_n * self._bins_n)
+            self._open[:len(event_times)] += counts.reshape(len(event_times), self.chans_n, self._bins_n)
+    
+    def finish(self) -> np.ndarray:
+        """adds the remaining events to the sums, returns the number of events of each type"""
+        self._add_sorted(self._held_ts, self._held_chans)
+        self._held_ts = np.empty(0)
+        self._held_chans = np.empty(0, dtype=np.int64)
+        self._close_events(len(self._event_times))
+        return np.bincount(self._event_types, minlength=len(self.sums))
+
+def _map_channel_name(k: str) -> str:
+    channel, unit = k.split('_')
+    return f"{channel:0>4}_{unit:0>4}"
+
+def _labels_chan_filter(labels: Optional[Dict[str, List[int]]]) -> set[str] | None:
+    if labels is None:
+        return None
+    chan_filter = set()
+    for channel, units in labels.items():
+        if units is None:
+            chan_filter.add(channel)
+            continue
+        for unit in units:
+            chan_filter.add(f"{channel:0>4}_{unit:0>4}")
+    return chan_filter
+
+class _SpikeDecoder:
+    """decodes the spikes records of an events file into arrays of timestamps and channel indexes
+    
+    the encoded timestamps of records are collected until there are batch_size channel
+    entries and then decoded at once, unsorted units are excluded
+    """
+    
+    def __init__(self, *, chan_filter: set[str] | None, batch_size: int = 2**18):
+        self._chan_filter = chan_filter
+        self.batch_size = batch_size
+        # channel names by index
+        self.chan_names: List[str] = []
+        self._chan_name_indexes: Dict[str, int] = {}
+        # raw channel name in the events file -> channel index, -1 if it's excluded
+        self._chan_indexes: Dict[str, int] = {}
+        self._encoded: List[str] = []
+        self._raw_chans: List[str] = []
+    
+    def _add_chan(self, raw_chan: str):
+        chan = _map_channel_name(raw_chan)
+        if self._chan_filter is not None and chan not in self._chan_filter:
+            index = -1
+        # remove unsorted spikes
+        elif chan.endswith('_0') or chan.endswith('_0000'):
+            index = -1
+        elif chan in self._chan_name_indexes:
+            index = self._chan_name_indexes[chan]
+        else:
+            index = len(self.chan_names)
+            self.chan_names.append(chan)
+            self._chan_name_indexes[chan] = index
+        self._chan_indexes[raw_chan] = index
+    
+    def add_record(self, rec: Dict[str, Any]) -> bool:
+        """returns True if a batch is ready to be decoded"""
+        if rec.get('type') != 'spikes':
+            return False
+        spikes = rec['s']
+        self._raw_chans.extend(spikes.keys())
+        self._encoded.extend(spikes.values())
+        return len(self._raw_chans) >= self.batch_size
+    
+    def decode(self) -> Tuple[np.ndarray, np.ndarray]:
+        """decodes the collected records, returns (timestamps, channel indexes) of their spikes"""
+        for raw_chan in set(self._raw_chans) - self._chan_indexes.keys():
+            self._add_chan(raw_chan)
+        chans = np.fromiter(map(self._chan_indexes.__getitem__, self._raw_chans), dtype=np.int64, count=len(self._raw_chans))
+        # 10 characters per timestamp
+        lens = np.fromiter(map(len, self._encoded), dtype=np.int64, count=len(self._encoded)) // 10
+        spike_ts = _b85decode_doubles(''.join(self._encoded))
+        spike_chans = np.repeat(chans, lens)
+        self._encoded.clear()
+        self._raw_chans.clear()
+        
+        keep = spike_chans >= 0
+        return spike_ts[keep], spike_chans[keep]
+
+def _event_accumulator(
+    ts_list: list[tuple[str, float]], post_time: int, bin_size: int,
+) -> Tuple[_PsthAccumulator, List[str]]:
+    """returns the accumulator for the events in ts_list and the names of the event types"""
+    ts_list.sort(key=lambda x: x[1])
+    event_type_names = sorted(set(event_type for event_type, _ in ts_list))
+    accumulator = _PsthAccumulator(
+        event_times = np.array([ts for _, ts in ts_list], dtype=np.float64),
+        event_types = np.array([event_type_names.index(et) for et, _ in ts_list], dtype=np.int64),
+        types_n = len(event_type_names),
+        post_time = post_time / 1000,
+        bin_size = bin_size / 1000,
+    )
+    return accumulator, event_type_names
+
+def read_events_file_spikes(
+    events_path: Path, *,
+    records: Optional[List[Dict[str, Any]]] = None,
+) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """reads all the spikes of sorted units in an events file
+        
+        Args:
+            records: if not None the records with a name are appended to it
+        
+        Returns:
+            (timestamps, channel indexes, channel names) sorted by timestamp
+        """
+    decoder = _SpikeDecoder(chan_filter=None)
+    spike_ts: List[np.ndarray] = []
+    spike_chans: List[np.ndarray] = []
+    def add_batch():
+        ts, chans = decoder.decode()
+        spike_ts.append(ts)
+        # channel indexes are small, halves the size of a cached session
+        spike_chans.append(chans.astype(np.int32))
+    
+    with EventReader(path=events_path) as reader:
+        for rec in reader.read_records():
+            if records is not None and rec.get('name') is not None:
+                records.append(rec)
+            if decoder.add_record(rec):
+                add_batch()
+    add_batch()
+    
+    timestamps = np.concatenate(spike_ts)
+    chans = np.concatenate(spike_chans)
+    order = np.argsort(timestamps, kind='stable')
+    return timestamps[order], chans[order], decoder.chan_names
+
+def build_templates_from_spikes(*,
+    ts_list: list[tuple[str, float]],
+    spike_ts: np.ndarray, spike_chans: np.ndarray, chan_names: List[str],
+    template_path: Optional[Path] = None,
+    event_class: Optional[str],
+    post_time: int, bin_size: int,
+    labels: Optional[Dict[str, List[int]]],
+):
+    """builds templates from the output of read_events_file_spikes
+        
+        gives the same result as build_templates_from_new_events_file, the spike arrays
+        can be memory mapped
+        """
+    chan_filter = _labels_chan_filter(labels)
+    accumulator, event_type_names = _event_accumulator(ts_list, post_time, bin_size)
+    
+    # index in chan_names -> index in the accumulator, -1 if excluded by the channel filter
+    out_chan_names = [
+        chan for chan in chan_names
+        if chan_filter is None or chan in chan_filter
+    ]
+    out_indexes = {chan: i for i, chan in enumerate(out_chan_names)}
+    chan_map = np.array([out_indexes.get(chan, -1) for chan in chan_names], dtype=np.int64)
+    
+    batch_size = 2**20
+    for start in range(0, len(spike_ts), batch_size):
+        chans = chan_map[spike_chans[start:start + batch_size]]
+        keep = chans >= 0
+        accumulator.add_spikes(
+            np.asarray(spike_ts[start:start + batch_size])[keep],
+            chans[keep],
+            len(out_chan_names),
+        )
+    accumulator.add_spikes(np.empty(0), np.empty(0, dtype=np.int64), len(out_chan_names))
+    
+    return _build_template_data(
+        accumulator = accumulator,
+        event_type_names = event_type_names,
+        chan_names = out_chan_names,
+        chan_filter = chan_filter,
+        template_path = template_path,
+        event_class = event_class,
+        post_time = post_time,
+        bin_size = bin_size,
+    )
 
 def build_templates_from_new_events_file(*,
     ts_list: list[tuple[str, float]],
@@ -194,110 +553,55 @@ def build_templates_from_new_events_file(*,
     post_time: int, bin_size: int,
     labels: Optional[Dict[str, List[int]]],
 ):
-    def map_channel_name(k):
-        channel, unit = k.split('_')
-        return f"{channel:0>4}_{unit:0>4}"
-    
-    if labels is None:
-        chan_filter: set[str] | None = None
-    else:
-        chan_filter = set()
-        if labels is not None:
-            for channel, units in labels.items():
-                if units is None:
-                    chan_filter.add(channel)
-                    continue
-                for unit in units:
-                    chan_filter.add(f"{channel:0>4}_{unit:0>4}")
-    
-    def get_spikes():
-        unpacker = Struct('<d')
-        with EventReader(path=events_path) as reader:
-            for rec in reader.read_records():
-                rt = rec.get('type')
-                if rt != 'spikes':
-                    continue
-                
-                def get_chunk_spikes():
-                    """get spikes for the next chunk and put the timestamps in order"""
-                    for chan, v in rec['s'].items():
-                        chan = map_channel_name(chan)
-                        if chan_filter is not None and chan not in chan_filter:
-                            continue
-                        # remove unsorted spikes
-                        if chan.endswith('_0') or chan.endswith('_0000'):
-                            continue
-                        for s in unpacker.iter_unpack(b85decode(v)):
-                            ts, = s
-                            # print(k, ts)
-                            yield chan, ts
-                
-                chunk_spikes = list(get_chunk_spikes())
-                chunk_spikes.sort(key=lambda x: x[1])
-                yield from chunk_spikes
+    chan_filter = _labels_chan_filter(labels)
+    accumulator, event_type_names = _event_accumulator(ts_list, post_time, bin_size)
     
-    ts_list.sort(key=lambda x: x[1])
-    def get_events():
-        """yields (type, timestamp, extra)"""
-        ts_i = 0
-        for spike in get_spikes():
-            # print(spike)
-            
-            while ts_i < len(ts_list) and ts_list[ts_i][1] < spike[1]:
-                yield ('e', ts_list[ts_i][1], ts_list[ts_i][0])
-                ts_i += 1
-            yield ('s', spike[1], spike[0])
-        
-        while ts_i < len(ts_list):
-            yield ('e', ts_list[ts_i][1], ts_list[ts_i][0])
-            ts_i += 1
+    # the spikes are streamed through the accumulator so the whole file is never in memory
+    decoder = _SpikeDecoder(chan_filter=chan_filter)
+    def add_batch():
+        ts, chans = decoder.decode()
+        accumulator.add_spikes(ts, chans, len(decoder.chan_names))
     
-    psths: Dict[str, List[EuclClassifier]] = {}
+    with EventReader(path=events_path) as reader:
+        for rec in reader.read_records():
+            if decoder.add_record(rec):
+                add_batch()
+    add_batch()
     
-    def build_psth(buf: 'deque[tuple[str, float, Any]]', event_ts: float) -> EuclClassifier:
-        builder = EuclClassifier(
-            post_time=post_time, bin_size=bin_size,
-            channel_filter = chan_filter,
-        )
-        # disable discarding of old spikes to ensure
-        # all spikes in buf are processed, even if the classifier
-        # would normally keep a window smaller than buf covers
-        builder._buffer_time = None
-        
-        builder.event(timestamp = event_ts)
-        
-        for t, ts, ch in buf:
-            if t != 's':
-                continue
-            builder.spike(ch, ts)
-        
-        return builder
-    
-    chan_list = set()
-    max_dist = post_time/1000*1.1 + 0.500
-    buf: 'deque[tuple[str, float, Any]]' = deque()
-    def pop_event():
-        event = buf.popleft()
-        if event[0] == 's':
-            chan_list.add(event[2])
-        if event[0] == 'e':
-            et = event[2]
-            psth = build_psth(buf, event[1])
-            if et not in psths:
-                psths[et] = []
-            psths[et].append(psth)
-    
-    for event in get_events():
-        buf.append(event)
-        while event[1] - buf[0][1] > max_dist:
-            pop_event()
-    while buf:
-        pop_event()
-    
-    templates = _build_templates_from_psths(
-        psths = psths,
-        builder = EuclClassifier(post_time=post_time, bin_size=bin_size),
+    return _build_template_data(
+        accumulator = accumulator,
+        event_type_names = event_type_names,
+        chan_names = decoder.chan_names,
+        chan_filter = chan_filter,
+        template_path = template_path,
+        event_class = event_class,
+        post_time = post_time,
+        bin_size = bin_size,
     )
+
+def _build_template_data(*,
+    accumulator: _PsthAccumulator,
+    event_type_names: List[str],
+    chan_names: List[str],
+    chan_filter: set[str] | None,
+    template_path: Optional[Path],
+    event_class: Optional[str],
+    post_time: int, bin_size: int,
+):
+    event_counts = accumulator.finish()
+    
+    # channels that had spikes
+    chan_is = np.flatnonzero(accumulator.chan_spike_counts)
+    out_chan_names = [chan_names[i] for i in chan_is]
+    templates = {}
+    for type_i, event_type in enumerate(event_type_names):
+        templates[event_type] = {
+            'spike_counts': dict(zip(out_chan_names, accumulator.sums[type_i, chan_is].tolist())),
+            # sums of the squared counts, used for the variance of each bin
+            'spike_sq_counts': dict(zip(out_chan_names, accumulator.sq_sums[type_i, chan_is].tolist())),
+            'event_count': int(event_counts[type_i]),
+        }
+    chan_list = set(out_chan_names)
     
     if chan_filter is not None:
         chan_list = chan_filter
@@ -308,11 +612,13 @@ def build_templates_from_new_events_file(*,
         # add zeros for channels in the channel filter but that had no spikes
         for chan in chan_list - template_chans:
             template['spike_counts'][chan] = builder.zero_psth()
+            template['spike_sq_counts'][chan] = builder.zero_psth()
         
         def key(x):
             a, b = x[0].split('_')
             return int(a), int(b)
         template['spike_counts'] = {k: v for k, v in sorted(template['spike_counts'].items(), key=key)}
+        template['spike_sq_counts'] = {k: v for k, v in sorted(template['spike_sq_counts'].items(), key=key)}
         
         if chan_filter is not None:
             assert set(template['spike_counts']) == chan_filter
@@ -1,12 +1,14 @@
 
 from os import PathLike
-from typing import Optional, Any, Dict
+from typing import Optional, Any, Dict, List, Set
 from pathlib import Path
 import json
 import time
 import logging
 from contextlib import ExitStack
 
+import numpy as np
+
 logger = logging.getLogger(__name__)
 
 from butil import EventFile
@@ -14,38 +16,84 @@ from butil import EventFile
 from ..classifier import Classifier
 from ..eucl_classifier import EuclClassifier, build_templates_from_new_events_file
 from ..random_classifier import RandomClassifier
+from ..metric_classifier import MetricClassifier
 
 from .events_file import EventsFileWriter
 
+def _template_chans(templates: Dict[str, Any]) -> Set[str]:
+    template_chans = set()
+    for _cue, template in templates['templates'].items():
+        for chan_str in template['spike_counts'].keys():
+            template_chans.add(chan_str)
+    return template_chans
+
+def template_spike_channels(templates: Dict[str, Any]) -> Optional[Dict[int, List[int]]]:
+    """returns { channel => [unit] } of the spikes used by the classifier created from templates
+        
+        None if the classifier doesn't use spikes, so they shouldn't be filtered
+        """
+    if templates['type'] not in ('eucl', 'cosine', 'poisson', 'mahalanobis'):
+        return None
+    out: Dict[int, List[int]] = {}
+    for chan_str in sorted(_template_chans(templates)):
+        chan, unit = chan_str.split('_')
+        out.setdefault(int(chan), []).append(int(unit))
+    return out
+
+def _prep_templates(templates: Dict[str, Any]):
+    """yields (cue, channel -> average psth) of each template"""
+    for cue, cue_templates in templates['templates'].items():
+        chans = list(cue_templates['spike_counts'])
+        counts = np.array([cue_templates['spike_counts'][chan] for chan in chans], dtype=float)
+        counts /= cue_templates['event_count']
+        yield cue, dict(zip(chans, counts.tolist()))
+
 def from_templates(templates: Dict[str, Any]) -> Classifier:
     ctype = templates['type']
     match ctype:
-        case 'eucl':
-            template_chans = set()
-            for _cue, template in templates['templates'].items():
-                for chan_str in template['spike_counts'].keys():
-                    template_chans.add(chan_str)
+        case 'eucl' if not templates.get('channel_weights', False):
+            template_chans = _template_chans(templates)
             
             classifier = EuclClassifier(
                 post_time = templates['post_time'],
                 bin_size = templates['bin_size'],
                 channel_filter = template_chans,
+                float32 = templates.get('float32', False),
             )
-            def prep_templates():
-                for cue, cue_templates in templates['templates'].items():
-                    n = cue_templates['event_count']
-                    def build_cue_template():
-                        for chan, counts in cue_templates['spike_counts'].items():
-                            yield chan, [x / n for x in counts]
-                    yield cue, dict(build_cue_template())
-            classifier.templates = dict(prep_templates())
+            # compiled into the classifier's template matrix
+            classifier.templates = dict(_prep_templates(templates))
+            
+            return classifier
+        case 'eucl' | 'cosine' | 'poisson' | 'mahalanobis':
+            template_chans = _template_chans(templates)
+            
+            classifier = MetricClassifier(
+                post_time = templates['post_time'],
+                bin_size = templates['bin_size'],
+                metric = ctype,
+                channel_filter = template_chans,
+                float32 = templates.get('float32', False),
+                shrinkage = templates.get('shrinkage', 0.1),
+            )
+            classifier.templates = dict(_prep_templates(templates))
+            
+            cue_templates = templates['templates']
+            # templates built before the squared counts were recorded use the poisson variance
+            if all('spike_sq_counts' in t for t in cue_templates.values()):
+                classifier.set_training_stats(
+                    sq_counts = {cue: t['spike_sq_counts'] for cue, t in cue_templates.items()},
+                    event_counts = {cue: t['event_count'] for cue, t in cue_templates.items()},
+                    learn_weights = templates.get('channel_weights', False),
+                )
+            elif templates.get('channel_weights', False):
+                logger.warning("templates have no spike_sq_counts, channel weights not learned")
             
             return classifier
         case 'random':
             assert isinstance(templates['event_types'], list)
             return RandomClassifier(templates['event_types'])
         case _:
-            raise ValueError("Unknown classifier type {ctype}")
+            raise ValueError(f"Unknown classifier type {ctype}")
 
 class Helper:
     def __init__(self, *,
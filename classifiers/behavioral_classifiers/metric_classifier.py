@@ -0,0 +1,188 @@
+from typing import Optional, Tuple, Dict, Any
+
+import numpy as np
+
+from .eucl_classifier import EuclClassifier, PsthDict
+
+METRICS = ['eucl', 'cosine', 'poisson', 'mahalanobis']
+
+# floor of the expected count of a bin, keeps log rates and variances finite for
+# bins that had no spikes in the training set
+_MIN_RATE = 1e-3
+
+class MetricClassifier(EuclClassifier):
+    """classifies events by their distance to templates using a selectable metric
+    
+    uses the same template matrix and event psths as EuclClassifier, every metric is
+    computed in one pass so the debug info has the distances of all of them
+    
+    metrics, lower is closer
+        eucl: euclidian distance
+        cosine: one minus the cosine similarity
+        poisson: negative poisson log likelihood of the event given the template rates
+        mahalanobis: euclidian distance scaled by the pooled variance of each bin, the
+            covariance is diagonal and shrunk towards the mean variance
+    """
+    
+    def __init__(self, *,
+        post_time: int, bin_size: int,
+        metric: str = 'eucl',
+        channel_filter: set[str] | None = None,
+        float32: bool = False,
+        shrinkage: float = 0.1,
+    ):
+        """
+            Args:
+                metric: one of METRICS, used to pick the event type
+                shrinkage: 0 to 1, weight of the mean variance in the mahalanobis covariance
+            """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}")
+        assert 0 <= shrinkage <= 1
+        self.metric: str = metric
+        self.shrinkage: float = shrinkage
+        # (channels,) weight of each template channel
+        self._chan_weights: np.ndarray = np.zeros(0)
+        # (channels, bins) pooled variance of each bin in the training set, None if
+        # the templates don't have it and the poisson variance is used
+        self._variance: Optional[np.ndarray] = None
+        super().__init__(
+            post_time = post_time,
+            bin_size = bin_size,
+            channel_filter = channel_filter,
+            float32 = float32,
+        )
+    
+    @EuclClassifier.templates.setter
+    def templates(self, templates: Dict[str, PsthDict]):
+        EuclClassifier.templates.fset(self, templates)
+        self._chan_weights = np.ones(len(self._template_chans), dtype=self._dtype)
+        self._variance = None
+        self._compile_metrics()
+    
+    def _compile_metrics(self):
+        """precomputes the parts of the metrics that only depend on the templates"""
+        rates = np.maximum(self._template_matrix, _MIN_RATE)
+        # (2, event types, channels, bins) templates and their log rates, so the dot products
+        # of the event with both are done in one pass
+        self._template_and_log_rates = np.stack([self._template_matrix, np.log(rates).astype(self._dtype)])
+        self._rate_sums = rates.sum(axis=2)
+        self._template_sq = np.einsum('tcb,tcb->tc', self._template_matrix, self._template_matrix)
+        
+        if self._variance is None:
+            # poisson variance, the mean rate of each bin across templates
+            variance = self._template_matrix.mean(axis=0) if len(self._template_types) else np.zeros((0, self._bins_n))
+        else:
+            variance = self._variance
+        variance = np.maximum(variance, _MIN_RATE)
+        mean_variance = variance.mean() if variance.size else 1
+        variance = (1 - self.shrinkage) * variance + self.shrinkage * mean_variance
+        self._inv_variance = (1 / variance).astype(self._dtype)
+        
+        # (event types, channels) weight of each channel in each template
+        self._template_weights = (self._template_mask * self._chan_weights).astype(self._dtype)
+    
+    def set_training_stats(self, *,
+        sq_counts: Dict[str, PsthDict],
+        event_counts: Dict[str, int],
+        learn_weights: bool = False,
+    ):
+        """sets the variance of the templates from the training set
+            
+            must be called after the templates are set
+            
+            Args:
+                sq_counts: event_type -> channel -> sum of the squared counts of each bin over the training events
+                event_counts: event_type -> number of training events
+                learn_weights: weight each channel by how well it separates the event types
+            """
+        chan_n = len(self._template_chans)
+        # sum of squared deviations from the template of each bin, pooled over event types
+        sq_dev = np.zeros((chan_n, self._bins_n))
+        dof = 0
+        for type_i, event_type in enumerate(self._template_types):
+            n = event_counts[event_type]
+            means = self._template_matrix[type_i].astype(np.float64)
+            type_sq = np.zeros((chan_n, self._bins_n))
+            for chan, chan_sq in sq_counts[event_type].items():
+                chan_i = self._template_chans.get(chan)
+                if chan_i is not None:
+                    type_sq[chan_i] = chan_sq
+            sq_dev += type_sq - n * means * means
+            dof += n - 1
+        
+        if dof > 0:
+            self._variance = np.maximum(sq_dev / dof, 0)
+        else:
+            self._variance = None
+        
+        if learn_weights:
+            self._chan_weights = self._learn_weights()
+        else:
+            self._chan_weights = np.ones(chan_n, dtype=self._dtype)
+        self._compile_metrics()
+    
+    def _learn_weights(self) -> np.ndarray:
+        """fisher ratio of each channel, the variance of the template means between event types
+            over the variance within them, normalized to a mean of 1
+            """
+        chan_n = len(self._template_chans)
+        if len(self._template_types) < 2 or self._variance is None:
+            return np.ones(chan_n, dtype=self._dtype)
+        
+        between = self._template_matrix.astype(np.float64).var(axis=0).mean(axis=1)
+        within = np.maximum(self._variance, _MIN_RATE).mean(axis=1)
+        weights = between / within
+        if weights.sum() == 0:
+            return np.ones(chan_n, dtype=self._dtype)
+        return (weights / weights.mean()).astype(self._dtype)
+    
+    def metric_distances(self) -> Dict[str, np.ndarray]:
+        """metric -> (event types,) distance of the current event to each template"""
+        event_matrix = self._event_counts.astype(self._dtype)
+        weights = self._template_weights
+        
+        diff = self._template_matrix - event_matrix
+        diff *= diff
+        chan_sq = diff.sum(axis=2)
+        chan_maha = np.einsum('tcb,cb->tc', diff, self._inv_variance)
+        
+        chan_dot, chan_log_rate_dot = np.einsum('stcb,cb->stc', self._template_and_log_rates, event_matrix)
+        
+        # cosine over the weighted channels of each template
+        chan_event_sq = np.einsum('cb,cb->c', event_matrix, event_matrix)
+        dot = (chan_dot * weights).sum(axis=1)
+        norms = np.sqrt((self._template_sq * weights).sum(axis=1) * (weights * chan_event_sq).sum(axis=1))
+        cos_sim = np.divide(dot, norms, out=np.zeros_like(dot), where=norms > 0)
+        
+        # log(x!) is the same for every template and is left out
+        chan_log_likelihood = chan_log_rate_dot - self._rate_sums
+        
+        return {
+            'eucl': np.sqrt((chan_sq * weights).sum(axis=1)),
+            'cosine': 1 - cos_sim,
+            'poisson': -(chan_log_likelihood * weights).sum(axis=1),
+            'mahalanobis': np.sqrt((chan_maha * weights).sum(axis=1)),
+        }
+    
+    def classify_debug_info(self) -> Tuple[str, Any]:
+        debug_info = {}
+        all_dists = self.metric_distances()
+        dist_array = all_dists[self.metric]
+        
+        dists = dict(zip(self._template_types, dist_array.tolist()))
+        
+        debug_info['metric'] = self.metric
+        debug_info['dists'] = dists
+        debug_info['metric_dists'] = {
+            metric: dict(zip(self._template_types, metric_dists.tolist()))
+            for metric, metric_dists in all_dists.items()
+        }
+        debug_info['channel_weights'] = dict(zip(self._template_chans, self._chan_weights.tolist()))
+        debug_info['templates'] = self.templates
+        debug_info['event'] = self.build_per_key_psth()
+        
+        assert dists
+        closest_event_type = self._template_types[int(np.argmin(dist_array))]
+        
+        return closest_event_type, debug_info
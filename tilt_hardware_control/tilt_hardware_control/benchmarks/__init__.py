@@ -0,0 +1,41 @@
+"""benchmarks for the recording and live view hot paths
+
+runs headless against `grf_sim.SimulatedDaq` so no hardware is needed, run from
+the tilt_hardware_control directory with
+    
+    python -m benchmarks [--quick] [--only record,ring] [--out results.json]
+
+results are printed as json, see each benchmark module for the reported values
+"""
+
+from typing import List, Dict, Any, Callable
+import platform
+import sys
+import time
+
+import numpy as np
+
+from benchmarks import bench_record, bench_ring, bench_live_view, bench_writer
+
+BENCHMARKS: Dict[str, Callable[..., Dict[str, Any]]] = {
+    'record': bench_record.run,
+    'ring': bench_ring.run,
+    'live_view': bench_live_view.run,
+    'writer': bench_writer.run,
+}
+
+def run_all(names: List[str], *, quick: bool) -> Dict[str, Any]:
+    results = {}
+    for name in names:
+        print(f"running {name}", file=sys.stderr)
+        results[name] = BENCHMARKS[name](quick=quick)
+    
+    return {
+        'time': time.time(),
+        'quick': quick,
+        'python': sys.version,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'results': results,
+    }
@@ -0,0 +1,36 @@
+
+import argparse
+import json
+import sys
+
+from benchmarks import BENCHMARKS, run_all
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the recording and live view hot paths')
+    parser.add_argument('--quick', action='store_true',
+        help='shorter runs with fewer sizes')
+    parser.add_argument('--only',
+        help=f"comma separated benchmarks to run ({','.join(BENCHMARKS)})")
+    parser.add_argument('--out',
+        help='path to write the json results to in addition to stdout')
+    args = parser.parse_args()
+    
+    if args.only is not None:
+        names = args.only.split(',')
+        for name in names:
+            if name not in BENCHMARKS:
+                parser.error(f"unknown benchmark {name}")
+    else:
+        names = list(BENCHMARKS)
+    
+    results = run_all(names, quick=args.quick)
+    
+    out = json.dumps(results, indent=2)
+    if args.out is not None:
+        with open(args.out, 'w', encoding='utf8') as f:
+            f.write(out)
+            f.write('\n')
+    sys.stdout.write(out + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""live view frame time without rendering
+
+measures the work `_live_view` does for each frame before handing data to pyqtgraph,
+reading the latest samples from the ring and downsampling them into the envelope
+    frame_ms: average time per frame
+    max_fps: frames per second the data path could sustain
+"""
+
+from typing import Dict, Any
+import time
+
+import numpy as np
+
+from grf_data import HEADERS, DOWNSAMPLE_MODES, _decimate
+from util_multiprocess import AnalogRing
+
+def run(*, quick: bool) -> Dict[str, Any]:
+    frames = 20 if quick else 200
+    channels = [h['analog_channel'] for h in HEADERS if 'analog_channel' in h]
+    modes = np.array([
+        DOWNSAMPLE_MODES.index(h.get('downsample_mode', 'minmax'))
+        for h in HEADERS if 'analog_channel' in h
+    ])
+    
+    results = []
+    for clock_rate in [1000, 10000, 40000]:
+        for seconds in [5, 30]:
+            window = clock_rate * seconds
+            ring = AnalogRing(channels=channels, max_len=window)
+            try:
+                ring.write_block(np.random.default_rng(0).normal(size=(len(channels), window)))
+                # same settings as record_data uses for the live view
+                downsample_to = 100
+                factor = clock_rate // downsample_to
+                envelope = np.zeros((len(channels), downsample_to * seconds * 2))
+                
+                start = time.perf_counter()
+                for _ in range(frames):
+                    write_count, latest = ring.read_latest(window + factor)
+                    _decimate(latest[:, :latest.shape[1] - write_count % factor], factor, modes, envelope)
+                elapsed = time.perf_counter() - start
+            finally:
+                ring.close()
+            
+            results.append({
+                'clock_rate': clock_rate,
+                'seconds': seconds,
+                'frame_ms': elapsed / frames * 1000,
+                'max_fps': frames / elapsed,
+            })
+    
+    return {
+        'channels': len(channels),
+        'frames': results,
+    }
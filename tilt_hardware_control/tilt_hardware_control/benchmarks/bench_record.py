@@ -0,0 +1,74 @@
+"""record_data throughput
+
+max_throughput: record_data with the simulated daq not paced by a clock so it runs as
+fast as possible, for each output format
+    samples_per_sec: samples per second through the whole record loop
+    cpu_us_per_sample: cpu time of the record process per sample, the writer
+        process is not included
+
+sustained: record_data at real clock rates with the telemetry summary of the run,
+a backlog_max_fraction near 1 means the nidaq buffer nearly overflowed
+"""
+
+from typing import Dict, Any
+from pathlib import Path
+import tempfile
+import time
+
+from grf_data import record_data, RecordState
+
+def _record(*, clock_rate: int, seconds: float, csv_path, mock_options) -> Dict[str, Any]:
+    state = RecordState()
+    num_samples = int(clock_rate * seconds)
+    
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    record_data(
+        clock_rate = clock_rate,
+        csv_path = csv_path,
+        state = state,
+        mock = True,
+        num_samples = num_samples,
+        mock_options = mock_options,
+    )
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    
+    return {
+        'clock_rate': clock_rate,
+        'samples': num_samples,
+        'wall_time': wall,
+        'samples_per_sec': num_samples / wall,
+        'cpu_us_per_sample': cpu / num_samples * 1e6,
+        'telemetry': state.telemetry.summary(),
+    }
+
+def run(*, quick: bool) -> Dict[str, Any]:
+    seconds = 1 if quick else 5
+    clock_rates = [1000, 40000] if quick else [1000, 10000, 20000, 40000]
+    
+    max_throughput = {}
+    sustained = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, suffix in [('none', None), ('csv', '.csv'), ('binary', '.grfb')]:
+            path = Path(tmp_dir) / f"max{suffix}" if suffix is not None else None
+            max_throughput[name] = _record(
+                clock_rate = 40000,
+                seconds = seconds,
+                csv_path = path,
+                # 10ms batches
+                mock_options = {'realtime': False, 'batch_size': 400, 'seed': 0},
+            )
+        
+        for clock_rate in clock_rates:
+            sustained.append(_record(
+                clock_rate = clock_rate,
+                seconds = seconds,
+                csv_path = Path(tmp_dir) / f"sustained_{clock_rate}.grfb",
+                mock_options = {'seed': 0},
+            ))
+    
+    return {
+        'max_throughput': max_throughput,
+        'sustained': sustained,
+    }
@@ -0,0 +1,57 @@
+"""AnalogRing write and read throughput with the live view channel count
+
+write: `write_block` for different batch sizes
+    samples_per_sec: samples per channel written per second
+read: `read_latest` and `copy_latest` of a live view window
+    reads_per_sec: reads per second
+"""
+
+from typing import Dict, Any
+import time
+
+import numpy as np
+
+from grf_data import HEADERS
+from util_multiprocess import AnalogRing
+
+def _timed(func, min_time: float) -> float:
+    """calls func until min_time has passed, returns calls per second"""
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return calls / elapsed
+
+def run(*, quick: bool) -> Dict[str, Any]:
+    min_time = 0.2 if quick else 1
+    channels = [h['analog_channel'] for h in HEADERS if 'analog_channel' in h]
+    ring = AnalogRing(channels=channels, max_len=40000 * 5)
+    try:
+        write = []
+        for batch_size in [1, 10, 100, 1000, 10000]:
+            block = np.random.default_rng(0).normal(size=(len(channels), batch_size))
+            rate = _timed(lambda: ring.write_block(block), min_time)
+            write.append({
+                'batch_size': batch_size,
+                'samples_per_sec': rate * batch_size,
+            })
+        
+        read = []
+        out = np.empty((len(channels), ring.max_len))
+        for window in [1000, 10000, 40000 * 5]:
+            read.append({
+                'window': window,
+                'read_latest_per_sec': _timed(lambda: ring.read_latest(window), min_time),
+                'copy_latest_per_sec': _timed(lambda: ring.copy_latest(window, out), min_time),
+            })
+    finally:
+        ring.close()
+    
+    return {
+        'channels': len(channels),
+        'write': write,
+        'read': read,
+    }
@@ -0,0 +1,58 @@
+"""csv and binary writer throughput in the current process
+
+for each format and batch size
+    samples_per_sec: samples written per second
+    bytes_per_sample: size of the output file per sample
+"""
+
+from typing import Dict, Any
+from pathlib import Path
+import tempfile
+import time
+
+import numpy as np
+
+from grf_data import HEADERS
+from grf_output import open_writer
+
+def run(*, quick: bool) -> Dict[str, Any]:
+    num_samples = 20000 if quick else 200000
+    channels = [
+        {
+            'type': 'analog' if 'nidaq' in h else 'digital',
+            'header': h['csv'],
+        }
+        for h in HEADERS if 'csv' in h
+    ]
+    num_analog = len([c for c in channels if c['type'] == 'analog'])
+    num_digital = len(channels) - num_analog
+    
+    rng = np.random.default_rng(0)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for suffix in ['.csv', '.grfb']:
+            for batch_size in [1, 100, 1000]:
+                analog = rng.normal(size=(num_analog, batch_size))
+                digital = rng.integers(0, 2, size=(num_digital, batch_size), dtype=np.uint8)
+                path = Path(tmp_dir) / f"out_{batch_size}{suffix}"
+                
+                # fewer samples for single sample batches so the run doesn't take too long
+                n = num_samples // 10 if batch_size == 1 else num_samples
+                start = time.perf_counter()
+                with open_writer(path, channels=channels, clock_rate=10000) as writer:
+                    for sample_i in range(0, n, batch_size):
+                        writer.write_block(analog, digital, sample_i)
+                elapsed = time.perf_counter() - start
+                
+                results.append({
+                    'format': suffix[1:],
+                    'batch_size': batch_size,
+                    'samples': n,
+                    'samples_per_sec': n / elapsed,
+                    'bytes_per_sample': path.stat().st_size / n,
+                })
+    
+    return {
+        'channels': len(channels),
+        'formats': results,
+    }
@@ -1,28 +1,216 @@
-
 from typing import Union, List, Tuple, Dict, Any, Optional
 from abc import ABC, abstractmethod
 import time
 from pathlib import Path
+import multiprocessing
+
+import numpy as np
+
+from util_multiprocess import EventRing, spawn_process
+
+# default time in seconds next_batch waits for new data
+DEFAULT_WAIT = 0.005
+# default time limit in seconds for draining the backlog of a source
+DRAIN_TIMEOUT = 0.5
+# time in seconds the ProcessSource process waits for new data before checking if it should stop
+PROCESS_WAIT = 0.05
 
 class Event(ABC):
+    __slots__ = ()
+    
     @property
     @abstractmethod
     def timestamp(self):
         raise NotImplementedError()
 
+class EventBatch:
+    """events from a source as parallel arrays, one element per event
+    
+    kind: one of the kind constants below
+    channel, unit: plexon channel and unit, for tilt events unit is the tilt type
+    timestamp: plexon timestamp in seconds
+    """
+    SPIKE = 0
+    TILT = 1
+    STIM = 2
+    UNKNOWN = 3
+    
+    def __init__(self, *, kind, channel, unit, timestamp):
+        self.kind: np.ndarray = np.asarray(kind, dtype=np.uint8)
+        self.channel: np.ndarray = np.asarray(channel, dtype=np.uint16)
+        self.unit: np.ndarray = np.asarray(unit, dtype=np.uint16)
+        self.timestamp: np.ndarray = np.asarray(timestamp, dtype=np.float64)
+    
+    @classmethod
+    def empty(cls) -> 'EventBatch':
+        return cls(kind=[], channel=[], unit=[], timestamp=[])
+    
+    @classmethod
+    def concat(cls, batches: List['EventBatch']) -> 'EventBatch':
+        if not batches:
+            return cls.empty()
+        return cls(
+            kind = np.concatenate([b.kind for b in batches]),
+            channel = np.concatenate([b.channel for b in batches]),
+            unit = np.concatenate([b.unit for b in batches]),
+            timestamp = np.concatenate([b.timestamp for b in batches]),
+        )
+    
+    def __len__(self) -> int:
+        return len(self.kind)
+    
+    def __getitem__(self, key) -> 'EventBatch':
+        """select events with a slice, boolean mask or index array"""
+        return EventBatch(
+            kind = self.kind[key],
+            channel = self.channel[key],
+            unit = self.unit[key],
+            timestamp = self.timestamp[key],
+        )
+    
+    def events(self) -> List[Event]:
+        """converts the batch to a list of event records"""
+        out: List[Event] = []
+        columns = zip(self.kind.tolist(), self.channel.tolist(), self.unit.tolist(), self.timestamp.tolist())
+        for kind, chan, unit, ts in columns:
+            if kind == self.SPIKE:
+                out.append(SpikeEvent(channel=chan, unit=unit, timestamp=ts))
+            elif kind == self.TILT:
+                out.append(TiltEvent(tilt_type=unit, timestamp=ts))
+            elif kind == self.STIM:
+                out.append(StimEvent(timestamp=ts))
+            else:
+                out.append(UnknownEvent(channel=chan, unit=unit, timestamp=ts))
+        
+        return out
+
+class DeliveryStats:
+    """time from a source noticing new data to the batch being returned to the caller"""
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.batches: int = 0
+        self.events: int = 0
+        self.latency_sum: float = 0
+        self.latency_max: float = 0
+        # events lost before they could be delivered
+        self.lost: int = 0
+    
+    def add(self, wake_time: float, num_events: int):
+        """
+            Args:
+                wake_time: time.perf_counter() when the source noticed the data
+            """
+        latency = time.perf_counter() - wake_time
+        self.batches += 1
+        self.events += num_events
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+    
+    def add_lost(self, num_events: int):
+        self.lost += num_events
+    
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'batches': self.batches,
+            'events': self.events,
+            'lost': self.lost,
+            'latency_mean': self.latency_sum / self.batches if self.batches else None,
+            'latency_max': self.latency_max if self.batches else None,
+        }
+
 class Source(ABC):
-    @abstractmethod
-    def next_event(self) -> Optional[Event]:
-        raise NotImplementedError()
+    def __init__(self):
+        # batch partially consumed by next_event
+        self._pending: EventBatch = EventBatch.empty()
+        self._pending_i: int = 0
+        self.delivery_stats: DeliveryStats = DeliveryStats()
     
     @abstractmethod
-    def clear(self) -> List[Event]:
+    def _fetch_batch(self, timeout: float) -> EventBatch:
+        """gets the events received since the last fetch
+            
+            Args:
+                timeout: maximum time in seconds to wait for new data if none is available
+            """
         raise NotImplementedError()
     
+    def _take_pending(self) -> EventBatch:
+        """returns the events not yet consumed by next_event and discards them from the source"""
+        batch = self._pending[self._pending_i:]
+        self._pending = EventBatch.empty()
+        self._pending_i = 0
+        return batch
+    
+    def next_batch(self, *, timeout: float = DEFAULT_WAIT) -> EventBatch:
+        """returns all available events, waits up to timeout seconds for new data if none
+        is available and returns an empty batch if none arrives"""
+        if self._pending_i < len(self._pending):
+            return self._take_pending()
+        
+        return self._fetch_batch(max(timeout, 0))
+    
+    def next_event(self) -> Optional[Event]:
+        """returns a single event record, use next_batch where per event overhead matters"""
+        if self._pending_i >= len(self._pending):
+            self._pending = self._fetch_batch(DEFAULT_WAIT)
+            self._pending_i = 0
+        
+        if self._pending_i >= len(self._pending):
+            return None
+        
+        evt, = self._pending[self._pending_i:self._pending_i+1].events()
+        self._pending_i += 1
+        return evt
+    
+    def _backlog_remaining(self) -> bool:
+        """true if the last fetch filled the client buffer so more data may be waiting"""
+        return False
+    
+    def _drain_summary(self, batch: EventBatch, *, fetches: int, start: float, complete: bool) -> Dict[str, Any]:
+        return {
+            'events': len(batch),
+            'spikes': int(np.count_nonzero(batch.kind == EventBatch.SPIKE)),
+            'fetches': fetches,
+            'duration': time.perf_counter() - start,
+            'complete': complete,
+        }
+    
+    def drain(self, *, timeout: float = DRAIN_TIMEOUT) -> Tuple[EventBatch, Dict[str, Any]]:
+        """removes all events waiting at the source without waiting for new data
+            
+            stops after timeout seconds even if the backlog is not empty
+            
+            Returns:
+                the drained events and a summary with the event counts, number of
+                fetches, duration and whether the backlog was fully drained
+            """
+        start = time.perf_counter()
+        deadline = start + timeout
+        batches = [self._take_pending()]
+        fetches = 0
+        while True:
+            batches.append(self._fetch_batch(0))
+            fetches += 1
+            complete = not self._backlog_remaining()
+            if complete or time.perf_counter() >= deadline:
+                break
+        
+        batch = EventBatch.concat(batches)
+        return batch, self._drain_summary(batch, fetches=fetches, start=start, complete=complete)
+    
+    def clear(self) -> EventBatch:
+        """discards pending events, returns the discarded events"""
+        batch, _ = self.drain()
+        return batch
+    
     def close(self):
         raise NotImplementedError()
 
 class SpikeEvent(Event):
+    __slots__ = ('channel', 'unit', '_timestamp')
+    
     channel: int
     unit: int
     
@@ -36,6 +224,8 @@ class SpikeEvent(Event):
         return self._timestamp
 
 class TiltEvent(Event):
+    __slots__ = ('tilt_type', '_timestamp')
+    
     tilt_type: int
     
     def __init__(self, *, tilt_type, timestamp):
@@ -47,6 +237,8 @@ class TiltEvent(Event):
         return self._timestamp
 
 class StimEvent(Event):
+    __slots__ = ('_timestamp',)
+    
     def __init__(self, *, timestamp):
         self._timestamp = timestamp
     
@@ -55,6 +247,8 @@ class StimEvent(Event):
         return self._timestamp
 
 class UnknownEvent(Event):
+    __slots__ = ('channel', 'unit', '_timestamp')
+    
     channel: int
     unit: int
     
@@ -69,6 +263,7 @@ class UnknownEvent(Event):
 
 class MockSource(Source):
     def __init__(self, channel: int, unit: int):
+        super().__init__()
         self.PL_SingleWFType = 0
         self.PL_ExtEventType = 1
         
@@ -77,40 +272,79 @@ class MockSource(Source):
         
         self.step = 'pending'
     
-    def next_event(self):
-        # note: pyplexclientts waits 50ms, pyopxclient should wait 5ms
-        time.sleep(0.005) # wait 5ms to maybe mimick plexon
+    def _fetch_batch(self, timeout):
+        # note: pyplexclientts waits 50ms
+        time.sleep(min(timeout, 0.005)) # wait up to 5ms to maybe mimick plexon
+        wake_time = time.perf_counter()
         if self.step == 'pending':
-            evt = TiltEvent(
-                tilt_type = self.unit,
-                timestamp = time.perf_counter(),
-            )
-            
             self.step = 'tilting'
-            return evt
+            batch = EventBatch(
+                kind = [EventBatch.TILT],
+                channel = [0],
+                unit = [self.unit],
+                timestamp = [time.perf_counter()],
+            )
         elif self.step == 'tilting':
-            evt = SpikeEvent(
-                channel = self.channel,
-                unit = self.unit,
-                timestamp = time.perf_counter(),
+            batch = EventBatch(
+                kind = [EventBatch.SPIKE],
+                channel = [self.channel],
+                unit = [self.unit],
+                timestamp = [time.perf_counter()],
             )
-            
-            return evt
         else:
             assert False
+        
+        self.delivery_stats.add(wake_time, len(batch))
+        return batch
     
-    def clear(self):
+    def drain(self, *, timeout: float = DRAIN_TIMEOUT):
+        start = time.perf_counter()
         self.step = 'pending'
-        return []
+        batch = self._take_pending()
+        return batch, self._drain_summary(batch, fetches=0, start=start, complete=True)
     
     def close(self):
         pass
 
 class OpxSource(Source):
-    def __init__(self):
-        from pyopxclient import PyOPXClientAPI, OPX_ERROR_NOERROR, SPIKE_TYPE, CONTINUOUS_TYPE, EVENT_TYPE, OTHER_TYPE
+    # plexon event channel -> tilt type
+    TILT_CHANNELS = {
+        25: 1,
+        22: 3,
+        24: 2,
+        21: 4,
+    }
+    STIM_CHANNEL = 20
+    
+    def __init__(self, *,
+            timestamps_only: bool = False,
+            channels: Optional[Dict[int, List[int]]] = None,
+        ):
+        """
+            Args:
+                timestamps_only: exclude continuous sources at the server and poll
+                    timestamps without waveforms
+                channels: { channel => [unit] } of the spikes to keep, None or empty keeps all
+                    spikes. continuous and other sources are excluded at the server, the server
+                    can only exclude whole sources so the other spikes are still transferred and
+                    are dropped when read
+            """
+        super().__init__()
+        if not channels:
+            channels = None
+        from pyopxclient import PyOPXClientAPI, OPX_ERROR_NOERROR, OPX_ERROR_TIMEOUT, SPIKE_TYPE, CONTINUOUS_TYPE, EVENT_TYPE, OTHER_TYPE
         self.SPIKE_TYPE = SPIKE_TYPE
         self.EVENT_TYPE = EVENT_TYPE
+        self._OPX_ERROR_TIMEOUT = OPX_ERROR_TIMEOUT
+        self._timestamps_only = timestamps_only
+        # (channel << 16 | unit) of the spikes to keep, None keeps all spikes
+        self._spike_units: Optional[np.ndarray] = None
+        if channels is not None:
+            self._spike_units = np.array([
+                chan << 16 | unit
+                for chan, units in channels.items()
+                for unit in units
+            ], dtype=np.uint32)
         
         dll_path = Path(__file__).parent / 'bin'
         self._opx_client = PyOPXClientAPI(opxclient_dll_path=str(dll_path))
@@ -119,13 +353,19 @@ class OpxSource(Source):
             msg = "Client isn't connected. Error code: {}".format(self._opx_client.last_result)
             raise RuntimeError(msg)
         
-        self._opx_config = self._get_opx_config()
+        if timestamps_only or channels is not None:
+            self._opx_client.exclude_source_type(CONTINUOUS_TYPE)
+        if channels is not None:
+            self._opx_client.exclude_source_type(OTHER_TYPE)
+        
+        self._opx_config = self._get_opx_config(channels)
         # self.PL_SingleWFType = 0
         # self.PL_ExtEventType = 1
         
-        self._event_queue = []
+        # number of data blocks returned by the last fetch, before filtering
+        self._last_fetch_size = 0
     
-    def _get_opx_config(self):
+    def _get_opx_config(self, channels: Optional[Dict[int, List[int]]]):
         client = self._opx_client
         
         spike_source_nums = set()
@@ -137,6 +377,12 @@ class OpxSource(Source):
             source_name, source_type, num_chans, linear_start_chan = src_info
             
             if source_type == self.SPIKE_TYPE:
+                # spike channels are numbered from 1 within each source, this only helps if there
+                # are several spike sources, usually a single source has every channel
+                if channels is not None and not any(1 <= chan <= num_chans for chan in channels):
+                    print(f"excluding spike source {source_name}, it has none of the used channels")
+                    client.exclude_source(src_num)
+                    continue
                 spike_source_nums.add(src_num)
             elif source_type == self.EVENT_TYPE:
                 event_source_nums.add(src_num)
@@ -144,82 +390,69 @@ class OpxSource(Source):
         return {
             'spike_source_nums': spike_source_nums,
             'event_source_nums': event_source_nums,
+            # arrays for filtering the data blocks with np.isin
+            'spike_source_array': np.array(sorted(spike_source_nums), dtype=np.uint8),
+            'event_source_array': np.array(sorted(event_source_nums), dtype=np.uint8),
         }
     
-    def _fetch_events(self):
-        self._opx_client.opx_wait(5)
-        new_data = self._opx_client.get_new_data()
+    def _fetch_batch(self, timeout):
+        # a full buffer means more data is already waiting at the server
+        if self._last_fetch_size != self._opx_client.opx_client.max_opx_data:
+            # blocks on the server wait handle, returns as soon as new data is published
+            self._opx_client.opx_wait(int(np.ceil(timeout * 1000)))
+            if self._opx_client.last_result == self._OPX_ERROR_TIMEOUT:
+                self._last_fetch_size = 0
+                return EventBatch.empty()
+        wake_time = time.perf_counter()
         
-        out = []
-        for i, num in enumerate(new_data.source_num_or_type):
-            if num in self._opx_config['spike_source_nums']:
-                evt = SpikeEvent(
-                    channel = new_data.channel[i],
-                    unit = new_data.unit[i],
-                    timestamp = new_data.timestamp[i],
-                )
-                out.append(evt)
-            elif num in self._opx_config['event_source_nums']:
-                # print('plx evt', new_data.channel[i], new_data.unit[i])
-                # if new_data.channel[i] == 257:
-                chan = new_data.channel[i]
-                unit = new_data.unit[i]
-                ts = new_data.timestamp[i]
-                tilt_type = {
-                    25: 1,
-                    22: 3,
-                    24: 2,
-                    21: 4,
-                }.get(chan)
-                if tilt_type is not None:
-                    evt = TiltEvent(
-                        # tilt_type = new_data.unit[i],
-                        tilt_type = tilt_type,
-                        timestamp = ts,
-                    )
-                elif chan == 20:
-                    evt = StimEvent(
-                        timestamp = ts,
-                    )
-                else:
-                    evt = UnknownEvent(
-                        channel = chan,
-                        unit = unit,
-                        timestamp = ts,
-                    )
-                
-                out.append(evt)
+        # views into the client's buffer, only valid until the next fetch
+        new_data = self._opx_client.get_new_data_arrays(timestamps_only = self._timestamps_only)
+        self._last_fetch_size = len(new_data.source_num_or_type)
         
-        return out
-    
-    def next_event(self):
-        if not self._event_queue:
-            # reverse list so pop() will get earlier events first
-            self._event_queue = list(reversed(self._fetch_events()))
+        source_nums = new_data.source_num_or_type
+        is_spike = np.isin(source_nums, self._opx_config['spike_source_array'])
+        is_event = np.isin(source_nums, self._opx_config['event_source_array'])
+        # spike sources take precedence if a source is somehow both
+        is_event &= ~is_spike
+        if self._spike_units is not None:
+            # channels can't be excluded at the server, only whole sources
+            unit_keys = new_data.channel.astype(np.uint32) << 16 | new_data.unit
+            is_spike &= np.isin(unit_keys, self._spike_units)
+        keep = np.flatnonzero(is_spike | is_event)
         
-        if not self._event_queue:
-            return None
+        # indexing with keep copies the data out of the client's buffer
+        channel = new_data.channel[keep]
+        unit = new_data.unit[keep]
+        is_event = is_event[keep]
         
-        return self._event_queue.pop()
-    
-    def clear(self):
-        self._event_queue.clear()
-        out = []
-        while True:
-            # res = self._opx_client.get_new_data()
-            res = self._fetch_events()
-            out.extend(res)
-            # continue until less than the max number of events is returned
-            if len(res) != self._opx_client.opx_client.max_opx_data:
-                break
+        kind = np.full(len(keep), EventBatch.SPIKE, dtype=np.uint8)
+        kind[is_event] = EventBatch.UNKNOWN
+        kind[is_event & (channel == self.STIM_CHANNEL)] = EventBatch.STIM
+        for chan, tilt_type in self.TILT_CHANNELS.items():
+            is_tilt = is_event & (channel == chan)
+            kind[is_tilt] = EventBatch.TILT
+            # tilt_type = unit
+            unit[is_tilt] = tilt_type
         
-        return out
+        batch = EventBatch(
+            kind = kind,
+            channel = channel,
+            unit = unit,
+            timestamp = new_data.timestamp[keep],
+        )
+        if len(batch):
+            self.delivery_stats.add(wake_time, len(batch))
+        return batch
+    
+    def _backlog_remaining(self):
+        return self._last_fetch_size == self._opx_client.opx_client.max_opx_data
     
     def close(self):
         self._opx_client.disconnect()
 
 class PyPlexSource(Source):
     def __init__(self):
+        super().__init__()
         from pyplexclientts import PyPlexClientTSAPI, PL_SingleWFType, PL_ExtEventType
         dll_path = Path(__file__).parent / 'bin'
         client = PyPlexClientTSAPI(plexclient_dll_path=str(dll_path))
@@ -227,44 +460,116 @@ class PyPlexSource(Source):
         self._PL_SingleWFType = PL_SingleWFType
         self._PL_ExtEventType = PL_ExtEventType
         self._plex_client = client
-        
-        self._event_queue = []
     
-    def _fetch_events(self):
+    def _fetch_batch(self, timeout):
+        # get_ts has its own fixed wait
         res = self._plex_client.get_ts()
-        out = []
+        wake_time = time.perf_counter()
+        kind = []
+        channel = []
+        unit = []
+        timestamp = []
         for plx_evt in res:
             if plx_evt.Type == self._PL_SingleWFType:
-                evt = SpikeEvent(
-                    channel = plx_evt.Channel,
-                    unit = plx_evt.Unit,
-                    timestamp = plx_evt.TimeStamp,
-                )
-                out.append(evt)
-            elif plx_evt.Type == self._PL_ExtEventType:
-                if plx_evt.Channel == 257:
-                    evt = TiltEvent(
-                        tilt_type = plx_evt.Unit,
-                        timestamp = plx_evt.TimeStamp,
-                    )
-                    out.append(evt)
+                kind.append(EventBatch.SPIKE)
+            elif plx_evt.Type == self._PL_ExtEventType and plx_evt.Channel == 257:
+                # unit is the tilt type
+                kind.append(EventBatch.TILT)
+            else:
+                continue
+            channel.append(plx_evt.Channel)
+            unit.append(plx_evt.Unit)
+            timestamp.append(plx_evt.TimeStamp)
         
-        return out
+        batch = EventBatch(
+            kind = kind,
+            channel = channel,
+            unit = unit,
+            timestamp = timestamp,
+        )
+        if len(batch):
+            self.delivery_stats.add(wake_time, len(batch))
+        return batch
     
-    def next_event(self):
-        if not self._event_queue:
-            # reverse list so pop() will get earlier events first
-            self._event_queue = list(reversed(self._fetch_events()))
-        
-        if not self._event_queue:
-            return None
+    def _backlog_remaining(self):
+        client = self._plex_client
+        return client.num_retreived_opx_server_events.value == client.max_opx_server_events.value
+    
+    def close(self):
+        self._plex_client.close_client()
+
+# EventRing fields used by ProcessSource, one for each EventBatch array
+_RING_FIELDS = [
+    ('kind', np.uint8),
+    ('channel', np.uint16),
+    ('unit', np.uint16),
+    ('timestamp', np.float64),
+]
+
+def _run_source_process(source_type, source_kwargs, ring: EventRing, new_data, stop):
+    """moves events from the source into the ring until stop is set"""
+    source = source_type(**source_kwargs)
+    try:
+        while not stop.is_set():
+            batch = source.next_batch(timeout = PROCESS_WAIT)
+            if not len(batch):
+                continue
+            ring.write(
+                kind = batch.kind,
+                channel = batch.channel,
+                unit = batch.unit,
+                timestamp = batch.timestamp,
+            )
+            new_data.set()
+    finally:
+        source.close()
+
+class ProcessSource(Source):
+    """runs another source in a separate process that continuously drains it into a
+        shared memory ring, the source keeps being read while this process is busy
+        with the motor, nidaq or sleeping between tilts
         
-        return self._event_queue.pop()
+        batches are read from the ring with a cursor without pickling
+        """
     
-    def clear(self):
-        self._event_queue.clear()
-        # may not actually clear all events if there are more than the max batch size
-        return self._fetch_events()
+    def __init__(self, source_type, *, capacity: int = 2**20, **source_kwargs):
+        """
+            Args:
+                source_type: Source subclass to create in the process
+                capacity: number of events kept in the ring
+                source_kwargs: arguments for source_type
+            """
+        super().__init__()
+        self._ring = EventRing(fields=_RING_FIELDS, capacity=capacity)
+        self._new_data = multiprocessing.Event()
+        self._stop = multiprocessing.Event()
+        self._cursor = 0
+        self._proc = spawn_process(
+            _run_source_process,
+            source_type, source_kwargs,
+            self._ring, self._new_data, self._stop,
+        )
+    
+    def _fetch_batch(self, timeout):
+        self._new_data.clear()
+        if self._ring.write_count == self._cursor:
+            if not self._proc.is_alive():
+                raise RuntimeError("event source process stopped")
+            self._new_data.wait(timeout)
+        
+        records, self._cursor, lost = self._ring.read(self._cursor)
+        if lost:
+            print(f"WARNING: {lost} events overwritten in the event ring before being read")
+            self.delivery_stats.add_lost(lost)
+        
+        batch = EventBatch(**records)
+        if len(batch):
+            self.delivery_stats.add(self._ring.last_write_time, len(batch))
+        return batch
     
     def close(self):
-        self._plex_client.close_client()
+        self._stop.set()
+        self._proc.join(timeout = 1)
+        if self._proc.is_alive():
+            self._proc.terminate()
+        self._ring.close()
@@ -0,0 +1,35 @@
+
+import argparse
+from pathlib import Path
+
+from grf_output import convert_to_csv
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='convert a binary (.grfb) loadcell recording to csv')
+    
+    parser.add_argument('input', type=Path,
+        help='input .grfb file')
+    parser.add_argument('--out', type=Path,
+        help='output csv path, defaults to the input path with a .csv extension')
+    
+    parser.add_argument('--overwrite', action='store_true',
+        help='overwrite output file if it already exists')
+    
+    args = parser.parse_args()
+    
+    return args
+
+def main():
+    args = parse_args()
+    
+    out_path = args.out
+    if out_path is None:
+        out_path = args.input.with_suffix('.csv')
+    
+    if not args.overwrite:
+        assert not out_path.exists(), f"output file {out_path} already exists"
+    
+    convert_to_csv(args.input, out_path)
+
+if __name__ == '__main__':
+    main()
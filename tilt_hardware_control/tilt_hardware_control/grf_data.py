@@ -2,7 +2,6 @@
 from typing import List, Dict, get_type_hints, Any, Literal, Tuple, Optional, Callable
 import os
 import time
-import csv
 import json
 from collections import deque
 from contextlib import ExitStack, AbstractContextManager, contextmanager
@@ -11,7 +10,12 @@ from multiprocessing import Process, Event as PEvent, Queue, Value, Lock
 from queue import Empty, Full
 import atexit
 
-from util_multiprocess import DigitalLine, AnalogChannel, spawn_process
+import numpy as np
+
+from grf_output import WriterProcess
+from grf_telemetry import RecordTelemetry
+from grf_sim import SimulatedDaq
+from util_multiprocess import DigitalLine, AnalogRing, spawn_process
 
 RECORD_PROCESS_STOP_TIMEOUT = 30
 
@@ -317,7 +321,11 @@ class LiveViewState:
             self.stopped.wait(timeout=RECORD_PROCESS_STOP_TIMEOUT)
 
 class RecordState:
-    def __init__(self):
+    def __init__(self, *, analog_history: int = 30000):
+        """
+            Args:
+                analog_history: number of samples per channel kept for the live view
+            """
         # set to request the record process to stop 
         self.stopping = PEvent()
         # set when the record process completes
@@ -325,8 +333,6 @@ class RecordState:
         # set if recording process fails
         self.failed = PEvent()
         
-        self.chan_lock = Lock()
-        
         d_line_keys = [x['digital_line'] for x in HEADERS if 'digital_line' in x]
         self.digital_lines = {
             # 'tilt_active': DigitalLine(),
@@ -335,10 +341,9 @@ class RecordState:
         }
         
         ac_keys = [x['analog_channel'] for x in HEADERS if 'analog_channel' in x]
-        self.analog_channels = {
-            k: AnalogChannel(max_len=30000, lock=self.chan_lock)
-            for k in ac_keys
-        }
+        self.analog = AnalogRing(channels=ac_keys, max_len=analog_history)
+        
+        self.telemetry = RecordTelemetry()
         
         self.live = LiveViewState()
     
@@ -371,6 +376,57 @@ class RecordEventContext(AbstractContextManager):
         # time.sleep(5)
         self.stop_event.stopped.set()
 
+DOWNSAMPLE_MODES = ['minmax', 'max', 'first']
+
+def _decimate(block: np.ndarray, factor: int, modes: np.ndarray, out: np.ndarray):
+    """downsamples the (channels, samples) `block` by `factor` into `out`
+        
+        each group of `factor` samples becomes two points, the min and max of the group
+        for minmax channels, the max twice for max channels and the first sample twice
+        for first channels. `out` is (channels, points) and is filled from the end,
+        points without samples are set to 0
+        
+        Args:
+            modes: index into DOWNSAMPLE_MODES for each channel
+        """
+    buckets = min(block.shape[1] // factor, out.shape[1] // 2)
+    pad = out.shape[1] - buckets * 2
+    out[:, :pad] = 0
+    if buckets == 0:
+        return
+    
+    # the most recent whole groups of samples, reshaping doesn't copy the data
+    grouped = block[:, block.shape[1]-buckets*factor:].reshape(block.shape[0], buckets, factor)
+    tail = out[:, pad:]
+    np.min(grouped, axis=2, out=tail[:, 0::2])
+    np.max(grouped, axis=2, out=tail[:, 1::2])
+    
+    max_rows = modes == DOWNSAMPLE_MODES.index('max')
+    tail[max_rows, 0::2] = tail[max_rows, 1::2]
+    first_rows = modes == DOWNSAMPLE_MODES.index('first')
+    tail[first_rows, 0::2] = grouped[first_rows, :, 0]
+    tail[first_rows, 1::2] = grouped[first_rows, :, 0]
+
+def _push_samples(buffer: np.ndarray, new: np.ndarray):
+    """shifts the (..., samples) `buffer` left and appends `new` to the end"""
+    n = min(new.shape[-1], buffer.shape[-1])
+    if n == 0:
+        return
+    buffer[..., :buffer.shape[-1]-n] = buffer[..., n:]
+    buffer[..., buffer.shape[-1]-n:] = new[..., new.shape[-1]-n:]
+
+def _bias_offset(apply_bias, bias, column_names: List[str]) -> Optional[np.ndarray]:
+    """returns the offset `apply_bias` adds to each column or None if it isn't a constant offset"""
+    probe = {
+        'np': np.array([np.zeros(len(column_names)), np.ones(len(column_names))]),
+        'column_names': list(column_names),
+    }
+    apply_bias(probe, bias)
+    offset = np.array(probe['np'][0], dtype=float)
+    if not np.allclose(probe['np'][1] - offset, 1):
+        return None
+    return offset
+
 def _live_view(
         *, state: RecordState, sample_rate: int, downsample_to: Optional[int],
         seconds: int,
@@ -484,11 +540,32 @@ def _live_view(
         timing_label = layout.addLabel('')
         
         queue_len = sample_rate*seconds#*(downsample_factor if downsample_factor is not None else 1)
-        collectors: List[deque[float]] = [deque(maxlen=queue_len) for _ in live_headers]
-        initial = [0 for _ in range(queue_len)]
-        for c in collectors:
-            c.extend(initial)
-        x_axis_data = [i/sample_rate for i in range(queue_len, 0, -1)]
+        x_axis_data = np.arange(queue_len, 0, -1) / sample_rate
+        
+        # live data is plotted as a min/max envelope with two points per downsampled sample
+        envelope_x = np.repeat(x_axis_data, 2)
+        envelope = np.zeros((len(state.analog.channels), queue_len * 2))
+        downsample_modes = np.zeros(len(state.analog.channels), dtype=int)
+        for h in HEADERS:
+            if 'analog_channel' not in h:
+                continue
+            downsample_mode = h.get('downsample_mode', 'minmax')
+            if downsample_mode not in DOWNSAMPLE_MODES:
+                raise ValueError(f'invalid downsample mode {downsample_mode}')
+            downsample_modes[state.analog.index(h['analog_channel'])] = DOWNSAMPLE_MODES.index(downsample_mode)
+        envelope_rows = [state.analog.index(h['analog_channel']) for h in live_headers]
+        
+        if calibrate is not None:
+            # rolling buffers of calibrated samples, only new samples are calibrated each render
+            cal_headers = [h for h in live_headers if 'cal' in h]
+            cal_names = [h['cal'] for h in cal_headers]
+            cal_rows = [state.analog.index(h['analog_channel']) for h in cal_headers]
+            cal_data = np.zeros((len(cal_headers), queue_len))
+            cop_data = np.zeros((2, queue_len))
+            # samples before this have been calibrated
+            cal_processed = [0]
+            # applied as a vector if apply_bias only adds a constant to each column
+            bias_offset = _bias_offset(apply_bias, bias, cal_names)
         
         plots = {}
         for graph_name, graph_info in GRAPHS.items():
@@ -516,7 +593,10 @@ def _live_view(
             color = h.get('color', (255, 255, 255))
             plot = plots[h['graph']]
             curve = plot.plot(pen=color)
-            curve.setData(x=x_axis_data, y=initial)
+            if calibrate is not None and 'cal' in h:
+                curve.setData(x=x_axis_data, y=np.zeros(queue_len))
+            else:
+                curve.setData(x=envelope_x, y=envelope[envelope_rows[i]])
             return curve
         
         curves: List[PlotDataItem] = [get_curve(i) for i in range(len(live_headers))]
@@ -600,46 +680,51 @@ def _live_view(
                 # timing_label.resizeEvent(None)
                 # timing_label.updateGeometry()
             
-            def apply_cal():
-                data = np.array(collectors, dtype=float)
-                data = data.swapaxes(0, 1)
+            def apply_cal(write_count: int, latest: np.ndarray):
+                factor = downsample_factor or 1
+                end = write_count - write_count % factor
+                # skip samples that are no longer in the buffer or wouldn't be visible
+                oldest = write_count - latest.shape[1]
+                start = max(cal_processed[0], end - queue_len * factor, oldest + (-oldest) % factor)
+                if end <= start:
+                    return
+                cal_processed[0] = end
+                
+                new = latest[cal_rows, start-oldest:end-oldest]
+                new = new.reshape(len(cal_rows), -1, factor).mean(axis=2)
                 
                 data = {
-                    'np': data,
-                    'column_names': [x['cal'] for x in live_headers],
+                    'np': new.swapaxes(0, 1),
+                    'column_names': cal_names,
                 }
                 
-                apply_bias(data, bias)
+                if bias_offset is not None:
+                    data['np'] = data['np'] + bias_offset
+                else:
+                    apply_bias(data, bias)
                 apply_best_voltage(data, hw_conf)
                 cop = calc_all_cop(data, hw_conf)
                 
-                out_data = data['np'].swapaxes(0, 1)
-                for i, (curve, header) in enumerate(zip(curves, live_headers)):
+                _push_samples(cal_data, np.asarray(data['np']).swapaxes(0, 1))
+                _push_samples(cop_data, np.array([cop['cop_x'], cop['cop_y']], dtype=float))
+            
+            factor = downsample_factor or 1
+            write_count, latest = state.analog.read_latest(src_sample_rate*seconds + factor)
+            if calibrate is not None:
+                apply_cal(write_count, latest)
+            
+            # drop the samples of an incomplete group so groups line up between renders
+            _decimate(latest[:, :latest.shape[1] - write_count % factor], factor, downsample_modes, envelope)
+            for row, header, curve in zip(envelope_rows, live_headers, curves):
+                if calibrate is not None and 'cal' in header:
                     if header['csv'] == 'Strobe':
-                        curve.setData(cop['cop_x'])
+                        curve.setData(y=cop_data[0], x=x_axis_data)
                     elif header['csv'] == 'Start':
-                        curve.setData(cop['cop_y'])
+                        curve.setData(y=cop_data[1], x=x_axis_data)
                     else:
-                        curve.setData(out_data[i])
-            
-            if calibrate is not None:
-                apply_cal()
-            else:
-                for i, (meta, curve) in enumerate(zip(live_headers, curves)):
-                    data = state.analog_channels[meta['analog_channel']].read()
-                    downsample_mode = meta.get('downsample_mode', 'first')
-                    if downsample_factor is not None:
-                        if downsample_mode == 'first':
-                            data = [data[x] for x in range(0, min(len(data), src_sample_rate*seconds), downsample_factor)]
-                        elif downsample_mode == 'max':
-                            data = [max(data[x:x+downsample_factor]) for x in range(0, min(len(data), src_sample_rate*seconds), downsample_factor)]
-                        else:
-                            raise ValueError(f'invalid downsample mode {downsample_mode}')
-                        # print(downsample_factor)
-                    if len(data) < queue_len:
-                        data = [0 for _ in range(queue_len-len(data))] + data
-                    # curve.setData(y=collectors[i], x=x_axis_data)
-                    curve.setData(y=data, x=x_axis_data)
+                        curve.setData(y=cal_data[cal_names.index(header['cal'])], x=x_axis_data)
+                else:
+                    curve.setData(y=envelope[row], x=envelope_x)
             
             app.processEvents()
         
@@ -650,6 +735,20 @@ def _live_view(
         
         app.exec_()
 
+def _channel_block(data, num_channels: int, dtype) -> np.ndarray:
+    """converts data read from a task to a (channels, samples) array
+        
+        if there is only one channel nidaqmx returns [ch1] in stead of [[ch1], [ch2]]
+        this converts the data into a consistant format regardless of channel count
+        """
+    block = np.asarray(data, dtype=dtype)
+    if block.ndim == 1:
+        assert num_channels == 1
+        return block.reshape(1, -1)
+    assert num_channels != 1
+    assert block.shape[0] == num_channels
+    return block
+
 def record_data(*,
         clock_source: str="", clock_rate: int,
         csv_path,
@@ -658,7 +757,14 @@ def record_data(*,
         num_samples: Optional[int] = None,
         live_view_seconds: int = 10,
         output_meta: Optional[Dict[str, Any]] = None,
+        telemetry_path: Optional[str] = None,
+        mock_options: Optional[Dict[str, Any]] = None,
     ):
+    """
+        Args:
+            telemetry_path: path to write a jsonl file of acquisition health telemetry to
+            mock_options: keyword arguments for `grf_sim.SimulatedDaq` when mock is true
+        """
     
     # samples per second
     # SAMPLE_RATE = 1250
@@ -670,16 +776,6 @@ def record_data(*,
     
     assert sample_batch_size > 0
     
-    _digital_line_cache = {k: False for k in state.digital_lines}
-    def set_digital_line(line: str, val: bool):
-        if _digital_line_cache[line] != val:
-            _digital_line_cache[line] = val
-            if val:
-                state.digital_lines[line].set_true()
-            else:
-                state.digital_lines[line].set_false()
-    
-    csv_headers = [x['csv'] for x in HEADERS if 'csv' in x]
     def get_channels():
         for h in HEADERS:
             if 'csv' not in h:
@@ -713,6 +809,12 @@ def record_data(*,
         digital_channels = [x for x in HEADERS if 'nidaq_digital' in x]
         assert len(nidaq_channels) + len(digital_channels) == len(channels)
         
+        # rows of the analog and digital blocks that are copied into the analog ring
+        ring_analog_src = [i for i, h in enumerate(nidaq_channels) if 'analog_channel' in h]
+        ring_analog_dst = [state.analog.index(nidaq_channels[i]['analog_channel']) for i in ring_analog_src]
+        ring_digital_src = [i for i, h in enumerate(digital_channels) if 'analog_channel' in h]
+        ring_digital_dst = [state.analog.index(digital_channels[i]['analog_channel']) for i in ring_digital_src]
+        
         if state.live.enabled:
             if state.live.calibrated:
                 assert state.live.bias_file is not None
@@ -760,75 +862,38 @@ def record_data(*,
             # task.triggers.start_trigger.cfg_dig_edge_start_trig("/Dev6/PFI8", trigger_edge=Edge.RISING)
         else:
             WAIT_INFINITELY = None
-            class MockTask:
-                def __init__(self, *, digital: bool = False):
-                    self.i = 0
-                    self.digital = digital
-                    if digital:
-                        hz = 0.5
-                        self._step = 1/clock_rate * hz
-                    else:
-                        self._step = 0.0001
-                    
-                    class InStream:
-                        avail_samp_per_chan = 1
-                    self.in_stream = InStream()
-                
-                def start(self):
-                    pass
-                
-                def count(self):
-                    i = self.i
-                    self.i += self._step
-                    if self.i > 1:
-                        self.i = 0
-                    return i
-                
-                def read(self, samples_per_channel, _timeout):
-                    time.sleep(samples_per_channel/clock_rate)
-                    from random import randrange
-                    val = self.count()
-                    def gen_samples(meta, col_i):
-                        if self.digital:
-                            return [val > 0.5 for _ in range(samples_per_channel)]
-                            # return [True for _ in range(samples_per_channel)]
-                        return [self.count()+(col_i/3) for _ in range(samples_per_channel)]
-                    if self.digital:
-                        row = [
-                            # [1 for _ in range(SAMPLE_BATCH_SIZE)]
-                            # [i for i in range(SAMPLE_BATCH_SIZE)]
-                            # [self.count()+(j/3) for _ in range(samples_per_channel)]
-                            gen_samples(meta, i)
-                            for i, meta in enumerate(digital_channels)
-                        ]
-                    else:
-                        row = [
-                            # [1 for _ in range(SAMPLE_BATCH_SIZE)]
-                            # [i for i in range(SAMPLE_BATCH_SIZE)]
-                            # [self.count()+(j/3) for _ in range(samples_per_channel)]
-                            gen_samples(meta, j)
-                            for meta, j in zip(nidaq_channels, range(len(nidaq_channels)))
-                        ]
-                    # emulated nidaqmx behavior with one channel
-                    if len(row) == 1:
-                        row = row[0]
-                    return row
-            task = MockTask()
-            digital_task = MockTask(digital=True)
+            daq = SimulatedDaq(
+                clock_rate = clock_rate,
+                analog_headers = nidaq_channels,
+                digital_headers = digital_channels,
+                buffer_size = nidaq_buffer_size,
+                **(mock_options or {}),
+            )
+            task = daq.analog_task()
+            digital_task = daq.digital_task()
         
         if csv_path is not None:
-            csv_file = stack.enter_context(open(csv_path, 'w+', newline='', encoding='utf8'))
-            writer = csv.writer(csv_file)
-            
-            if output_meta is not None:
-                # write metadata
-                writer.writerow(['v', '1'])
-                writer.writerow([json.dumps(output_meta, indent=2)])
-            
-            writer.writerow(csv_headers + ['Timestamp'])
+            # csv or binary output depending on the file extension
+            # file writes happen in a separate process so a slow disk can't delay nidaq reads
+            writer: Optional[WriterProcess] = WriterProcess(
+                csv_path,
+                channels = channels,
+                clock_rate = clock_rate,
+                output_meta = output_meta,
+                failed = state.failed,
+            )
+            stack.callback(writer.close, timeout=RECORD_PROCESS_STOP_TIMEOUT)
         else:
             writer = None
         
+        telemetry = state.telemetry
+        telemetry.start(
+            path = telemetry_path,
+            nidaq_buffer_size = nidaq_buffer_size,
+            writer_capacity = writer.queue.capacity if writer is not None else 0,
+        )
+        stack.callback(telemetry.close)
+        
         task.start()
         digital_task.start()
         
@@ -846,7 +911,9 @@ def record_data(*,
             
             # print(task.in_stream.avail_samp_per_chan)
             # sample_batch_size = 1000
-            sample_batch_size = task.in_stream.avail_samp_per_chan or 1
+            backlog = task.in_stream.avail_samp_per_chan
+            sample_batch_size = backlog or 1
+            read_start = time.perf_counter()
             data = task.read(sample_batch_size, read_timeout)
             # digital_batch_size = 
             digital_data = digital_task.read(sample_batch_size, read_timeout)
@@ -855,18 +922,8 @@ def record_data(*,
             # continue
             timer_start = time.perf_counter()
             
-            # if there is only one channel nidaqmx returns [ch1] in stead of [[ch1], [ch2]]
-            # convert the data into a consistant format regardless of channel count
-            if type(data[0]) is not list:
-                assert len(nidaq_channels) == 1
-                data = [data]
-            else:
-                assert len(nidaq_channels) != 1
-            if type(digital_data[0]) is not list:
-                assert len(digital_channels) == 1
-                digital_data = [digital_data]
-            else:
-                assert len(digital_channels) != 1
+            analog_block = _channel_block(data, len(nidaq_channels), float)
+            digital_block = _channel_block(digital_data, len(digital_channels), np.uint8)
             
             # if state.live.enabled:
             #     try:
@@ -874,71 +931,23 @@ def record_data(*,
             #     except Full:
             #         print("live view queue full, data is being discarded (will still be written to csv)")
             
-            # import util_multiprocess
-            with state.chan_lock:
-                for meta, chan in zip(nidaq_channels, data):
-                    if 'digital_line' in meta:
-                        val = chan[-1]
-                        val = val > 2.2
-                        assert type(val) == bool
-                        set_digital_line(meta['digital_line'], val)
-                    if 'analog_channel' in meta:
-                        # assert len(chan) == 1
-                        val = chan[0]
-                        assert type(val) == float
-                        ch = state.analog_channels[meta['analog_channel']]
-                        # with ch._lock:
-                        for x in chan:
-                            ch._write_sample(x)
-                        # state.analog_channels[meta['analog_channel']].write_sample(val)
-                for meta, chan in zip(digital_channels, digital_data):
-                    if 'digital_line' in meta:
-                        val = chan[-1]
-                        assert type(val) == bool
-                        set_digital_line(meta['digital_line'], val)
-                    if 'analog_channel' in meta:
-                        # assert len(chan) == 1
-                        # val = 1.0 if chan[0] else 0.0
-                        # assert type(val) == float
-                        ch = state.analog_channels[meta['analog_channel']]
-                        for x in chan:
-                            ch._write_sample(1.0 if x else 0.0)
-                        # state.analog_channels[meta['analog_channel']].write_sample(val)
-            
-            
-            for i in range(sample_batch_size):
-                def gen_row():
-                    # indexes for analog and digital channels
-                    a_i = 0
-                    d_i = 0
-                    for c in channels:
-                        if c['type'] == 'analog':
-                            x = data[a_i][i]
-                            yield x
-                            a_i += 1
-                        elif c['type'] == 'digital':
-                            x = digital_data[d_i][i]
-                            yield 1 if x else 0
-                            d_i += 1
-                        else:
-                            assert False
-                    
-                    assert a_i == len(data)
-                    assert d_i == len(digital_data)
-                    
-                    # for meta, chan in zip(nidaq_channels, data):
-                    #     if 'csv' in meta:
-                    #         val = chan[i]
-                    #         if type(val) == bool:
-                    #             yield 1 if val else 0
-                    #         else:
-                    #             yield val
-                    yield sample_i / clock_rate
-                
-                if writer is not None:
-                    writer.writerow(gen_row())
-                
-                sample_i += 1
+            # edges are found from every sample in the batch so their exact sample index is known
+            for meta, chan in zip(nidaq_channels, analog_block):
+                if 'digital_line' in meta:
+                    state.digital_lines[meta['digital_line']].write_block(chan > 2.2, sample_i, clock_rate)
+            for meta, chan in zip(digital_channels, digital_block):
+                if 'digital_line' in meta:
+                    state.digital_lines[meta['digital_line']].write_block(chan.astype(bool), sample_i, clock_rate)
+            
+            ring_block = np.zeros((len(state.analog.channels), sample_batch_size))
+            ring_block[ring_analog_dst] = analog_block[ring_analog_src]
+            ring_block[ring_digital_dst] = digital_block[ring_digital_src]
+            state.analog.write_block(ring_block)
+            
+            if writer is not None:
+                writer.write_block(analog_block, digital_block, sample_i)
+            
+            sample_i += sample_batch_size
             
             timer_end = time.perf_counter()
             # print(timer_end - timer_start)
@@ -950,9 +959,20 @@ def record_data(*,
                     }, block=False)
                 except Full:
                     # print("timing queue full")
-                    pass
+                    telemetry.live_dropped()
+            
+            telemetry.batch(
+                samples = sample_batch_size,
+                backlog = backlog,
+                read_time = timer_start - read_start,
+                proc_time = timer_end - timer_start,
+            )
+            if telemetry.due():
+                telemetry.flush(sample_i = sample_i, writer_stats = writer.queue.stats() if writer is not None else None)
             
             if num_samples is not None and sample_i >= num_samples:
                 break
             if state.stopping.is_set():
                 break
+        
+        telemetry.flush(sample_i = sample_i, writer_stats = writer.queue.stats() if writer is not None else None)
@@ -0,0 +1,538 @@
+"""
+writers and readers for recorded ground reaction force data
+
+two formats are supported, selected by the output file extension
+    .csv (or any other extension): text csv, one row per sample
+    .grfb: chunked binary file
+
+grfb layout (all values little endian)
+    magic b'GRFB', u32 format version
+    u32 header length, utf8 json header
+        {'meta': output_meta, 'clock_rate': int, 'channels': [{'type', 'header'}, ...]}
+    repeated chunks
+        u64 index of the first sample in the chunk, u32 number of samples (n)
+        analog samples, f8[analog channels][n]
+        digital samples, u1[digital channels][n]
+
+`WriterProcess` writes either format from a separate process so a slow disk
+does not delay reads from the nidaq
+"""
+
+from typing import List, Dict, Any, Optional, Iterator, Tuple, Union
+from pathlib import Path
+from struct import Struct
+from multiprocessing import Event as PEvent
+import time
+import csv
+import json
+
+import numpy as np
+
+from util_multiprocess import SharedArray, spawn_process
+
+BINARY_SUFFIX = '.grfb'
+_BINARY_MAGIC = b'GRFB'
+_BINARY_VERSION = 1
+
+_file_header = Struct('<4sII')
+_chunk_header = Struct('<QI')
+
+class CsvWriter:
+    """writes blocks of analog and digital samples to a loadcell csv file
+        
+        each block is converted to a single array and written with one call,
+        the output is the same as writing each row with `csv.writer`
+        """
+    
+    def __init__(self, f, *,
+        channels: List[Dict[str, Any]],
+        clock_rate: int,
+        output_meta: Optional[Dict[str, Any]] = None,
+    ):
+        """
+            Args:
+                f: text file opened with newline=''
+                channels: list of {'type': 'analog' | 'digital', 'header': str}
+                    in csv column order
+            """
+        self._f = f
+        self._clock_rate = clock_rate
+        
+        self._analog_cols = [i for i, c in enumerate(channels) if c['type'] == 'analog']
+        self._digital_cols = [i for i, c in enumerate(channels) if c['type'] == 'digital']
+        assert len(self._analog_cols) + len(self._digital_cols) == len(channels)
+        self._num_cols = len(channels) + 1
+        
+        # csv.writer formats floats with repr, %s gives the same output
+        # digital values are written as 0 or 1
+        fmts = ['%d' if c['type'] == 'digital' else '%s' for c in channels]
+        fmts.append('%s') # timestamp
+        self._row_fmt = ','.join(fmts) + '\r\n'
+        
+        writer = csv.writer(f)
+        if output_meta is not None:
+            # write metadata
+            writer.writerow(['v', '1'])
+            writer.writerow([json.dumps(output_meta, indent=2)])
+        writer.writerow([c['header'] for c in channels] + ['Timestamp'])
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        self._f.close()
+    
+    def write_block(self, analog: np.ndarray, digital: np.ndarray, sample_i: int):
+        """
+            Args:
+                analog: (analog channels, samples) array
+                digital: (digital channels, samples) array
+                sample_i: index of the first sample in the block
+            """
+        n = analog.shape[1]
+        assert digital.shape[1] == n
+        
+        block = np.empty((n, self._num_cols), dtype=float)
+        block[:, self._analog_cols] = analog.T
+        block[:, self._digital_cols] = digital.T
+        block[:, -1] = np.arange(sample_i, sample_i + n) / self._clock_rate
+        
+        row_fmt = self._row_fmt
+        self._f.write(''.join([row_fmt % tuple(row) for row in block.tolist()]))
+
+class BinaryWriter:
+    """writes blocks of analog and digital samples to a grfb file"""
+    
+    def __init__(self, f, *,
+        channels: List[Dict[str, Any]],
+        clock_rate: int,
+        output_meta: Optional[Dict[str, Any]] = None,
+    ):
+        """
+            Args:
+                f: file opened in binary mode
+                channels: list of {'type': 'analog' | 'digital', 'header': str}
+                    in csv column order
+            """
+        self._f = f
+        self._num_analog = len([c for c in channels if c['type'] == 'analog'])
+        self._num_digital = len([c for c in channels if c['type'] == 'digital'])
+        assert self._num_analog + self._num_digital == len(channels)
+        
+        header = {
+            'meta': output_meta,
+            'clock_rate': clock_rate,
+            'channels': [
+                {'type': c['type'], 'header': c['header']}
+                for c in channels
+            ],
+        }
+        header_bytes = json.dumps(header).encode('utf8')
+        f.write(_file_header.pack(_BINARY_MAGIC, _BINARY_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        self._f.close()
+    
+    def write_block(self, analog: np.ndarray, digital: np.ndarray, sample_i: int):
+        n = analog.shape[1]
+        assert analog.shape[0] == self._num_analog
+        assert digital.shape == (self._num_digital, n)
+        
+        self._f.write(_chunk_header.pack(sample_i, n))
+        self._f.write(np.ascontiguousarray(analog, dtype='<f8').tobytes())
+        self._f.write(np.ascontiguousarray(digital, dtype='u1').tobytes())
+
+GrfWriter = Union[CsvWriter, BinaryWriter]
+
+def open_writer(path, *,
+    channels: List[Dict[str, Any]],
+    clock_rate: int,
+    output_meta: Optional[Dict[str, Any]] = None,
+) -> GrfWriter:
+    """opens a writer for `path`, the format is selected by the file extension"""
+    path = Path(path)
+    if path.suffix == BINARY_SUFFIX:
+        bin_f = open(path, 'wb')
+        return BinaryWriter(bin_f, channels=channels, clock_rate=clock_rate, output_meta=output_meta)
+    
+    csv_f = open(path, 'w+', newline='', encoding='utf8')
+    return CsvWriter(csv_f, channels=channels, clock_rate=clock_rate, output_meta=output_meta)
+
+class BinaryReader:
+    """reads a grfb file written by `BinaryWriter`"""
+    
+    def __init__(self, path):
+        self._f = open(path, 'rb')
+        
+        magic, version, header_len = _file_header.unpack(self._f.read(_file_header.size))
+        if magic != _BINARY_MAGIC:
+            raise ValueError(f"{path} is not a grfb file")
+        if version != _BINARY_VERSION:
+            raise ValueError(f"unsupported grfb version {version}")
+        
+        header = json.loads(self._f.read(header_len).decode('utf8'))
+        self.meta: Optional[Dict[str, Any]] = header['meta']
+        self.clock_rate: int = header['clock_rate']
+        self.channels: List[Dict[str, Any]] = header['channels']
+        
+        self._num_analog = len([c for c in self.channels if c['type'] == 'analog'])
+        self._num_digital = len([c for c in self.channels if c['type'] == 'digital'])
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        self._f.close()
+    
+    def iter_blocks(self) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        """yields (first sample index, analog, digital) for each chunk
+            
+            a truncated chunk at the end of the file (e.g. from an interrupted
+            recording) is ignored
+            """
+        while True:
+            raw = self._f.read(_chunk_header.size)
+            if len(raw) < _chunk_header.size:
+                return
+            sample_i, n = _chunk_header.unpack(raw)
+            
+            analog_size = self._num_analog * n * 8
+            digital_size = self._num_digital * n
+            raw = self._f.read(analog_size + digital_size)
+            if len(raw) < analog_size + digital_size:
+                return
+            
+            analog = np.frombuffer(raw, dtype='<f8', count=self._num_analog * n)
+            digital = np.frombuffer(raw, dtype='u1', offset=analog_size)
+            yield sample_i, analog.reshape(self._num_analog, n), digital.reshape(self._num_digital, n)
+
+def load_binary(path) -> Dict[str, Any]:
+    """loads a grfb file
+        
+        Returns:
+            {
+                'np': (samples, columns) array in csv column order, including Timestamp
+                'column_names': csv column names,
+                'meta': output_meta the file was recorded with,
+                'clock_rate': int,
+            }
+        """
+    with BinaryReader(path) as reader:
+        analog_cols = [i for i, c in enumerate(reader.channels) if c['type'] == 'analog']
+        digital_cols = [i for i, c in enumerate(reader.channels) if c['type'] == 'digital']
+        
+        blocks = []
+        for sample_i, analog, digital in reader.iter_blocks():
+            n = analog.shape[1]
+            block = np.empty((n, len(reader.channels) + 1), dtype=float)
+            block[:, analog_cols] = analog.T
+            block[:, digital_cols] = digital.T
+            block[:, -1] = np.arange(sample_i, sample_i + n) / reader.clock_rate
+            blocks.append(block)
+        
+        if blocks:
+            data = np.concatenate(blocks)
+        else:
+            data = np.empty((0, len(reader.channels) + 1), dtype=float)
+        
+        return {
+            'np': data,
+            'column_names': [c['header'] for c in reader.channels] + ['Timestamp'],
+            'meta': reader.meta,
+            'clock_rate': reader.clock_rate,
+        }
+
+def load_csv(path) -> Dict[str, Any]:
+    """loads a loadcell csv file into the same format as `load_binary`
+        
+        clock_rate is calculated from the timestamps and is None if there are
+        less than two samples
+        """
+    with open(path, newline='', encoding='utf8') as f:
+        reader = csv.reader(f)
+        row = next(reader)
+        if row == ['v', '1']:
+            meta = json.loads(next(reader)[0])
+            row = next(reader)
+        else:
+            meta = None
+        column_names = row
+        data = np.loadtxt(f, delimiter=',', ndmin=2)
+    
+    if len(data) == 0:
+        data = np.empty((0, len(column_names)), dtype=float)
+    if len(data) >= 2:
+        clock_rate: Optional[int] = int(round(1 / (data[1, -1] - data[0, -1])))
+    else:
+        clock_rate = None
+    
+    return {
+        'np': data,
+        'column_names': column_names,
+        'meta': meta,
+        'clock_rate': clock_rate,
+    }
+
+def load_recording(path) -> Dict[str, Any]:
+    """loads a csv or grfb file depending on the file extension"""
+    if Path(path).suffix == BINARY_SUFFIX:
+        return load_binary(path)
+    return load_csv(path)
+
+def convert_to_csv(src_path, dst_path):
+    """converts a grfb file to the csv format written during recording"""
+    with BinaryReader(src_path) as reader:
+        csv_f = open(dst_path, 'w', newline='', encoding='utf8')
+        with CsvWriter(csv_f,
+            channels = reader.channels,
+            clock_rate = reader.clock_rate,
+            output_meta = reader.meta,
+        ) as writer:
+            for sample_i, analog, digital in reader.iter_blocks():
+                writer.write_block(analog, digital, sample_i)
+
+class WriterFailure(Exception):
+    pass
+
+class QueueOverrun(Exception):
+    pass
+
+# SampleQueue counter indexes
+_WRITE_COUNT = 0
+_READ_COUNT = 1
+_BACKPRESSURE_WAITS = 2
+_MAX_FILL = 3
+
+class SampleQueue:
+    """single producer, single consumer queue of samples in shared memory
+        
+        samples are stored in a ring buffer, the producer only advances the write
+        count and the consumer only advances the read count so no lock is needed
+        """
+    
+    def __init__(self, *, capacity: int, num_analog: int, num_digital: int):
+        self.capacity = capacity
+        self._analog = SharedArray((capacity, num_analog), '<f8')
+        self._digital = SharedArray((capacity, num_digital), 'u1')
+        self._counters = SharedArray((4,), 'i8')
+    
+    def close(self):
+        self._analog.close()
+        self._digital.close()
+        self._counters.close()
+    
+    @property
+    def write_count(self) -> int:
+        return int(self._counters.array[_WRITE_COUNT])
+    
+    @property
+    def read_count(self) -> int:
+        return int(self._counters.array[_READ_COUNT])
+    
+    def fill(self) -> int:
+        """number of samples waiting to be consumed"""
+        counters = self._counters.array
+        return int(counters[_WRITE_COUNT] - counters[_READ_COUNT])
+    
+    def stats(self) -> Dict[str, int]:
+        counters = self._counters.array
+        return {
+            'samples': int(counters[_WRITE_COUNT]),
+            'fill': int(counters[_WRITE_COUNT] - counters[_READ_COUNT]),
+            'max_fill': int(counters[_MAX_FILL]),
+            'capacity': self.capacity,
+            'backpressure_waits': int(counters[_BACKPRESSURE_WAITS]),
+        }
+    
+    def put(self, analog: np.ndarray, digital: np.ndarray, *,
+        timeout: float, consumer_stopped: Optional[Any] = None,
+    ):
+        """
+            Args:
+                analog: (analog channels, samples) array
+                digital: (digital channels, samples) array
+                timeout: time to wait for the consumer if there isn't enough space
+                consumer_stopped: event that is set if the consumer has stopped
+            
+            Raises:
+                QueueOverrun: if space isn't available before the timeout
+                WriterFailure: if the consumer stops while waiting for space
+            """
+        n = analog.shape[1]
+        assert n <= self.capacity
+        counters = self._counters.array
+        
+        wait_start = None
+        while self.capacity - self.fill() < n:
+            if consumer_stopped is not None and consumer_stopped.is_set():
+                raise WriterFailure()
+            if wait_start is None:
+                wait_start = time.perf_counter()
+            elif time.perf_counter() - wait_start > timeout:
+                raise QueueOverrun()
+            counters[_BACKPRESSURE_WAITS] += 1
+            time.sleep(0.001)
+        
+        write_count = int(counters[_WRITE_COUNT])
+        start = write_count % self.capacity
+        # split the block if it wraps around the end of the buffer
+        first = min(n, self.capacity - start)
+        self._analog.array[start:start+first] = analog[:, :first].T
+        self._digital.array[start:start+first] = digital[:, :first].T
+        if first < n:
+            self._analog.array[:n-first] = analog[:, first:].T
+            self._digital.array[:n-first] = digital[:, first:].T
+        
+        # only advance the write count after the data is in place
+        counters[_WRITE_COUNT] = write_count + n
+        fill = write_count + n - int(counters[_READ_COUNT])
+        if fill > counters[_MAX_FILL]:
+            counters[_MAX_FILL] = fill
+    
+    def peek(self) -> Optional[Tuple[int, np.ndarray, np.ndarray]]:
+        """returns (first sample index, analog, digital) views of the next contiguous
+            span of samples without consuming them, or None if the queue is empty
+            
+            the analog and digital arrays are (channels, samples) views into the
+            shared buffer and are only valid until `consume` is called
+            """
+        counters = self._counters.array
+        read_count = int(counters[_READ_COUNT])
+        n = int(counters[_WRITE_COUNT]) - read_count
+        if n == 0:
+            return None
+        start = read_count % self.capacity
+        n = min(n, self.capacity - start)
+        return (
+            read_count,
+            self._analog.array[start:start+n].T,
+            self._digital.array[start:start+n].T,
+        )
+    
+    def consume(self, n: int):
+        self._counters.array[_READ_COUNT] += n
+
+def _run_writer(*,
+    queue: SampleQueue,
+    path,
+    channels: List[Dict[str, Any]],
+    clock_rate: int,
+    output_meta: Optional[Dict[str, Any]],
+    done,
+    stopped,
+    failed,
+):
+    try:
+        with open_writer(path,
+            channels = channels,
+            clock_rate = clock_rate,
+            output_meta = output_meta,
+        ) as writer:
+            while True:
+                span = queue.peek()
+                if span is None:
+                    # check done after finding the queue empty so no samples are missed
+                    if done.is_set() and queue.fill() == 0:
+                        break
+                    time.sleep(0.005)
+                    continue
+                sample_i, analog, digital = span
+                writer.write_block(analog, digital, sample_i)
+                queue.consume(analog.shape[1])
+    except:
+        failed.set()
+        raise
+    finally:
+        stopped.set()
+
+class WriterProcess:
+    """writes sample blocks to a csv or grfb file from a separate process
+        
+        samples are passed to the writer process through a `SampleQueue`
+        """
+    
+    def __init__(self, path, *,
+        channels: List[Dict[str, Any]],
+        clock_rate: int,
+        output_meta: Optional[Dict[str, Any]] = None,
+        failed,
+        buffer_seconds: float = 10,
+    ):
+        """
+            Args:
+                failed: event set if the writer fails, typically RecordState.failed
+                buffer_seconds: size of the queue in seconds of samples, if
+                    the writer falls behind by more than this amount recording fails
+            """
+        num_analog = len([c for c in channels if c['type'] == 'analog'])
+        num_digital = len([c for c in channels if c['type'] == 'digital'])
+        self.queue = SampleQueue(
+            capacity = max(int(clock_rate * buffer_seconds), 1),
+            num_analog = num_analog,
+            num_digital = num_digital,
+        )
+        
+        self.failed = failed
+        self._done = PEvent()
+        self._stopped = PEvent()
+        self._put_timeout = buffer_seconds
+        
+        self._proc = spawn_process(_run_writer,
+            queue = self.queue,
+            path = path,
+            channels = channels,
+            clock_rate = clock_rate,
+            output_meta = output_meta,
+            done = self._done,
+            stopped = self._stopped,
+            failed = self.failed,
+        )
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def check(self):
+        """raises an exception if the writer process has stopped before being closed"""
+        if self._stopped.is_set():
+            raise WriterFailure()
+    
+    def write_block(self, analog: np.ndarray, digital: np.ndarray, sample_i: int):
+        assert sample_i == self.queue.write_count
+        self.check()
+        self.queue.put(analog, digital, timeout=self._put_timeout, consumer_stopped=self._stopped)
+    
+    def close(self, timeout: Optional[float] = None):
+        """waits for all queued samples to be written then stops the writer process
+            
+            Raises:
+                WriterFailure: if the writer is still running after timeout or stopped
+                    before writing every sample
+            """
+        self._done.set()
+        self._proc.join(timeout=timeout)
+        unwritten = self.queue.write_count - self.queue.read_count
+        if self._proc.is_alive():
+            self.failed.set()
+            # the queue is left open since the writer is still reading it, the writer is
+            # terminated at exit
+            raise WriterFailure(f"writer still running after {timeout}s, {unwritten} samples not written")
+        self.queue.close()
+        if unwritten != 0:
+            self.failed.set()
+            raise WriterFailure(f"writer stopped with {unwritten} samples not written")
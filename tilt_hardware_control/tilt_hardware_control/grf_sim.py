@@ -0,0 +1,234 @@
+"""simulated nidaq acquisition for running record_data without hardware
+
+`SimulatedDaq` generates samples for the loadcell channels as numpy blocks,
+`analog_task` and `digital_task` return objects that behave like the nidaqmx tasks
+used by `record_data`. both tasks read from the same simulated clock so sample n of
+the analog task lines up with sample n of the digital task.
+
+force and torque channels are a sine wave with a step while a tilt is active plus
+noise, the tilt_active digital line is high during each tilt and tilt_midpoint is
+pulsed at the midpoint of each tilt. samples can be replayed from a previous
+recording (csv or grfb) instead.
+"""
+
+from typing import List, Dict, Any, Optional, Tuple
+import time
+import random
+
+import numpy as np
+
+from grf_output import load_recording
+
+class SimulatedOverrun(Exception):
+    """raised if samples aren't read fast enough and the simulated nidaq buffer overflows"""
+    pass
+
+class _InStream:
+    def __init__(self, task: '_SimulatedTask'):
+        self._task = task
+    
+    @property
+    def avail_samp_per_chan(self) -> int:
+        return self._task.available()
+
+class _SimulatedTask:
+    def __init__(self, daq: 'SimulatedDaq', *, digital: bool):
+        self._daq = daq
+        self._digital = digital
+        self.read_count = 0
+        self.in_stream = _InStream(self)
+    
+    def start(self):
+        self._daq.start()
+    
+    def available(self) -> int:
+        return self._daq.available(self.read_count)
+    
+    def read(self, samples_per_channel: int, _timeout=None):
+        daq = self._daq
+        start = self.read_count
+        daq.wait_for(start, samples_per_channel, stall = not self._digital)
+        self.read_count += samples_per_channel
+        if self._digital:
+            block = daq.digital_block(start, samples_per_channel)
+        else:
+            block = daq.analog_block(start, samples_per_channel)
+        # emulated nidaqmx behavior with one channel
+        if len(block) == 1:
+            return block[0]
+        return block
+
+class SimulatedDaq:
+    def __init__(self, *,
+        clock_rate: int,
+        analog_headers: List[Dict[str, Any]],
+        digital_headers: List[Dict[str, Any]],
+        buffer_size: Optional[int] = None,
+        realtime: bool = True,
+        batch_size: int = 100,
+        noise: float = 0.005,
+        force_amplitude: float = 0.5,
+        force_frequency: float = 1,
+        tilt_delay: float = 1,
+        tilt_interval: float = 3,
+        tilt_duration: float = 1.5,
+        tilt_response: float = 1,
+        midpoint_pulse: float = 0.002,
+        jitter: float = 0,
+        burst: Optional[Tuple[float, float]] = None,
+        replay: Optional[str] = None,
+        seed: Optional[int] = None,
+    ):
+        """
+            Args:
+                analog_headers: HEADERS entries of the analog channels in read order
+                digital_headers: HEADERS entries of the digital channels in read order
+                buffer_size: samples the simulated nidaq buffer holds,
+                    SimulatedOverrun is raised if the backlog exceeds it
+                realtime: if true samples are produced at clock_rate, otherwise
+                    `batch_size` samples are always available so record_data runs
+                    as fast as possible
+                noise: standard deviation of the noise added to analog channels
+                force_amplitude, force_frequency: sine wave on force and torque channels
+                tilt_delay: seconds before the first tilt starts
+                tilt_interval: seconds between the start of each tilt
+                tilt_duration: seconds tilt_active is high for each tilt
+                tilt_response: step added to force and torque channels during a tilt
+                midpoint_pulse: length in seconds of the tilt_midpoint pulse
+                jitter: mean extra delay in seconds added after each read
+                burst: (period, stall) every `period` seconds a read is delayed
+                    for `stall` seconds so a backlog of samples builds up
+                replay: path to a csv or grfb recording to replay instead of generating
+                    samples, columns are matched by csv header and the recording is looped
+                seed: seed for noise and jitter
+            """
+        self.clock_rate = clock_rate
+        self._analog_headers = analog_headers
+        self._digital_headers = digital_headers
+        self._buffer_size = buffer_size
+        self._realtime = realtime
+        self._batch_size = batch_size
+        self._noise = noise
+        self._force_amplitude = force_amplitude
+        self._force_frequency = force_frequency
+        self._tilt_delay = tilt_delay
+        self._tilt_interval = tilt_interval
+        self._tilt_duration = tilt_duration
+        self._midpoint_pulse = midpoint_pulse
+        self._jitter = jitter
+        self._burst = burst
+        
+        self._rng = np.random.default_rng(seed)
+        self._random = random.Random(seed)
+        self._start_time: Optional[float] = None
+        self._next_burst: Optional[float] = None
+        
+        # force and torque channels get the sine wave and tilt response
+        sensor = np.array([
+            'cal' in h and h['csv'].startswith('sensor')
+            for h in analog_headers
+        ], dtype=float)[:, None]
+        channels = np.arange(len(analog_headers))[:, None]
+        self._offsets = sensor * (channels % 6) * 0.1
+        self._phases = channels * (np.pi / 6)
+        self._sine_gain = sensor * force_amplitude
+        self._tilt_gain = sensor * tilt_response * np.where(channels % 2 == 0, 1, -1)
+        
+        self._replay: Optional[np.ndarray] = None
+        if replay is not None:
+            rec = load_recording(replay)
+            if rec['clock_rate'] is not None and rec['clock_rate'] != clock_rate:
+                print(f"warning: replaying {replay} recorded at {rec['clock_rate']}hz at {clock_rate}hz")
+            if len(rec['np']) == 0:
+                raise ValueError(f"{replay} contains no samples")
+            cols = {name: i for i, name in enumerate(rec['column_names'])}
+            # column of the recording for each analog channel then each digital channel,
+            # -1 for channels not in the recording
+            self._replay_analog = [cols.get(h['csv'], -1) for h in analog_headers]
+            self._replay_digital = [cols.get(h['csv'], -1) for h in digital_headers]
+            # extra zero column for missing channels
+            self._replay = np.concatenate([rec['np'], np.zeros((len(rec['np']), 1))], axis=1)
+    
+    def analog_task(self) -> _SimulatedTask:
+        return _SimulatedTask(self, digital=False)
+    
+    def digital_task(self) -> _SimulatedTask:
+        return _SimulatedTask(self, digital=True)
+    
+    def start(self):
+        if self._start_time is None:
+            self._start_time = time.perf_counter()
+            if self._burst is not None:
+                self._next_burst = self._start_time + self._burst[0]
+    
+    def _produced(self) -> int:
+        """number of samples produced by the simulated clock"""
+        assert self._start_time is not None, "task not started"
+        return int((time.perf_counter() - self._start_time) * self.clock_rate)
+    
+    def available(self, read_count: int) -> int:
+        if not self._realtime:
+            return self._batch_size
+        return self._produced() - read_count
+    
+    def wait_for(self, read_count: int, n: int, *, stall: bool):
+        """waits until samples up to read_count + n have been produced"""
+        if not self._realtime:
+            return
+        
+        if stall:
+            now = time.perf_counter()
+            if self._next_burst is not None and now >= self._next_burst:
+                assert self._burst is not None
+                period, stall_time = self._burst
+                time.sleep(stall_time)
+                self._next_burst = now + period
+            if self._jitter > 0:
+                time.sleep(self._random.expovariate(1 / self._jitter))
+        
+        backlog = self._produced() - read_count
+        if self._buffer_size is not None and backlog > self._buffer_size:
+            raise SimulatedOverrun(f"{backlog} samples waiting, buffer size {self._buffer_size}")
+        if backlog < n:
+            time.sleep((n - backlog) / self.clock_rate)
+    
+    def _tilt_lines(self, t: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """returns (tilt active, tilt midpoint) for sample times `t`"""
+        phase = (t - self._tilt_delay) % self._tilt_interval
+        started = t >= self._tilt_delay
+        active = started & (phase < self._tilt_duration)
+        mid = self._tilt_duration / 2
+        midpoint = started & (phase >= mid) & (phase < mid + self._midpoint_pulse)
+        return active, midpoint
+    
+    def analog_block(self, start: int, n: int) -> np.ndarray:
+        """(analog channels, n) array of samples from sample index `start`"""
+        idx = np.arange(start, start + n)
+        if self._replay is not None:
+            rows = self._replay[idx % len(self._replay)]
+            return rows[:, self._replay_analog].T.copy()
+        
+        t = idx / self.clock_rate
+        active, _ = self._tilt_lines(t)
+        block = self._offsets + self._sine_gain * np.sin(2 * np.pi * self._force_frequency * t + self._phases)
+        block += self._tilt_gain * active
+        if self._noise > 0:
+            block += self._rng.normal(0, self._noise, block.shape)
+        return block
+    
+    def digital_block(self, start: int, n: int) -> np.ndarray:
+        """(digital channels, n) boolean array of samples from sample index `start`"""
+        idx = np.arange(start, start + n)
+        if self._replay is not None:
+            rows = self._replay[idx % len(self._replay)]
+            return rows[:, self._replay_digital].T != 0
+        
+        active, midpoint = self._tilt_lines(idx / self.clock_rate)
+        block = np.zeros((len(self._digital_headers), n), dtype=bool)
+        for i, h in enumerate(self._digital_headers):
+            line = h.get('digital_line', h.get('analog_channel'))
+            if line == 'tilt_active':
+                block[i] = active
+            elif line == 'tilt_midpoint':
+                block[i] = midpoint
+        return block
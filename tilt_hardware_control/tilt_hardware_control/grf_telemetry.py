@@ -0,0 +1,168 @@
+"""acquisition health telemetry for the record process
+
+the record process accumulates statistics for each batch locally and publishes them
+once per interval to counters in shared memory, which the main process summarizes
+into the meta file, and optionally as a line in a jsonl sidecar file
+
+each line of the jsonl file covers one interval
+    time: seconds since recording started
+    sample_i: number of samples recorded
+    batches: number of batches read in the interval
+    samples: number of samples read in the interval
+    read_time_avg, read_time_max: time spent in nidaq reads per batch
+    proc_time_avg, proc_time_max: time spent processing each batch after reading
+    backlog_max: largest number of samples waiting in the nidaq buffer before a read
+    writer_fill: samples waiting to be written to disk
+    writer_fill_max: largest writer fill since recording started
+    writer_backpressure_waits: times the record loop waited for the writer
+    live_dropped: live view messages discarded because the queue was full
+"""
+
+from typing import Dict, Any, Optional
+import json
+import time
+
+from util_multiprocess import SharedArray
+
+# seconds between each publish of the telemetry
+TELEMETRY_INTERVAL = 1
+
+_FIELDS = [
+    'batches',
+    'samples',
+    'read_time',
+    'read_time_max',
+    'proc_time',
+    'proc_time_max',
+    'backlog_max',
+    'nidaq_buffer_size',
+    'writer_fill_max',
+    'writer_capacity',
+    'writer_backpressure_waits',
+    'live_dropped',
+]
+_INDEX = {k: i for i, k in enumerate(_FIELDS)}
+
+def _empty_window() -> Dict[str, float]:
+    return {
+        'batches': 0,
+        'samples': 0,
+        'read_time': 0,
+        'read_time_max': 0,
+        'proc_time': 0,
+        'proc_time_max': 0,
+        'backlog_max': 0,
+        'live_dropped': 0,
+    }
+
+class RecordTelemetry:
+    """shared telemetry counters, `start`, `batch`, `live_dropped`, `flush` and `close`
+        are called from the record process and `summary` from any process
+        """
+    
+    def __init__(self):
+        self._counters = SharedArray((len(_FIELDS),), 'f8')
+        self._window = _empty_window()
+        self._start_time: Optional[float] = None
+        self._last_flush: float = 0
+        self._file: Optional[Any] = None
+    
+    def __getstate__(self):
+        assert self._file is None, "telemetry can not be shared after recording starts"
+        return self.__dict__
+    
+    def start(self, *, path: Optional[str], nidaq_buffer_size: int, writer_capacity: int):
+        counters = self._counters.array
+        counters[_INDEX['nidaq_buffer_size']] = nidaq_buffer_size
+        counters[_INDEX['writer_capacity']] = writer_capacity
+        if path is not None:
+            self._file = open(path, 'w', encoding='utf8', newline='\n')
+        self._start_time = time.perf_counter()
+        self._last_flush = self._start_time
+    
+    def batch(self, *, samples: int, backlog: int, read_time: float, proc_time: float):
+        window = self._window
+        window['batches'] += 1
+        window['samples'] += samples
+        window['read_time'] += read_time
+        window['read_time_max'] = max(window['read_time_max'], read_time)
+        window['proc_time'] += proc_time
+        window['proc_time_max'] = max(window['proc_time_max'], proc_time)
+        window['backlog_max'] = max(window['backlog_max'], backlog)
+    
+    def live_dropped(self):
+        self._window['live_dropped'] += 1
+    
+    def due(self) -> bool:
+        """true if the interval has passed since the last flush"""
+        return time.perf_counter() - self._last_flush >= TELEMETRY_INTERVAL
+    
+    def flush(self, *, sample_i: int, writer_stats: Optional[Dict[str, int]]):
+        """publishes the statistics collected since the last flush
+            
+            Args:
+                writer_stats: `SampleQueue.stats()` of the writer queue if writing to a file
+            """
+        now = time.perf_counter()
+        self._last_flush = now
+        window = self._window
+        self._window = _empty_window()
+        
+        counters = self._counters.array
+        for k in ['batches', 'samples', 'read_time', 'proc_time', 'live_dropped']:
+            counters[_INDEX[k]] += window[k]
+        for k in ['read_time_max', 'proc_time_max', 'backlog_max']:
+            counters[_INDEX[k]] = max(counters[_INDEX[k]], window[k])
+        if writer_stats is not None:
+            counters[_INDEX['writer_fill_max']] = writer_stats['max_fill']
+            counters[_INDEX['writer_backpressure_waits']] = writer_stats['backpressure_waits']
+        
+        if self._file is not None:
+            batches = window['batches']
+            assert self._start_time is not None
+            line = {
+                'time': now - self._start_time,
+                'sample_i': sample_i,
+                'batches': batches,
+                'samples': window['samples'],
+                'read_time_avg': window['read_time'] / batches if batches else None,
+                'read_time_max': window['read_time_max'],
+                'proc_time_avg': window['proc_time'] / batches if batches else None,
+                'proc_time_max': window['proc_time_max'],
+                'backlog_max': window['backlog_max'],
+                'writer_fill': writer_stats['fill'] if writer_stats is not None else None,
+                'writer_fill_max': writer_stats['max_fill'] if writer_stats is not None else None,
+                'writer_backpressure_waits': writer_stats['backpressure_waits'] if writer_stats is not None else None,
+                'live_dropped': window['live_dropped'],
+            }
+            self._file.write(json.dumps(line) + '\n')
+            self._file.flush()
+    
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    def summary(self) -> Dict[str, Any]:
+        """totals and worst cases over the whole recording"""
+        values = {k: float(v) for k, v in zip(_FIELDS, self._counters.array)}
+        batches = values['batches']
+        
+        def fraction(num, denom):
+            return num / denom if denom else None
+        
+        return {
+            'batches': int(batches),
+            'samples': int(values['samples']),
+            'read_time_avg': fraction(values['read_time'], batches),
+            'read_time_max': values['read_time_max'],
+            'proc_time_avg': fraction(values['proc_time'], batches),
+            'proc_time_max': values['proc_time_max'],
+            'backlog_max': int(values['backlog_max']),
+            # how close the nidaq buffer came to overflowing
+            'backlog_max_fraction': fraction(values['backlog_max'], values['nidaq_buffer_size']),
+            'writer_fill_max': int(values['writer_fill_max']),
+            'writer_fill_max_fraction': fraction(values['writer_fill_max'], values['writer_capacity']),
+            'writer_backpressure_waits': int(values['writer_backpressure_waits']),
+            'live_dropped': int(values['live_dropped']),
+        }
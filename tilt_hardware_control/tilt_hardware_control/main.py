@@ -297,7 +297,7 @@ def start_recording(state: RecordState, args, config: 'Config'):
     if args.live:
         record_stop_event.live.enabled = True
         assert not args.live_cal, "can not use both --live and --live-cal at the same time"
-        
+    
     if args.live_cal:
         record_stop_event.live.enabled = True
         record_stop_event.live.calibrated = True
@@ -316,6 +316,8 @@ def start_recording(state: RecordState, args, config: 'Config'):
     
     if args.loadcell_out is not None and not args.overwrite:
         assert not Path(args.loadcell_out).exists(), f"output file {args.loadcell_out} already exists"
+    if args.telemetry_out is not None and not args.overwrite:
+        assert not Path(args.telemetry_out).exists(), f"output file {args.telemetry_out} already exists"
     
     # record_output_extra = {
     #     **output_extra,
@@ -327,6 +329,8 @@ def start_recording(state: RecordState, args, config: 'Config'):
         live_view_seconds=args.live_secs,
         # output_meta=record_output_extra,
         output_meta=None,
+        telemetry_path=args.telemetry_out,
+        mock_options=args.mock_options,
     )
     # wait after starting recording to make sure there is enough time
     # before a tilt to cover an analysis window
@@ -365,6 +369,9 @@ class Config:
     yoked: Optional[bool]
     
     plexon_lib: Optional[Literal['plex', 'opx']]
+    opx_timestamps_only: bool
+    opx_client_spike_filter: bool
+    plexon_process: bool
     classifier: Optional[str]
     
     # full deserialized json from the config file
@@ -425,6 +432,9 @@ def load_config(path: Path, labels_path: Optional[Path]) -> Config:
         config.yoked = None
         config.channels = None
         config.plexon_lib = None
+        config.opx_timestamps_only = False
+        config.opx_client_spike_filter = False
+        config.plexon_process = False
     elif mode == 'closed_loop':
         config.baseline = data['baseline']
         config.yoked = data['yoked']
@@ -432,6 +442,12 @@ def load_config(path: Path, labels_path: Optional[Path]) -> Config:
         assert type(config.baseline) == bool
         assert type(config.yoked) == bool
         assert config.plexon_lib in ['plex', 'opx']
+        config.opx_timestamps_only = data.get('opx_timestamps_only', False)
+        assert type(config.opx_timestamps_only) == bool
+        config.opx_client_spike_filter = data.get('opx_client_spike_filter', False)
+        assert type(config.opx_client_spike_filter) == bool
+        config.plexon_process = data.get('plexon_process', False)
+        assert type(config.plexon_process) == bool
         config.classifier = data.get('classifier', 'psth')
         
         if labels_path is not None:
@@ -496,6 +512,8 @@ def parse_args_config():
     
     parser.add_argument('--meta-out',
         help='output path for generated meta file')
+    parser.add_argument('--telemetry-out',
+        help='output path for recording telemetry jsonl file')
     parser.add_argument('--template-in',
         help='input path for template')
     parser.add_argument('--template-out',
@@ -505,6 +523,9 @@ def parse_args_config():
         help=argparse.SUPPRESS)
     parser.add_argument('--mock', action='store_true',
         help=argparse.SUPPRESS)
+    # json object of grf_sim.SimulatedDaq options used with --mock
+    parser.add_argument('--mock-options', type=json.loads,
+        help=argparse.SUPPRESS)
     
     if config_path is not None:
         raw_args = copy(sys.argv[1:])
@@ -563,6 +584,8 @@ def main():
     
     args.events_out = auto_path(args.events_out, "_events.json")
     
+    args.telemetry_out = auto_path(args.telemetry_out, "_telemetry.jsonl")
+    
     args.template_out = auto_path(args.template_out, "_template.json")
     if args.template_out is not None:
         assert args.meta_out is not None and args.events_out is not None, "Must output meta and events file to automatically generate a template."
@@ -571,6 +594,7 @@ def main():
     # hide unused dev flags
     dev_flags = [
         'mock',
+        'mock_options',
         'retry',
         'no_end_prompt',
     ]
@@ -629,7 +653,8 @@ def main():
         'tilt_sequence': tilt_sequence,
     }
     
-    record_state = RecordState()
+    # keep enough samples for the full live view window
+    record_state = RecordState(analog_history = max(30000, config.clock_rate * args.live_secs))
     start_recording(record_state, args, config)
     
     if mode == 'monitor':
@@ -704,6 +729,15 @@ def main():
                 else:
                     grf_file_hash = None
                 output_extra['output_files'][fpath.name] = grf_file_hash
+            
+            output_extra['recording_telemetry'] = record_state.telemetry.summary()
+            if args.telemetry_out is not None:
+                fpath = Path(args.telemetry_out)
+                if fpath.exists():
+                    file_hash = hash_file(fpath)
+                else:
+                    file_hash = None
+                output_extra['output_files'][fpath.name] = file_hash
         
         def after_platform_close():
             if args.events_out is not None:
@@ -770,6 +804,9 @@ def main():
             channel_dict = config.channels,
             mock = mock,
             pyopx = config.plexon_lib == 'opx',
+            opx_timestamps_only = config.opx_timestamps_only,
+            opx_client_spike_filter = config.opx_client_spike_filter,
+            event_process = config.plexon_process,
             after_tilt_delay = config.after_tilt_delay,
             collect_events = collect_events,
             reward_enabled = config.reward,
@@ -6,11 +6,13 @@ from contextlib import ExitStack, AbstractContextManager
 from pathlib import Path
 import json
 
+import numpy as np
+
 from classifier import Classifier
 from motor_control import MotorControl, SerialMotorOutputWrapper
 from util_nidaq import line_wait
 from event_source import Event, SpikeEvent, TiltEvent, StimEvent, UnknownEvent
-from event_source import Source, MockSource, OpxSource, PyPlexSource
+from event_source import Source, EventBatch, MockSource, OpxSource, PyPlexSource, ProcessSource
 from grf_data import RecordState
 from stimulation import TiltStimulation
 
@@ -25,6 +27,9 @@ class PsthTiltPlatform(AbstractContextManager):
             channel_dict,
             mock: bool = False,
             pyopx: bool = True,
+            opx_timestamps_only: bool = False,
+            opx_client_spike_filter: bool = False,
+            event_process: bool = False,
             after_tilt_delay: float,
             collect_events: bool,
             reward_enabled: bool,
@@ -39,6 +44,7 @@ class PsthTiltPlatform(AbstractContextManager):
         """
             Args:
                 collect_events: if true events will be collected from plexon
+                opx_client_spike_filter: drop spikes of units not in channel_dict when they are read from plexon
                 tilt_duration: if not None assumes the tilt lasts the specified duration
                     instead of waiting for the tilt end signal
             """
@@ -71,10 +77,20 @@ class PsthTiltPlatform(AbstractContextManager):
         self.event_source: Source
         if mock or classifier is None:
             self.event_source = MockSource(1, 1)
-        elif pyopx:
-            self.event_source = OpxSource()
         else:
-            self.event_source = PyPlexSource()
+            if pyopx:
+                source_type = OpxSource
+                source_kwargs: Dict[str, Any] = {'timestamps_only': opx_timestamps_only}
+                if opx_client_spike_filter:
+                    source_kwargs['channels'] = channel_dict
+            else:
+                source_type = PyPlexSource
+                source_kwargs = {}
+            
+            if event_process:
+                self.event_source = ProcessSource(source_type, **source_kwargs)
+            else:
+                self.event_source = source_type(**source_kwargs)
         
         # channel_dict = {
         #     1: [1], 2: [1,2], 3: [1,2], 4: [1,2],
@@ -86,6 +102,13 @@ class PsthTiltPlatform(AbstractContextManager):
         # }
         # { channel => [Unit] }
         self.channel_dict = channel_dict
+        # (channel << 16 | unit) -> classifier channel name, for the units in channel_dict
+        self._unit_names: Dict[int, str] = {
+            chan << 16 | unit: f"{chan:0>4}_{unit:0>4}"
+            for chan, units in (channel_dict or {}).items()
+            for unit in units
+        }
+        self._relevent_units = np.array(list(self._unit_names), dtype=np.uint32)
         self._post_time = post_time
         self._post_time_ms = post_time / 1000
         self.baseline_recording = baseline_recording
@@ -122,6 +145,9 @@ class PsthTiltPlatform(AbstractContextManager):
             'local_events': [],
             'warnings': [],
             'got_response': None,
+            # summary of each drain of the plexon backlog
+            'flushes': [],
+            'event_delivery': None,
             'delay': None,
             'decoder_result': None,
             'decoder_result_source': None,
@@ -164,6 +190,25 @@ class PsthTiltPlatform(AbstractContextManager):
         if self.event_callback is not None:
             self.event_callback(rec)
     
+    def _add_batch_to_record(self, batch: EventBatch, *, ignored=None, relevent=None):
+        """
+            Args:
+                relevent: a value for all events or a bool array with a value for each event
+            """
+        if self.event_callback is not None:
+            indices = np.arange(len(batch))
+        else:
+            # only tilt events are kept in the tilt record, skip creating the others
+            indices = np.flatnonzero(batch.kind == EventBatch.TILT)
+        
+        if isinstance(relevent, np.ndarray):
+            relevent_list = relevent[indices].tolist()
+        else:
+            relevent_list = [relevent] * len(indices)
+        
+        for evt, is_relevent in zip(batch[indices].events(), relevent_list):
+            self._add_event_to_record(evt, ignored=ignored, relevent=is_relevent)
+    
     def _add_local_event(self, event_type, extra = None):
         assert self._tilt_record is not None
         if extra is None:
@@ -188,46 +233,56 @@ class PsthTiltPlatform(AbstractContextManager):
         found_event = False
         collected_ts = False
         
+        self.event_source.delivery_stats.reset()
+        
         wait_start_time = time.perf_counter()
         while True:
-            evt: Optional[Event] = self.event_source.next_event()
-            if evt is not None:
-                if isinstance(evt, TiltEvent):
-                    tilt_time: float = time.perf_counter()
-                    self._add_local_event('recieve_tilt_remote')
-                    found_event = True
-                    self.classifier.event(tilt_name, evt.timestamp)
-                    self._add_event_to_record(evt, relevent=True)
-                    break
-                self._add_event_to_record(evt, relevent=False)
+            # block until data arrives or the tilt wait times out
+            wait_remaining = wait_start_time + WAIT_TIMEOUT - time.perf_counter()
+            batch = self.event_source.next_batch(timeout = wait_remaining)
+            tilts = np.flatnonzero(batch.kind == EventBatch.TILT)
+            if len(tilts):
+                tilt_i = tilts[0]
+                tilt_time: float = time.perf_counter()
+                self._add_local_event('recieve_tilt_remote')
+                found_event = True
+                self._add_batch_to_record(batch[:tilt_i], relevent=False)
+                self.classifier.event(event_type=tilt_name, timestamp=float(batch.timestamp[tilt_i]))
+                self._add_batch_to_record(batch[tilt_i:tilt_i+1], relevent=True)
+                # events after the tilt in the same batch are handled below
+                batch = batch[tilt_i+1:]
+                break
+            self._add_batch_to_record(batch, relevent=False)
             if time.perf_counter() - wait_start_time > WAIT_TIMEOUT:
                 raise TiltWaitTimeout()
         
         while True:
-            evt = self.event_source.next_event()
+            unit_keys = batch.channel.astype(np.uint32) << 16 | batch.unit
+            is_relevent = (batch.kind == EventBatch.SPIKE) & np.isin(unit_keys, self._relevent_units)
+            if is_relevent.any():
+                self.classifier.spike_batch(
+                    [self._unit_names[k] for k in unit_keys[is_relevent].tolist()],
+                    batch.timestamp[is_relevent].tolist(),
+                )
+                collected_ts = True
             
-            if evt is not None:
-                if isinstance(evt, SpikeEvent):
-                    is_relevent = evt.unit in self.channel_dict.get(evt.channel, [])
-                    if is_relevent:
-                        self.classifier.spike(evt.channel, evt.unit, evt.timestamp)
-                        collected_ts = True
-                elif isinstance(evt, TiltEvent):
-                    warn_str = "WARNING: recieved a second tilt event"
-                    print(warn_str)
-                    self._tilt_record['warnings'].append(warn_str)
-                    is_relevent = False
-                else:
-                    is_relevent = False
-                
-                self._add_event_to_record(evt, relevent=is_relevent)
+            for _ in range(np.count_nonzero(batch.kind == EventBatch.TILT)):
+                warn_str = "WARNING: recieved a second tilt event"
+                print(warn_str)
+                self._tilt_record['warnings'].append(warn_str)
+            
+            self._add_batch_to_record(batch, relevent=is_relevent)
             
             if secondary_tilt_time is not None:
-                if time.perf_counter() - secondary_tilt_time >= self._post_time_ms:
-                    break
+                collect_end = secondary_tilt_time + self._post_time_ms
             else:
-                if time.perf_counter() - tilt_time >= self._post_time_ms:
-                    break
+                collect_end = tilt_time + self._post_time_ms
+            collect_remaining = collect_end - time.perf_counter()
+            if collect_remaining <= 0:
+                break
+            
+            # wait no longer than the end of the collection window
+            batch = self.event_source.next_batch(timeout = collect_remaining)
         
         print('found event and collected ts')
         if tilt_time is not None:
@@ -243,6 +298,8 @@ class PsthTiltPlatform(AbstractContextManager):
         
         got_response = found_event and collected_ts
         self._tilt_record['got_response'] = got_response
+        # time from the source receiving data to it being handled here
+        self._tilt_record['event_delivery'] = self.event_source.delivery_stats.summary()
         
         return {
             'got_response': got_response,
@@ -252,13 +309,16 @@ class PsthTiltPlatform(AbstractContextManager):
         self._init_record()
         assert self._tilt_record is not None
         tilt_record = self._tilt_record
-        add_event_to_record = self._add_event_to_record
         
         def flush_events():
             if self.collect_events:
-                res = self.event_source.clear()
-                for event in res:
-                    add_event_to_record(event, ignored=True)
+                res, drain_info = self.event_source.drain()
+                tilt_record['flushes'].append(drain_info)
+                if not drain_info['complete']:
+                    warn_str = f"WARNING: plexon backlog not fully drained after {drain_info['duration']:.3f}s"
+                    print(warn_str)
+                    tilt_record['warnings'].append(warn_str)
+                self._add_batch_to_record(res, ignored=True)
         
         self._tilt_record['tilt_name'] = tilt_name
         
@@ -286,7 +346,9 @@ class PsthTiltPlatform(AbstractContextManager):
         else:
             if self.tilt_duration is None:
                 if not isinstance(self.motor, SerialMotorOutputWrapper):
-                    self.record_state.digital_lines['tilt_active'].wait_true(timeout=WAIT_TIMEOUT)
+                    edge_time = self.record_state.digital_lines['tilt_active'].wait_true(timeout=WAIT_TIMEOUT)
+                    # time of the rising edge from the loadcell acquisition clock
+                    self._add_local_event('tilt_active', {'clock_time': edge_time})
             got_response = False
         
         if not self.baseline_recording:
@@ -335,14 +397,16 @@ class PsthTiltPlatform(AbstractContextManager):
         
         # wait for tilt to finish
         if self.tilt_duration is None:
+            finish_extra = {}
             if isinstance(self.motor, SerialMotorOutputWrapper):
                 tilt_res = self.motor.wait_for_tilt_finish()
                 # from pprint import pprint
                 # pprint(tilt_res)
             elif not self.mock:
                 # line_wait("Dev4/port2/line3", False)
-                self.record_state.digital_lines['tilt_active'].wait_false(timeout=WAIT_TIMEOUT)
-            self._add_local_event('tilt_finish')
+                edge_time = self.record_state.digital_lines['tilt_active'].wait_false(timeout=WAIT_TIMEOUT)
+                finish_extra['clock_time'] = edge_time
+            self._add_local_event('tilt_finish', finish_extra)
         else:
             # calculate additional time to sleep
             dur_remaining = self.tilt_duration - (time.perf_counter() - send_tilt_time)
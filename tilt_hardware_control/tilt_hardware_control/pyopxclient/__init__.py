@@ -20,6 +20,7 @@
 #      parts of the API.
 
 from .pyopxclientlib import PyOPXClient, OPX_GlobalParams, OPX_DataBlock, OPX_FilterInfo
+from .pyopxclientlib import OPX_DATA_BLOCK_DTYPE, NewDataArrays, NewTimestampsArrays
 from .pyopxclientlib import SPIKE_TYPE, EVENT_TYPE, CONTINUOUS_TYPE, OTHER_TYPE
 from .pyopxclientlib import MAX_WF_LENGTH
 from .pyopxclientlib import OPXSYSTEM_INVALID, OPXSYSTEM_TESTADC, OPXSYSTEM_AD64, OPXSYSTEM_DIGIAMP, OPXSYSTEM_DHSDIGIAMP
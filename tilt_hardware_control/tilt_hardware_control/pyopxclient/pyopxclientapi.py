@@ -170,6 +170,28 @@ class PyOPXClientAPI:
         self.last_result = result
         return new_data
 
+    def get_new_data_arrays(self, timestamps_only = False):
+        """
+        Get a batch of online client data as NumPy arrays instead of lists.
+
+        The arrays are views into the client's buffers and are only valid until the next call
+        to get_new_data() or get_new_data_arrays().
+
+        Args:
+            timestamps_only - If False, returns spike and event information along with spike waveforms and continuous data
+                              If True, returns spike and event information only
+
+        Returns:
+            new_data - named tuple of arrays, see PyOPXClient.get_new_data_arrays() and PyOPXClient.get_new_timestamps_arrays()
+                both include .source_num_or_type, .timestamp, .channel and .unit
+        """
+        if timestamps_only:
+            result, new_data = self.opx_client.get_new_timestamps_arrays()
+        else:
+            result, new_data = self.opx_client.get_new_data_arrays()
+        self.last_result = result
+        return new_data
+
     def get_source_info(self, source_name_or_number):
         """
         Given a source number or name, return basic info about that source
@@ -255,6 +277,21 @@ class PyOPXClientAPI:
         if type(source_name_or_number) is int:
             self.last_result = self.opx_client.exclude_source_by_number(source_name_or_number)
 
+    def exclude_source_type(self, source_type):
+        """
+        Excludes all sources of the given type from the data sent to this client.
+        
+        Args:
+            source_type - SPIKE_TYPE, CONTINUOUS_TYPE, EVENT_TYPE, or OTHER_TYPE
+        
+        Returns:
+            None
+        """
+        self.last_result = self.opx_client.exclude_all_sources_of_type(source_type)
+        
+        if self.last_result != 0:
+            print(f'exclude failed? type {source_type}')
+
     def include_source(self, source_name_or_number):
         """
         Includes the given source with the data sent to this client.
@@ -1,10 +1,14 @@
 
-from typing import List, Optional, Any
-from multiprocessing import Value, Array, Event
-from ctypes import c_bool, c_double, c_size_t
+from typing import List, Optional, Any, Tuple, Dict
+from multiprocessing import Value, Event
+from multiprocessing.shared_memory import SharedMemory
+from ctypes import c_bool
 import atexit
 from multiprocessing import Process, RLock, Lock
 import traceback
+import time
+
+import numpy as np
 
 def _print_exc(func, *args, **kwargs):
     try:
@@ -20,16 +24,80 @@ def spawn_process(func, *args, **kwargs) -> Process:
     proc.start()
     return proc
 
+class SharedArray:
+    """numpy array in shared memory that can be passed to spawned processes
+        
+        the process that creates the array owns the shared memory and unlinks it on close
+        """
+    
+    def __init__(self, shape: Tuple[int, ...], dtype: Any):
+        self._shape = tuple(shape)
+        self._dtype = np.dtype(dtype)
+        size = int(np.prod(self._shape)) * self._dtype.itemsize
+        self._shm = SharedMemory(create=True, size=max(size, 1))
+        self._owner = True
+        self._closed = False
+        self.array: np.ndarray = np.ndarray(self._shape, dtype=self._dtype, buffer=self._shm.buf)
+        self.array.fill(0)
+        # unlink the shared memory if it isn't closed explicitly
+        atexit.register(self.close)
+    
+    def __getstate__(self):
+        return {
+            'name': self._shm.name,
+            'shape': self._shape,
+            'dtype': self._dtype.str,
+        }
+    
+    def __setstate__(self, state):
+        self._shape = state['shape']
+        self._dtype = np.dtype(state['dtype'])
+        self._shm = SharedMemory(name=state['name'])
+        self._owner = False
+        self._closed = False
+        self.array = np.ndarray(self._shape, dtype=self._dtype, buffer=self._shm.buf)
+    
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        # the array must be released before the shared memory can be closed
+        del self.array
+        try:
+            self._shm.close()
+        except BufferError:
+            # views of the array are still referenced, the memory is released when the process exits
+            pass
+        if self._owner:
+            self._shm.unlink()
+
 class Timeout(Exception):
     def __init__(self):
         Exception.__init__(self)
 
+# DigitalLine info indexes
+_LINE_EDGE_COUNT = 0
+_LINE_STATE = 1
+_LINE_CLOCK_RATE = 2
+
 class DigitalLine:
-    def __init__(self):
+    """digital line state shared between processes
+        
+        lines updated with `write_block` keep a log of the sample index of each
+        edge so waiters can get the time of an edge from the acquisition clock
+        instead of the time the batch containing it was processed
+        """
+    
+    def __init__(self, *, max_edges: int = 4096):
         # self.value = Value(c_bool)
         self._true_event = Event()
         self._false_event = Event()
         self._false_event.set()
+        
+        self._max_edges = max_edges
+        # ring of (sample index, new state) for each edge
+        self._edges = SharedArray((max_edges, 2), 'i8')
+        self._info = SharedArray((3,), 'i8')
     
     def set_true(self):
         self._false_event.clear()
@@ -39,50 +107,313 @@ class DigitalLine:
         self._true_event.clear()
         self._false_event.set()
     
-    def wait_true(self, timeout=None):
+    @property
+    def edge_count(self) -> int:
+        """total number of edges logged"""
+        return int(self._info.array[_LINE_EDGE_COUNT])
+    
+    def write_block(self, values: np.ndarray, first_sample: int, clock_rate: int):
+        """logs edges in a batch of samples and updates the line state
+            
+            Args:
+                values: boolean value of the line for each sample in the batch
+                first_sample: sample index of the first value
+                clock_rate: acquisition sample rate used to convert sample indexes to times
+            """
+        info = self._info.array
+        info[_LINE_CLOCK_RATE] = clock_rate
+        if len(values) == 0:
+            return
+        values = np.asarray(values, dtype=bool)
+        prev = bool(info[_LINE_STATE])
+        
+        # index of samples that differ from the previous sample
+        change = np.flatnonzero(values[1:] != values[:-1]) + 1
+        if values[0] != prev:
+            change = np.concatenate(([0], change))
+        
+        edges = self._edges.array
+        edge_count = int(info[_LINE_EDGE_COUNT])
+        for i in change[-self._max_edges:]:
+            row = edges[edge_count % self._max_edges]
+            row[0] = first_sample + i
+            row[1] = values[i]
+            edge_count += 1
+        # publish the edges before updating the state so waiters will find them
+        info[_LINE_EDGE_COUNT] = edge_count
+        
+        state = bool(values[-1])
+        if state != prev:
+            info[_LINE_STATE] = state
+            if state:
+                self.set_true()
+            else:
+                self.set_false()
+    
+    def edges(self, since: int = 0) -> np.ndarray:
+        """returns a (edges, 2) array of (sample index, new state) logged after the
+            first `since` edges, only the most recent `max_edges` edges are kept
+            """
+        edge_count = self.edge_count
+        since = max(since, edge_count - self._max_edges)
+        idx = np.arange(since, edge_count) % self._max_edges
+        return self._edges.array[idx]
+    
+    def last_edge_time(self, state: bool) -> Optional[float]:
+        """time in seconds from the start of acquisition of the most recent edge
+            to `state`, None if no such edge has been logged
+            """
+        clock_rate = int(self._info.array[_LINE_CLOCK_RATE])
+        if clock_rate == 0:
+            return None
+        edges = self.edges()
+        matching = edges[edges[:, 1] == int(state)]
+        if len(matching) == 0:
+            return None
+        return int(matching[-1, 0]) / clock_rate
+    
+    def wait_true(self, timeout=None) -> Optional[float]:
+        """waits for the line to be true
+            
+            Returns:
+                the time of the rising edge from the acquisition clock if known
+            """
         res = self._true_event.wait(timeout=timeout)
         if res is not True:
             raise Timeout()
+        return self.last_edge_time(True)
     
-    def wait_false(self, timeout=None):
+    def wait_false(self, timeout=None) -> Optional[float]:
+        """waits for the line to be false
+            
+            Returns:
+                the time of the falling edge from the acquisition clock if known
+            """
         res = self._false_event.wait(timeout=timeout)
         if res is not True:
             raise Timeout()
+        return self.last_edge_time(False)
+
+# AnalogRing counter indexes
+_RING_SEQ = 0
+_RING_WRITE_COUNT = 1
+
+class AnalogRing:
+    """ring buffer of samples from multiple analog channels in shared memory
+        
+        there must be only one writer. instead of a lock the writer increments a
+        sequence counter (seqlock) before and after each write, readers use it to
+        get a consistent write count and to detect data overwritten while reading
+        
+        every sample is stored twice so the latest `max_len` samples are always
+        contiguous and can be returned as a view without copying
+        """
+    
+    def __init__(self, *, channels: List[str], max_len: int):
+        self.channels = list(channels)
+        self._index = {k: i for i, k in enumerate(self.channels)}
+        self.max_len = max_len
+        # extra space so a view of the latest samples stays valid for a while
+        self._capacity = max_len * 2
+        self._buffer = SharedArray((len(self.channels), self._capacity * 2), '<f8')
+        self._counters = SharedArray((2,), 'i8')
+    
+    def close(self):
+        self._buffer.close()
+        self._counters.close()
+    
+    def index(self, channel: str) -> int:
+        """row of `channel` in blocks written to and read from the ring"""
+        return self._index[channel]
+    
+    @property
+    def write_count(self) -> int:
+        """total number of samples written per channel"""
+        return int(self._counters.array[_RING_WRITE_COUNT])
+    
+    def write_block(self, block: np.ndarray):
+        """
+            Args:
+                block: (channels, samples) array
+            """
+        assert block.shape[0] == len(self.channels)
+        counters = self._counters.array
+        buffer = self._buffer.array
+        capacity = self._capacity
+        
+        write_count = int(counters[_RING_WRITE_COUNT])
+        n = block.shape[1]
+        if n > capacity:
+            # older samples would be overwritten in the same write
+            write_count += n - capacity
+            block = block[:, -capacity:]
+            n = capacity
+        
+        # odd sequence number while the write is in progress
+        counters[_RING_SEQ] += 1
+        start = write_count % capacity
+        first = min(n, capacity - start)
+        buffer[:, start:start+first] = block[:, :first]
+        buffer[:, capacity+start:capacity+start+first] = block[:, :first]
+        if first < n:
+            buffer[:, :n-first] = block[:, first:]
+            buffer[:, capacity:capacity+n-first] = block[:, first:]
+        counters[_RING_WRITE_COUNT] = write_count + n
+        counters[_RING_SEQ] += 1
+    
+    def _snapshot(self) -> Tuple[int, int]:
+        """returns (sequence number, write count) while no write is in progress"""
+        counters = self._counters.array
+        while True:
+            seq = int(counters[_RING_SEQ])
+            if seq % 2 == 1:
+                time.sleep(0)
+                continue
+            write_count = int(counters[_RING_WRITE_COUNT])
+            if int(counters[_RING_SEQ]) == seq:
+                return seq, write_count
+    
+    def read_latest(self, n: int) -> Tuple[int, np.ndarray]:
+        """returns (write count, view) with a (channels, samples) view of up to the latest
+            `n` samples, `n` is limited to `max_len`
+            
+            the view is not copied and remains valid until `max_len` more samples
+            are written, use `copy_latest` if that can't be guaranteed
+            """
+        n = min(n, self.max_len)
+        _, write_count = self._snapshot()
+        n = min(n, write_count)
+        stop = write_count % self._capacity + self._capacity
+        return write_count, self._buffer.array[:, stop-n:stop]
+    
+    def copy_latest(self, n: int, out: Optional[np.ndarray] = None) -> Tuple[int, np.ndarray]:
+        """same as `read_latest` but returns a copy, retrying if the samples were
+            overwritten while being copied
+            
+            Args:
+                out: (channels, n) array to copy into instead of allocating a new one
+            """
+        while True:
+            write_count, view = self.read_latest(n)
+            if out is None:
+                result = view.copy()
+            else:
+                result = out[:, :view.shape[1]]
+                result[...] = view
+            _, new_write_count = self._snapshot()
+            # samples are overwritten once the writer wraps around to them
+            if new_write_count - write_count <= self._capacity - view.shape[1]:
+                return write_count, result
 
-class AnalogChannel:
-    def __init__(self, *, max_len: int, lock: Optional[Lock] = None):
-        self._max_len = max_len
-        
-        if lock is None:
-            lock = Lock()
-        self._lock = lock
-        
-        self._buffer = Array(c_double, self._max_len, lock=False)
-        self._write_index = Value(c_size_t, lock=False)
-        self._full = Value(c_bool, lock=False)
-    
-    def _write_sample(self, val: float):
-        if self._write_index.value == self._max_len:
-            self._full.value = True
-            self._write_index.value = 0
-        self._buffer[self._write_index.value] = val
-        self._write_index.value += 1
-    
-    def write_sample(self, val: float):
-        with self._lock:
-            self._write_sample(val)
-    
-    def write_samples(self, vals: List[float]):
-        with self._lock:
-            for val in vals:
-                self._write_sample(val)
-    
-    def read(self) -> List[float]:
-        with self._lock:
-            full = self._full.value
-            idx = self._write_index.value
-            buffer = self._buffer
-            # indexing creates a copy of the data as a list
-            if full:
-                return buffer[idx:] + buffer[:idx]
-            return buffer[:idx]
+class EventRing:
+    """ring buffer of event records in shared memory
+        
+        records are stored as one array per field. there must be only one writer, it
+        uses the same seqlock as `AnalogRing`. each reader keeps its own cursor, the
+        write count it has read up to, and is told how many records were overwritten
+        before it read them
+        """
+    
+    def __init__(self, *, fields: List[Tuple[str, Any]], capacity: int):
+        """
+            Args:
+                fields: (name, dtype) of each record field
+                capacity: number of records kept before the oldest is overwritten
+            """
+        self.capacity = capacity
+        self._fields = {
+            name: SharedArray((capacity,), dtype)
+            for name, dtype in fields
+        }
+        self._counters = SharedArray((2,), 'i8')
+        # time.perf_counter() of the last write
+        self._write_time = SharedArray((1,), '<f8')
+    
+    def close(self):
+        for field in self._fields.values():
+            field.close()
+        self._counters.close()
+        self._write_time.close()
+    
+    @property
+    def write_count(self) -> int:
+        """total number of records written"""
+        return int(self._counters.array[_RING_WRITE_COUNT])
+    
+    @property
+    def last_write_time(self) -> float:
+        return float(self._write_time.array[0])
+    
+    def write(self, **columns: np.ndarray):
+        """writes records given as one array per field, all fields must be given"""
+        assert columns.keys() == self._fields.keys()
+        n = len(next(iter(columns.values())))
+        if n == 0:
+            return
+        counters = self._counters.array
+        capacity = self.capacity
+        
+        write_count = int(counters[_RING_WRITE_COUNT])
+        skip = max(0, n - capacity)
+        if skip:
+            # older records would be overwritten in the same write
+            write_count += skip
+            n -= skip
+        
+        # odd sequence number while the write is in progress
+        counters[_RING_SEQ] += 1
+        start = write_count % capacity
+        first = min(n, capacity - start)
+        for name, values in columns.items():
+            values = values[skip:]
+            array = self._fields[name].array
+            array[start:start+first] = values[:first]
+            if first < n:
+                array[:n-first] = values[first:]
+        counters[_RING_WRITE_COUNT] = write_count + n
+        self._write_time.array[0] = time.perf_counter()
+        counters[_RING_SEQ] += 1
+    
+    def _snapshot(self) -> Tuple[int, int]:
+        """returns (sequence number, write count) while no write is in progress"""
+        counters = self._counters.array
+        while True:
+            seq = int(counters[_RING_SEQ])
+            if seq % 2 == 1:
+                time.sleep(0)
+                continue
+            write_count = int(counters[_RING_WRITE_COUNT])
+            if int(counters[_RING_SEQ]) == seq:
+                return seq, write_count
+    
+    def read(self, cursor: int) -> Tuple[Dict[str, np.ndarray], int, int]:
+        """copies the records written since `cursor`
+            
+            Returns:
+                (records, cursor, lost) with a dict of arrays with one element per record,
+                the cursor to pass to the next read and the number of records that were
+                overwritten before they could be read
+            """
+        _, write_count = self._snapshot()
+        capacity = self.capacity
+        start = max(cursor, write_count - capacity)
+        n = write_count - start
+        
+        begin = start % capacity
+        first = min(n, capacity - begin)
+        records = {}
+        for name, field in self._fields.items():
+            array = field.array
+            if first < n:
+                records[name] = np.concatenate([array[begin:], array[:n-first]])
+            else:
+                records[name] = array[begin:begin+n].copy()
+        
+        # records are overwritten once the writer wraps around to them
+        _, new_write_count = self._snapshot()
+        overwritten = min(n, max(0, new_write_count - capacity - start))
+        if overwritten:
+            records = {name: values[overwritten:] for name, values in records.items()}
+        
+        lost = start - cursor + overwritten
+        return records, write_count, lost
@@ -4,6 +4,7 @@ import socket
 import json
 import os
 import time
+import select
 
 from ..plexon import PlexonEvent
 
@@ -81,6 +82,14 @@ class DataBridge:
         
         self._soc = soc
     
+    def wait_for_data(self, timeout: float) -> bool:
+        """blocks until the socket is readable or timeout seconds pass, returns False if the wait timed out"""
+        if self._soc is None:
+            # let get_data handle reconnecting
+            return True
+        readable, _, _ = select.select([self._soc], [], [], timeout)
+        return bool(readable)
+    
     def get_raw(self):
         if self._soc is None:
             x = b''
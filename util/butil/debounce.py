@@ -1,8 +1,10 @@
 
-from typing import Union, Optional
+from typing import Union, Optional, List, Tuple
 from numbers import Real
 from time import perf_counter
 
+import numpy as np
+
 class Edge:
     rising: bool = False
     falling: bool = False
@@ -53,3 +55,37 @@ class Debounce:
             self._is_high = False
         
         return edge
+    
+    def sample_block(self, timestamps: np.ndarray, values: np.ndarray) -> List[Tuple[float, Edge]]:
+        """same as calling sample for each value in order but only returns the edges
+            
+            returns (timestamp, edge) for each sample that produced an edge
+            """
+        # indexes of samples that would change the state from high or from low
+        below = np.flatnonzero(values < self._threshold)
+        above = np.flatnonzero(values >= self._high_threshold)
+        
+        out = []
+        i = 0
+        while True:
+            candidates = below if self._is_high else above
+            candidates = candidates[np.searchsorted(candidates, i):]
+            if self._last_state_change is not None:
+                # same comparison as sample so the result is identical
+                candidates = candidates[timestamps[candidates] - self._last_state_change > self._delay]
+            if len(candidates) == 0:
+                return out
+            
+            i = int(candidates[0])
+            now = float(timestamps[i])
+            self._last_state_change = now
+            
+            edge = Edge()
+            if self._is_high:
+                edge.falling = True
+                self._is_high = False
+            else:
+                edge.rising = True
+                self._is_high = True
+            out.append((now, edge))
+            i += 1
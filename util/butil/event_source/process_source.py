@@ -1,48 +1,117 @@
 
+from typing import Optional, Dict, Any, Tuple
 import time
-from multiprocessing import Process, Queue as PQueue
-from queue import Empty
+from multiprocessing import Process, Event as PEvent
+
+import numpy as np
+
+from .shm_ring import EventRing, RING_CAPACITY
+
+# maximum time in seconds the source process blocks waiting for new data,
+# sources without wait_for_data are polled every millisecond instead
+SOURCE_WAIT_TIMEOUT = 0.1
 
 class SourceProcessError(Exception):
     pass
 
+class DeliveryStats:
+    """time from a source process noticing new data to the data being returned by the proxy
+    
+    uses time.perf_counter values from both processes, which share the system wide monotonic clock
+    """
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.batches: int = 0
+        self.events: int = 0
+        self.latency_sum: float = 0
+        self.latency_max: float = 0
+    
+    def add(self, wake_time: float, num_events: int):
+        latency = time.perf_counter() - wake_time
+        self.batches += 1
+        self.events += num_events
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+    
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'batches': self.batches,
+            'events': self.events,
+            'latency_mean': self.latency_sum / self.batches if self.batches else None,
+            'latency_max': self.latency_max if self.batches else None,
+        }
+
 class _SourceProcess(Process):
-    def __init__(self, init_func):
-        self._queue = PQueue()
+    def __init__(self, init_func, *, capacity: int = RING_CAPACITY):
+        self.ring = EventRing(capacity)
+        self.failed = PEvent()
         self._init_func = init_func
         super().__init__(daemon=True)
     
     def run(self):
+        # imported here since butil.plexon imports this module
+        from ..plexon import events_to_records
         try:
             source = self._init_func()
+            wait_for_data = getattr(source, 'wait_for_data', None)
+            get_records = getattr(source, 'get_records', None)
             
             while True:
-                time.sleep(0.001)
-                data = list(source.get_data())
-                if not data:
+                if wait_for_data is None:
+                    time.sleep(0.001)
+                elif not wait_for_data(SOURCE_WAIT_TIMEOUT):
                     continue
-                self._queue.put(data)
+                wake_time = time.perf_counter()
+                if get_records is not None:
+                    records, samples = get_records()
+                else:
+                    records, samples = events_to_records(source.get_data()), None
+                if len(records) == 0:
+                    continue
+                self.ring.write(records, samples=samples, write_time=wake_time)
         except Exception as e:
-            self._queue.put(SourceProcessError())
+            self.failed.set()
             raise
-    
-    def get_data(self):
-        try:
-            data = self._queue.get(block=False)
-        except Empty:
-            return []
-        return data
 
 class SourceProxy:
-    def __init__(self, init_func):
-        self._proc = _SourceProcess(init_func)
+    def __init__(self, init_func, *, capacity: int = RING_CAPACITY):
+        """
+            Args:
+                init_func: called in the source process to create the source
+                capacity: number of events buffered in shared memory before new events are dropped
+            """
+        self._proc = _SourceProcess(init_func, capacity = capacity)
         self._proc.start()
+        self.delivery_stats = DeliveryStats()
+    
+    @property
+    def dropped(self) -> int:
+        """number of events dropped because they were not read before the buffer filled"""
+        return self._proc.ring.dropped
+    
+    @property
+    def overruns(self) -> int:
+        """number of times the source process found the buffer full"""
+        return self._proc.ring.overruns
     
     def wait_for_start(self):
         return {'ts': 0}
     
+    def get_records(self) -> Tuple[np.ndarray, np.ndarray]:
+        """returns all new events as an array of butil.event_source.shm_ring.EVENT_RECORD_DTYPE
+            and the samples of its analog blocks
+            """
+        records, samples, write_time = self._proc.ring.read()
+        if len(records) == 0:
+            # raise only once the events from before the error are read
+            if self._proc.failed.is_set():
+                raise SourceProcessError()
+            return records, samples
+        self.delivery_stats.add(write_time, len(records))
+        return records, samples
+    
     def get_data(self):
-        res = self._proc.get_data()
-        if type(res) == SourceProcessError:
-            raise res # type: ignore
-        return res
+        from ..plexon import records_to_events
+        return records_to_events(*self.get_records())
@@ -0,0 +1,189 @@
+
+from typing import Tuple, Optional
+import atexit
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# values of the record type field, indexes into PlexonEvent.TYPES
+RECORD_ANALOG = 0
+RECORD_SPIKE = 1
+RECORD_EVENT = 2
+RECORD_OTHER_EVENT = 3
+# a block of continuous samples, ts is the time of the first sample, unit the number of
+# samples and value the sample rate, the samples themselves are kept separately
+RECORD_ANALOG_BLOCK = 4
+
+# one PlexonEvent, packed so records are the same size in every process
+EVENT_RECORD_DTYPE = np.dtype([
+    ('ts', '<f8'),
+    ('type', 'u1'),
+    ('chan', '<i4'),
+    ('unit', '<i4'),
+    ('value', '<f8'),
+    ('falling', 'u1'),
+])
+
+RING_CAPACITY = 2**20
+SAMPLE_CAPACITY = 2**22
+
+# header counter indexes
+_WRITE_COUNT = 0
+_READ_COUNT = 1
+_DROPPED = 2
+_OVERRUNS = 3
+_SAMPLE_WRITE_COUNT = 4
+_SAMPLE_READ_COUNT = 5
+_NUM_COUNTERS = 6
+# time.perf_counter() of the last write is stored after the counters
+_WRITE_TIME_OFFSET = _NUM_COUNTERS * 8
+_RECORDS_OFFSET = _WRITE_TIME_OFFSET + 8
+
+def _ring_put(ring: np.ndarray, count: int, values: np.ndarray):
+    """copies values into ring starting at total write count `count`"""
+    start = count % len(ring)
+    first = min(len(values), len(ring) - start)
+    ring[start:start + first] = values[:first]
+    ring[:len(values) - first] = values[first:]
+
+def _ring_take(ring: np.ndarray, count: int, n: int) -> np.ndarray:
+    """returns a copy of n values starting at total read count `count`"""
+    start = count % len(ring)
+    end = start + n
+    if end <= len(ring):
+        return ring[start:end].copy()
+    return np.concatenate([ring[start:], ring[:end - len(ring)]])
+
+class EventRing:
+    """ring buffer of event records in shared memory with one writer and one reader
+    
+    the samples of RECORD_ANALOG_BLOCK records are stored in a second ring of float64
+    values, in the same order as their records
+    
+    the writer only advances the write counts and the reader only advances the read counts,
+    so no lock is needed. the writer never overwrites data the reader hasn't read, if
+    either ring is too full for a write the whole write is dropped and counted instead
+    
+    the process that creates the ring owns the shared memory and unlinks it on close
+    """
+    
+    def __init__(self, capacity: int = RING_CAPACITY, *, sample_capacity: int = SAMPLE_CAPACITY):
+        """
+            Args:
+                capacity: number of records
+                sample_capacity: number of analog block samples
+            """
+        self.capacity = capacity
+        self.sample_capacity = sample_capacity
+        size = _RECORDS_OFFSET + capacity * EVENT_RECORD_DTYPE.itemsize + sample_capacity * 8
+        self._shm = SharedMemory(create=True, size=size)
+        self._owner = True
+        self._closed = False
+        self._map()
+        self._counters.fill(0)
+        self._write_time[0] = 0
+        # unlink the shared memory if it isn't closed explicitly
+        atexit.register(self.close)
+    
+    def _map(self):
+        buf = self._shm.buf
+        self._counters = np.ndarray((_NUM_COUNTERS,), dtype='<i8', buffer=buf)
+        self._write_time = np.ndarray((1,), dtype='<f8', buffer=buf, offset=_WRITE_TIME_OFFSET)
+        self._records = np.ndarray((self.capacity,), dtype=EVENT_RECORD_DTYPE, buffer=buf, offset=_RECORDS_OFFSET)
+        samples_offset = _RECORDS_OFFSET + self.capacity * EVENT_RECORD_DTYPE.itemsize
+        self._samples = np.ndarray((self.sample_capacity,), dtype='<f8', buffer=buf, offset=samples_offset)
+    
+    def __getstate__(self):
+        return {
+            'name': self._shm.name,
+            'capacity': self.capacity,
+            'sample_capacity': self.sample_capacity,
+        }
+    
+    def __setstate__(self, state):
+        self.capacity = state['capacity']
+        self.sample_capacity = state['sample_capacity']
+        self._shm = SharedMemory(name=state['name'])
+        self._owner = False
+        self._closed = False
+        self._map()
+    
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        # the arrays must be released before the shared memory can be closed
+        del self._counters
+        del self._write_time
+        del self._records
+        del self._samples
+        try:
+            self._shm.close()
+        except BufferError:
+            # views of the records are still referenced, the memory is released when the process exits
+            pass
+        if self._owner:
+            self._shm.unlink()
+    
+    @property
+    def dropped(self) -> int:
+        """number of records dropped because the ring was full when they were written"""
+        return int(self._counters[_DROPPED])
+    
+    @property
+    def overruns(self) -> int:
+        """number of writes dropped because the ring was full"""
+        return int(self._counters[_OVERRUNS])
+    
+    @property
+    def pending(self) -> int:
+        """number of records written but not yet read"""
+        return int(self._counters[_WRITE_COUNT] - self._counters[_READ_COUNT])
+    
+    def write(self, records: np.ndarray, *, samples: Optional[np.ndarray] = None, write_time: float) -> bool:
+        """writes records with EVENT_RECORD_DTYPE, returns False if the write was dropped
+            
+            Args:
+                samples: samples of all RECORD_ANALOG_BLOCK records in records, concatenated
+                write_time: time.perf_counter() when the records became available
+            """
+        counters = self._counters
+        write_count = int(counters[_WRITE_COUNT])
+        sample_write_count = int(counters[_SAMPLE_WRITE_COUNT])
+        num_samples = 0 if samples is None else len(samples)
+        free = self.capacity - (write_count - int(counters[_READ_COUNT]))
+        free_samples = self.sample_capacity - (sample_write_count - int(counters[_SAMPLE_READ_COUNT]))
+        if len(records) > free or num_samples > free_samples:
+            counters[_DROPPED] += len(records)
+            counters[_OVERRUNS] += 1
+            return False
+        
+        _ring_put(self._records, write_count, records)
+        if num_samples:
+            _ring_put(self._samples, sample_write_count, samples)
+            counters[_SAMPLE_WRITE_COUNT] = sample_write_count + num_samples
+        self._write_time[0] = write_time
+        # publish the records only after they and their samples are in the ring
+        counters[_WRITE_COUNT] = write_count + len(records)
+        return True
+    
+    def read(self) -> Tuple[np.ndarray, np.ndarray, float]:
+        """returns copies of all unread records and their samples and the time of the last write"""
+        counters = self._counters
+        read_count = int(counters[_READ_COUNT])
+        n = int(counters[_WRITE_COUNT]) - read_count
+        write_time = float(self._write_time[0])
+        if n == 0:
+            return np.empty(0, dtype=EVENT_RECORD_DTYPE), np.empty(0), write_time
+        
+        records = _ring_take(self._records, read_count, n)
+        # the sample count of the records read is used since the writer may have added
+        # samples for records it hasn't published yet
+        blocks = records['type'] == RECORD_ANALOG_BLOCK
+        num_samples = int(records['unit'][blocks].sum())
+        sample_read_count = int(counters[_SAMPLE_READ_COUNT])
+        samples = _ring_take(self._samples, sample_read_count, num_samples)
+        # frees the space for the writer
+        counters[_SAMPLE_READ_COUNT] = sample_read_count + num_samples
+        counters[_READ_COUNT] = read_count + n
+        return records, samples, write_time
@@ -6,6 +6,8 @@ from base64 import b85encode
 from collections.abc import Callable
 from struct import Struct
 
+import numpy as np
+
 from .out_file import EventFile
 
 FlushCallback = Callable[[str], None]
@@ -44,6 +46,10 @@ class NumChunker:
     def append(self, x):
         self._buf.extend(self._packer.pack(x))
         self.flush()
+    
+    def append_array(self, xs: np.ndarray):
+        self._buf.extend(np.asarray(xs, dtype='<f8').tobytes())
+        self.flush()
 
 class AnalogOut:
     def __init__(self, channel: str, event_file: EventFile):
@@ -68,3 +74,11 @@ class AnalogOut:
         if self._ts is None:
             self._ts = ts
         self._chunker.append(x)
+    
+    def append_block(self, xs: np.ndarray, *, ts: float | None = None):
+        """appends consecutive samples, ts is the time of the first sample"""
+        if len(xs) == 0:
+            return
+        if self._ts is None:
+            self._ts = ts
+        self._chunker.append_array(xs)
@@ -2,14 +2,22 @@
 import logging
 from pathlib import Path
 import os
-from multiprocessing import Process, Queue as PQueue
-from queue import Empty
+from multiprocessing import Process, Event as PEvent
 import platform
+import time
+from typing import List, Iterable, Optional, Tuple, Dict
+
+import numpy as np
 
 from .common import PlexonError
 
 from .plexdo import PlexDo
 from .. import DigitalOutput
+from ..event_source.process_source import DeliveryStats, SourceProcessError, SOURCE_WAIT_TIMEOUT
+from ..event_source.shm_ring import (
+    EventRing, EVENT_RECORD_DTYPE, RING_CAPACITY,
+    RECORD_ANALOG, RECORD_SPIKE, RECORD_EVENT, RECORD_OTHER_EVENT, RECORD_ANALOG_BLOCK,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +26,9 @@ class PlexonEvent:
     SPIKE = 'spike'
     EVENT = 'event'
     OTHER_EVENT = 'other_event'
+    # indexed by the type field of event records
+    TYPES = (ANALOG, SPIKE, EVENT, OTHER_EVENT)
+    TYPE_CODES = {t: i for i, t in enumerate(TYPES)}
     
     def __init__(self, ts, event_type, *,
         value: float = 0,
@@ -36,11 +47,93 @@ class PlexonEvent:
     def rising(self) -> bool:
         return not self.falling
 
+class AnalogBlock:
+    """consecutive samples of one continuous channel"""
+    __slots__ = ('ts', 'chan', 'rate', 'values', '_timestamps')
+    
+    def __init__(self, ts: float, *, chan: int, rate: float, values: np.ndarray):
+        """
+            Args:
+                ts: time of the first sample
+                rate: samples per second
+                values: scaled sample values
+            """
+        self.ts = ts
+        self.chan = chan
+        self.rate = rate
+        self.values = values
+        self._timestamps: Optional[np.ndarray] = None
+    
+    def __len__(self):
+        return len(self.values)
+    
+    @property
+    def timestamps(self) -> np.ndarray:
+        """time of each sample, computed on first use"""
+        if self._timestamps is None:
+            self._timestamps = self.ts + np.arange(len(self.values)) / self.rate
+        return self._timestamps
+
+def events_to_records(events: Iterable[PlexonEvent]) -> np.ndarray:
+    codes = PlexonEvent.TYPE_CODES
+    return np.array([
+        (e.ts, codes[e.type], e.chan, e.unit, e.value, e.falling)
+        for e in events
+    ], dtype=EVENT_RECORD_DTYPE)
+
+def records_to_events(records: np.ndarray, samples: Optional[np.ndarray] = None) -> List[PlexonEvent]:
+    """converts records to events, analog blocks are expanded to one event per sample"""
+    types = PlexonEvent.TYPES
+    events = []
+    samples_i = 0
+    for ts, event_type, chan, unit, value, falling in records.tolist():
+        if event_type == RECORD_ANALOG_BLOCK:
+            assert samples is not None
+            block = AnalogBlock(ts, chan=chan, rate=value, values=samples[samples_i:samples_i + unit])
+            samples_i += unit
+            events.extend(
+                PlexonEvent(sample_ts, PlexonEvent.ANALOG, value=sample, chan=chan)
+                for sample_ts, sample in zip(block.timestamps.tolist(), block.values.tolist())
+            )
+        else:
+            events.append(PlexonEvent(ts, types[event_type], value=value, chan=chan, unit=unit, falling=bool(falling)))
+    return events
+
 class Plexon:
-    def __init__(self):
-        from .pyopxclient import PyOPXClientAPI, OPX_ERROR_NOERROR, SPIKE_TYPE, CONTINUOUS_TYPE, EVENT_TYPE, OTHER_TYPE
+    # block kinds in the source number lookup table used by get_data
+    _KIND_NONE = 0
+    _KIND_ANALOG = 1
+    _KIND_SPIKE = 2
+    _KIND_EVENT = 3
+    _KIND_OTHER_EVENT = 4
+    # record type of each block kind
+    _KIND_RECORD_TYPES = np.array([0, RECORD_ANALOG_BLOCK, RECORD_SPIKE, RECORD_EVENT, RECORD_OTHER_EVENT], dtype=np.uint8)
+    
+    def __init__(self, *,
+        timestamps_only: bool = False,
+        spike_channels: Optional[Dict[int, List[int]]] = None,
+    ):
+        """
+            Args:
+                timestamps_only: exclude continuous sources at the server and poll
+                    spike and event timestamps only, no analog events are produced
+                spike_channels: { channel => [unit] } of the spikes to keep, None or empty keeps all
+                    spikes. the server can only exclude whole sources so the other spikes are
+                    still transferred and are dropped when read
+            """
+        from .pyopxclient import PyOPXClientAPI, OPX_ERROR_NOERROR, OPX_ERROR_TIMEOUT, SPIKE_TYPE, CONTINUOUS_TYPE, EVENT_TYPE, OTHER_TYPE
+        self._OPX_ERROR_TIMEOUT = OPX_ERROR_TIMEOUT
         self._SPIKE_TYPE = SPIKE_TYPE
         self._CONTINUOUS_TYPE = CONTINUOUS_TYPE
+        self._timestamps_only = timestamps_only
+        # (channel << 16 | unit) of the spikes to keep, None keeps all spikes
+        self._spike_units: Optional[np.ndarray] = None
+        if spike_channels:
+            self._spike_units = np.array([
+                chan << 16 | unit
+                for chan, units in spike_channels.items()
+                for unit in units
+            ], dtype=np.uint32)
         
         self.client = PyOPXClientAPI()
         
@@ -55,6 +148,8 @@ class Plexon:
         self.client.exclude_source('WB')
         self.client.exclude_source('FP')
         self.client.exclude_source('SPKC')
+        if timestamps_only:
+            self.client.exclude_source_type(CONTINUOUS_TYPE)
         
         self.source_numbers_types = {}
         self.source_numbers_names = {}
@@ -100,82 +195,179 @@ class Plexon:
                     self.source_numbers_rates[global_parameters.source_ids[index]] = rate
                     self.source_numbers_voltage_scalers[global_parameters.source_ids[index]] = voltage_scaler
                     logger.info("Digitization Rate: {}, Voltage Scaler: {}".format(rate, voltage_scaler))
+        
+        if spike_channels:
+            # only helps if there are several spike sources, usually a single source has every channel
+            for num, source_type in self.source_numbers_types.items():
+                if source_type != SPIKE_TYPE:
+                    continue
+                source_name, _, num_chans, _ = self.client.get_source_info(num)
+                # spike channels are numbered from 1 within each source
+                if not any(1 <= chan <= num_chans for chan in spike_channels):
+                    logger.info('excluding spike source %s, it has none of the used channels', source_name)
+                    self.client.exclude_source(num)
+        
+        # lookup tables indexed by source number so get_data can classify all blocks at once
+        self._source_kinds = np.zeros(256, dtype=np.uint8)
+        self._voltage_scalers = np.zeros(256)
+        self._rates = np.ones(256)
+        for num, source_type in self.source_numbers_types.items():
+            if source_type == SPIKE_TYPE:
+                self._source_kinds[num] = self._KIND_SPIKE
+        if not timestamps_only:
+            for num, voltage_scaler in self.source_numbers_voltage_scalers.items():
+                self._source_kinds[num] = self._KIND_ANALOG
+                self._voltage_scalers[num] = voltage_scaler
+                self._rates[num] = self.source_numbers_rates[num]
+        if hasattr(self, 'event_source'):
+            self._source_kinds[self.event_source] = self._KIND_EVENT
+        if hasattr(self, 'other_event_source'):
+            self._source_kinds[self.other_event_source] = self._KIND_OTHER_EVENT
     
     def wait_for_start(self):
         while True:
-            new_data = self.client.get_new_data()
-            for i in range(new_data.num_data_blocks):
-                if new_data.source_num_or_type[i] == self.other_event_source and new_data.channel[i] == 2: # Start event timestamp is channel 2 in 'Other Events' source
-                    return {
-                        'ts': new_data.timestamp[i],
-                    }
-    
-    def get_data(self):
-        # self.client.opx_wait(5)
-        new_data = self.client.get_new_data()
+            new_data = self.client.get_new_data_arrays(timestamps_only = self._timestamps_only)
+            # Start event timestamp is channel 2 in 'Other Events' source
+            start = np.flatnonzero((new_data.source_num_or_type == self.other_event_source) & (new_data.channel == 2))
+            if len(start):
+                return {
+                    'ts': float(new_data.timestamp[start[0]]),
+                }
+    
+    def wait_for_data(self, timeout: float) -> bool:
+        """blocks on the server wait handle until new data is published or timeout seconds pass
         
-        for i in range(new_data.num_data_blocks):
-            num_or_type = new_data.source_num_or_type[i]
-            block_type = self.source_numbers_types[new_data.source_num_or_type[i]]
-            source_name = self.source_numbers_names[new_data.source_num_or_type[i]]
-            chan = new_data.channel[i]
-            ts = new_data.timestamp[i]
+        returns False if the wait timed out
+        """
+        self.client.opx_wait(max(1, round(timeout * 1000)))
+        return self.client.last_result != self._OPX_ERROR_TIMEOUT
+    
+    def get_records(self) -> Tuple[np.ndarray, np.ndarray]:
+        """returns all new events as an array of EVENT_RECORD_DTYPE and the samples of its analog blocks
             
-            if block_type == self._CONTINUOUS_TYPE and source_name == 'AI':
-                voltage_scaler = self.source_numbers_voltage_scalers[num_or_type]
-                samples = new_data.waveform[i]
-                samples = (s * voltage_scaler for s in samples)
-                
-                for val in samples:
-                    yield PlexonEvent(ts, PlexonEvent.ANALOG, value=val, chan=chan)
-            elif block_type == self._SPIKE_TYPE:
-                unit = new_data.unit[i]
-                yield PlexonEvent(ts, PlexonEvent.SPIKE, chan=chan, unit=unit)
-            elif num_or_type == self.event_source:
-                yield PlexonEvent(ts, PlexonEvent.EVENT, chan=chan)
-            elif num_or_type == self.other_event_source:
-                if chan == 1:
-                    continue
-                yield PlexonEvent(ts, PlexonEvent.OTHER_EVENT, chan=chan)
+            each continuous block is one RECORD_ANALOG_BLOCK record, its scaled samples are
+            concatenated into the samples array in record order
+            """
+        # self.client.opx_wait(5)
+        # views into the client's buffer, only valid until the next call
+        new_data = self.client.get_new_data_arrays(timestamps_only = self._timestamps_only)
+        
+        source_nums = new_data.source_num_or_type
+        kinds = self._source_kinds[source_nums]
+        # channel 1 of 'Other events' is skipped
+        kinds[(kinds == self._KIND_OTHER_EVENT) & (new_data.channel == 1)] = self._KIND_NONE
+        if self._spike_units is not None:
+            # channels can't be excluded at the server, only whole sources
+            unit_keys = new_data.channel.astype(np.uint32) << 16 | new_data.unit
+            kinds[(kinds == self._KIND_SPIKE) & ~np.isin(unit_keys, self._spike_units)] = self._KIND_NONE
+        keep = np.flatnonzero(kinds)
+        kinds = kinds[keep]
+        
+        records = np.zeros(len(keep), dtype=EVENT_RECORD_DTYPE)
+        records['ts'] = new_data.timestamp[keep]
+        records['type'] = self._KIND_RECORD_TYPES[kinds]
+        records['chan'] = new_data.channel[keep]
+        records['unit'] = np.where(kinds == self._KIND_SPIKE, new_data.unit[keep], 0)
+        
+        is_ai = kinds == self._KIND_ANALOG
+        ai_rows = keep[is_ai]
+        if len(ai_rows) == 0:
+            return records, np.empty(0)
+        
+        counts = new_data.number_of_data_words[ai_rows]
+        records['unit'][is_ai] = counts
+        records['value'][is_ai] = self._rates[source_nums[ai_rows]]
+        ai_values = new_data.waveform[ai_rows] * self._voltage_scalers[source_nums[ai_rows], np.newaxis]
+        # words past each block's word count are padding
+        valid = np.arange(ai_values.shape[1]) < counts[:, np.newaxis]
+        return records, ai_values[valid]
+    
+    def get_data(self) -> List[PlexonEvent]:
+        return records_to_events(*self.get_records())
 
 class _PlexonProcess(Process):
-    def __init__(self):
-        self._queue = PQueue()
+    def __init__(self, *,
+        timestamps_only: bool = False,
+        spike_channels: Optional[Dict[int, List[int]]] = None,
+        capacity: int = RING_CAPACITY,
+    ):
+        self.ring = EventRing(capacity)
+        self.failed = PEvent()
+        self._timestamps_only = timestamps_only
+        self._spike_channels = spike_channels
         super().__init__(daemon=True)
     
     def run(self):
-        plexon = Plexon()
-        
-        while True:
-            plexon.client.opx_wait(1)
-            data = list(plexon.get_data())
-            if not data:
-                continue
-            self._queue.put(data)
-    
-    def get_data(self):
         try:
-            data = self._queue.get(block=False)
-        except Empty:
-            return []
-        return data
+            plexon = Plexon(
+                timestamps_only = self._timestamps_only,
+                spike_channels = self._spike_channels,
+            )
+            
+            while True:
+                if not plexon.wait_for_data(SOURCE_WAIT_TIMEOUT):
+                    continue
+                wake_time = time.perf_counter()
+                records, samples = plexon.get_records()
+                if len(records) == 0:
+                    continue
+                self.ring.write(records, samples=samples, write_time=wake_time)
+        except Exception:
+            self.failed.set()
+            raise
 
 class PlexonProxy:
-    def __init__(self):
-        self._proc = _PlexonProcess()
+    def __init__(self, *,
+        timestamps_only: bool = False,
+        spike_channels: Optional[Dict[int, List[int]]] = None,
+        capacity: int = RING_CAPACITY,
+    ):
+        """
+            Args:
+                timestamps_only, spike_channels: see Plexon
+                capacity: number of events buffered in shared memory before new events are dropped
+            """
+        self._proc = _PlexonProcess(
+            timestamps_only = timestamps_only,
+            spike_channels = spike_channels,
+            capacity = capacity,
+        )
         self._proc.start()
+        self.delivery_stats = DeliveryStats()
+    
+    @property
+    def dropped(self) -> int:
+        """number of events dropped because they were not read before the buffer filled"""
+        return self._proc.ring.dropped
+    
+    @property
+    def overruns(self) -> int:
+        """number of times the plexon process found the buffer full"""
+        return self._proc.ring.overruns
     
     def wait_for_start(self):
         while True:
-            new_data = self._proc.get_data()
-            for x in new_data:
-                if x.type == x.OTHER_EVENT and x.chan == 2:
-                    return {
-                        'ts': x.ts
-                    }
-    
-    def get_data(self):
-        return self._proc.get_data()
+            records, _ = self.get_records()
+            # Start event timestamp is channel 2 in 'Other Events' source
+            start = np.flatnonzero((records['type'] == RECORD_OTHER_EVENT) & (records['chan'] == 2))
+            if len(start):
+                return {
+                    'ts': float(records['ts'][start[0]]),
+                }
+    
+    def get_records(self) -> Tuple[np.ndarray, np.ndarray]:
+        """returns all new events and analog block samples, see Plexon.get_records"""
+        records, samples, write_time = self._proc.ring.read()
+        if len(records) == 0:
+            # raise only once the events from before the error are read
+            if self._proc.failed.is_set():
+                raise SourceProcessError()
+            return records, samples
+        self.delivery_stats.add(write_time, len(records))
+        return records, samples
+    
+    def get_data(self) -> List[PlexonEvent]:
+        return records_to_events(*self.get_records())
 
 class PlexonOutput(DigitalOutput):
     def __init__(self):
@@ -7,11 +7,13 @@
 # You are free to modify or share this file, provided that the above
 # copyright notice is kept intact.
 
-from ctypes import Structure, c_int32, c_double, c_uint8, c_uint32, c_uint16, c_int16, WinDLL, byref, c_char, c_int, c_uint, c_byte, c_ulonglong, c_ulong, c_bool, c_float
+from ctypes import Structure, c_int32, c_double, c_uint8, c_uint32, c_uint16, c_int16, WinDLL, byref, c_char, c_int, c_uint, c_byte, c_ulonglong, c_ulong, c_bool, c_float, sizeof
 import os
 import platform
 from collections import namedtuple
 
+import numpy as np
+
 # Temporary, TODO
 TS64 = 1
 
@@ -68,6 +70,10 @@ FilterInfo = namedtuple('FilterInfo', 'hpf_enabled, hpf_filter_type, hpf_num_pol
 NewData = namedtuple('NewData', 'num_data_blocks, source_num_or_type, timestamp, channel, unit, number_of_blocks_per_waveform, block_number_for_waveform, waveform')
 # Named tuple to organize information returned from PyOPXClient.get_new_timestamps()
 NewTimestamps = namedtuple('NewTimestamps', 'num_timestamps, timestamp, source_num_or_type, channel, unit')
+# Named tuple to organize information returned from PyOPXClient.get_new_timestamps_arrays()
+NewTimestampsArrays = namedtuple('NewTimestampsArrays', 'num_timestamps, timestamp, source_num_or_type, channel, unit')
+# Named tuple to organize information returned from PyOPXClient.get_new_data_arrays()
+NewDataArrays = namedtuple('NewDataArrays', 'num_data_blocks, source_num_or_type, ticks, timestamp, channel, unit, number_of_blocks_per_waveform, block_number_for_waveform, number_of_data_words, waveform')
 
 # TODO
 # - Conversion from string/bytes/UTF is functional but sloppy
@@ -115,6 +121,24 @@ class OPX_DataBlock(Structure):
                 ("NumberOfDataWords", c_uint8),         # Number of shorts (2-byte integers) that follow this header
                 ("WaveForm", c_int16 * MAX_WF_LENGTH)]  # The spike waveform or a series of continuous data samples
 
+# NumPy dtype with the same memory layout as OPX_DataBlock, used to view an array of data blocks without copying
+OPX_DATA_BLOCK_DTYPE = np.dtype({
+    'names': ['SourceNumOrType', 'UpperTS', 'TimeStamp', 'Channel', 'Unit', 'NumberOfBlocksPerWaveform', 'BlockNumberForWaveform', 'NumberOfDataWords', 'WaveForm'],
+    'formats': [np.uint8, np.uint8, np.uint32, np.uint16, np.uint16, np.uint8, np.uint8, np.uint8, (np.int16, MAX_WF_LENGTH)],
+    'offsets': [
+        OPX_DataBlock.SourceNumOrType.offset,
+        OPX_DataBlock.UpperTS.offset,
+        OPX_DataBlock.TimeStamp.offset,
+        OPX_DataBlock.Channel.offset,
+        OPX_DataBlock.Unit.offset,
+        OPX_DataBlock.NumberOfBlocksPerWaveform.offset,
+        OPX_DataBlock.BlockNumberForWaveform.offset,
+        OPX_DataBlock.NumberOfDataWords.offset,
+        OPX_DataBlock.WaveForm.offset,
+    ],
+    'itemsize': sizeof(OPX_DataBlock),
+})
+
 class OPX_FilterInfo(Structure):
     _fields_ = [("m_bEnabledHPF", c_bool),
                 ("m_filterTypeHPF", c_int32),
@@ -145,8 +169,12 @@ class PyOPXClient:
         self.max_opx_data = max_opx_data
         self.opx_dll_path = os.path.abspath(opxclient_dll_path)
         
-        # Used in get_new_data()
+        # Used in get_new_data() and get_new_data_arrays()
         self.data_blocks = (OPX_DataBlock * self.max_opx_data)()
+        # Structured array view of self.data_blocks, shares memory with the ctypes array
+        self.data_blocks_np = np.frombuffer(self.data_blocks, dtype = OPX_DATA_BLOCK_DTYPE)
+        # Timestamp tick frequency, read from the global parameters on first use
+        self.timestamp_frequency = None
 
         # Used in get_new_timestamps()
         self.num_timestamps = (c_int)(self.max_opx_data)
@@ -154,6 +182,11 @@ class PyOPXClient:
         self.source_num_or_type = (c_byte * self.max_opx_data)(0)
         self.channel = (c_uint16 * self.max_opx_data)(0)
         self.unit = (c_uint16 * self.max_opx_data)(0)
+        # Array views of the above, share memory with the ctypes arrays
+        self.timestamp_np = np.frombuffer(self.timestamp, dtype = np.float64)
+        self.source_num_or_type_np = np.frombuffer(self.source_num_or_type, dtype = np.uint8)
+        self.channel_np = np.frombuffer(self.channel, dtype = np.uint16)
+        self.unit_np = np.frombuffer(self.unit, dtype = np.uint16)
         
         if self.platform == '32bit':
             self.opx_dll_file = os.path.join(self.opx_dll_path, 'OPXClient.dll')
@@ -621,26 +654,65 @@ class PyOPXClient:
         Note: the OPX_SetDataFormat function determines whether source types or source numbers
         appear in source_num_or_type; by default, source numbers are returned
         """
+        result, data = self.get_new_data_arrays()
+        
+        waveform = [tuple(w[:n]) for w, n in zip(data.waveform.tolist(), data.number_of_data_words.tolist())]
+
+        return result, NewData(num_data_blocks = data.num_data_blocks,
+                                source_num_or_type = data.source_num_or_type.tolist(),
+                                timestamp = data.timestamp.tolist(),
+                                channel = data.channel.tolist(),
+                                unit = data.unit.tolist(),
+                                number_of_blocks_per_waveform = data.number_of_blocks_per_waveform.tolist(),
+                                block_number_for_waveform = data.block_number_for_waveform.tolist(),
+                                waveform = waveform)
+
+    def get_new_data_arrays(self):
+        """
+        Get a batch of online client data as NumPy arrays.
+
+        The fields other than timestamp are views into the buffer that OPX_GetNewData writes to, so no per block
+        Python objects are created. The views are only valid until the next call to get_new_data() or
+        get_new_data_arrays(), copy them to keep the data longer.
+
+        Args:
+            None
+
+        Returns:
+            result - OPX_ERROR_NOERROR on success
+            NewDataArrays - named tuple loaded with arrays of length num_data_blocks:
+                .num_data_blocks - number of data blocks returned
+                .source_num_or_type - source number or type of data block (uint8)
+                .ticks - 40 bit spike, continuous, and event timestamps in timestamp ticks (uint64)
+                .timestamp - spike, continuous, and event timestamps in seconds (float64)
+                .channel - channel numbers for each block (uint16)
+                .unit - units (0 = unsorted, 1 = Unit A, 2 = Unit B, etc) for spike timestamps, or a strobed event word value for a strobed event timestamp (uint16)
+                .number_of_blocks_per_waveform - how many blocks an individual spike waveform is spread across (uint8)
+                .block_number_for_waveform - block number of multiple-block spike waveform (uint8)
+                .number_of_data_words - number of valid words at the start of each waveform row (uint8)
+                .waveform - spike or continuous waveform data, shape (num_data_blocks, MAX_WF_LENGTH) (int16)
+        """
+        if self.timestamp_frequency is None:
+            _, global_parameters = self.get_global_parameters()
+            self.timestamp_frequency = global_parameters.timestamp_frequency
+        
         num_data_blocks = c_int(self.max_opx_data)
         
         result = self.opxclient_dll.OPX_GetNewData(byref(num_data_blocks), byref(self.data_blocks))
         
-        source_num_or_type = [self.data_blocks[n].SourceNumOrType for n in range(num_data_blocks.value)]
-        timestamp = [self.get_64_bit_double_timestamp_from_data_block(self.data_blocks[n]) for n in range(num_data_blocks.value)]
-        channel = [self.data_blocks[n].Channel for n in range(num_data_blocks.value)]
-        unit = [self.data_blocks[n].Unit for n in range(num_data_blocks.value)]
-        number_of_blocks_per_waveform = [self.data_blocks[n].NumberOfBlocksPerWaveform for n in range(num_data_blocks.value)]
-        block_number_for_waveform = [self.data_blocks[n].BlockNumberForWaveform for n in range(num_data_blocks.value)]
-        waveform = [tuple(self.data_blocks[n].WaveForm[0:self.data_blocks[n].NumberOfDataWords]) for n in range(num_data_blocks.value)]
-
-        return result, NewData(num_data_blocks = num_data_blocks.value,
-                                source_num_or_type = source_num_or_type,
-                                timestamp = timestamp,
-                                channel = channel,
-                                unit = unit,
-                                number_of_blocks_per_waveform = number_of_blocks_per_waveform,
-                                block_number_for_waveform = block_number_for_waveform,
-                                waveform = waveform)
+        blocks = self.data_blocks_np[:num_data_blocks.value]
+        ticks = (blocks['UpperTS'].astype(np.uint64) << np.uint64(32)) | blocks['TimeStamp']
+        
+        return result, NewDataArrays(num_data_blocks = num_data_blocks.value,
+                                source_num_or_type = blocks['SourceNumOrType'],
+                                ticks = ticks,
+                                timestamp = ticks / self.timestamp_frequency,
+                                channel = blocks['Channel'],
+                                unit = blocks['Unit'],
+                                number_of_blocks_per_waveform = blocks['NumberOfBlocksPerWaveform'],
+                                block_number_for_waveform = blocks['BlockNumberForWaveform'],
+                                number_of_data_words = blocks['NumberOfDataWords'],
+                                waveform = blocks['WaveForm'])
 
     def get_new_data_ex(self):
         """
@@ -706,15 +778,43 @@ class PyOPXClient:
         Note: the OPX_SetDataFormat function determines whether source types or source numbers
         appear in source_num_or_type; by default, source numbers are returned 
         """
+        result, data = self.get_new_timestamps_arrays()
+
+        return result, NewTimestamps(num_timestamps = data.num_timestamps,
+                                        timestamp = data.timestamp.tolist(),
+                                        source_num_or_type = data.source_num_or_type.tolist(),
+                                        channel = data.channel.tolist(),
+                                        unit = data.unit.tolist())
+
+    def get_new_timestamps_arrays(self):
+        """
+        Get a batch of online client data as NumPy arrays; no spike waveforms or continuous data are returned.
+
+        The arrays are views into the buffers that OPX_GetNewTimestamps writes to and are only valid until
+        the next call to get_new_timestamps() or get_new_timestamps_arrays().
+
+        Args:
+            None
+
+        Returns:
+            result - OPX_ERROR_NOERROR on success
+            NewTimestampsArrays - named tuple loaded with arrays of length num_timestamps:
+                .num_timestamps - the number of timestamps returned
+                .timestamp - spike and event timestamps in seconds (float64)
+                .source_num_or_type - source numbers or source types (SPIKE_TYPE or EVENT_TYPE) for each timestamp (uint8)
+                .channel - channel numbers for each timestamp (uint16)
+                .unit - units (0 = unsorted, 1 = Unit A, 2 = Unit B, etc) for spike timestamps, or a strobed event word value for a strobed event timestamp (uint16)
+        """
         num_timestamps = (c_int)(self.max_opx_data)
         
         result = self.opxclient_dll.OPX_GetNewTimestamps(byref(num_timestamps), byref(self.timestamp), byref(self.source_num_or_type), byref(self.channel), byref(self.unit))
-
-        return result, NewTimestamps(num_timestamps = num_timestamps.value,
-                                        timestamp = [self.timestamp[n] for n in range(self.num_timestamps.value)],
-                                        source_num_or_type = [self.source_num_or_type[n] for n in range(self.num_timestamps.value)],
-                                        channel = [self.channel[n] for n in range(self.num_timestamps.value)],
-                                        unit = [self.unit[n] for n in range(self.num_timestamps.value)])
+        
+        n = num_timestamps.value
+        return result, NewTimestampsArrays(num_timestamps = n,
+                                        timestamp = self.timestamp_np[:n],
+                                        source_num_or_type = self.source_num_or_type_np[:n],
+                                        channel = self.channel_np[:n],
+                                        unit = self.unit_np[:n])
     
     def set_data_format(self, data_format):
         """